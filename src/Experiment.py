@@ -1,6 +1,8 @@
 import matplotlib.pyplot as plt
 import cPickle as pkl
 
+import Tools
+
 from SpikeTrainComparator import *
 from SpikingModel import *
 from Trace import *
@@ -180,7 +182,7 @@ class Experiment :
     ############################################################################################
     # EVALUATE PERFORMANCES OF A MODEL
     ############################################################################################         
-    def predictSpikes(self, spiking_model, nb_rep=500):
+    def predictSpikes(self, spiking_model, nb_rep=500, n_jobs=1, seed=None):
 
         """
         Evaluate the predictive power of a spiking model in predicting the spike timing of the test traces.
@@ -188,6 +190,9 @@ class Experiment :
         
         spiking_model : Spiking Model Object used to predict spiking activity
         np_rep: number of times the spiking model is stimulated to predict spikes
+        n_jobs: number of worker processes among which the repetitions are distributed (-1: one per CPU)
+        seed: seed of the random number generator used by the simulations (see GIF.simulate_batch); for a given seed,
+              the prediction is reproducible and does not depend on n_jobs (if None, a seed is drawn from numpy.random)
   
         Return a SpikeTrainComparator object that can be used to compute different performance metrics.
         """
@@ -209,14 +214,19 @@ class Experiment :
         T_test = self.testset_traces[0].T       # duration of the test set input current
         I_test = self.testset_traces[0].I       # test set current used in experimetns
         
-        all_spks_times_prediction = []
-        
         print "Predict spike times..."
         
-        for rep in np.arange(nb_rep) :
-            print "Progress: %2.1f %% \r" % (100*(rep+1)/nb_rep),
-            spks_times = spiking_model.simulateSpikingResponse(I_test, self.dt)
-            all_spks_times_prediction.append(spks_times)
+        if seed == None :
+            seed = Tools.getRandomSeed()
+        
+        # Each worker simulates a block of consecutive repetitions (rep0, nb_rep_block)
+        all_rep = np.arange(nb_rep)
+        blocks  = [ (int(rep[0]), len(rep)) for rep in np.array_split(all_rep, Tools.getJobsNb(n_jobs)) if len(rep) > 0 ]
+        
+        all_spks_times_prediction = []
+        
+        for spks_block in Tools.parallelMap(predictSpikes_block, blocks, n_jobs=n_jobs, data=(spiking_model, I_test, self.dt, seed)) :
+            all_spks_times_prediction.extend(spks_block)
         
         # Create SpikeTrainComparator object containing experimental and predicted spike times 
         
@@ -400,4 +410,16 @@ class Experiment :
         
         plt.subplots_adjust(left=0.10, bottom=0.07, right=0.95, top=0.92, wspace=0.25, hspace=0.25)
 
-        plt.show()
\ No newline at end of file
+        plt.show()
+
+
+def predictSpikes_block(data, block):
+
+    """
+    Simulate a block of repetitions of Experiment.predictSpikes (executed by the worker processes).
+    """
+
+    (spiking_model, I_test, dt, seed) = data
+    (rep0, nb_rep_block) = block
+
+    return spiking_model.simulateSpikingResponse_batch(I_test, dt, nb_rep_block, seed=seed, rep0=rep0)
@@ -42,6 +42,10 @@ class Filter :
         
         self.filtersupport   = 0               # array, support of interpolated filter (ie, time vector)
         
+        self.version         = 0               # incremented each time the filter is modified (see setModified)
+        
+        self.interpolated    = {}              # cache of interpolated filters, dt -> (version, coefficients, support, filter)
+        
         
         # Results of multiexponantial fit (these parameters are used to approximate the filter as a sum of exponentials)
         
@@ -64,6 +68,8 @@ class Filter :
         """    
         
         self.filter_coeff = np.zeros(self.filter_coeffNb)
+        
+        self.setModified()
 
 
     def setFilter_Coefficients(self, coeff):
@@ -75,6 +81,8 @@ class Filter :
         if len(coeff) == self.filter_coeffNb :
             
             self.filter_coeff = coeff
+            
+            self.setModified()
         
         else :
             
@@ -95,17 +103,88 @@ class Filter :
         return int(self.filter_coeffNb)
 
 
+    def setModified(self):
+        
+        """
+        Increment the version of the filter and empty the cache of interpolated filters.
+        Called each time the basis functions or the coefficients of the filter are changed (e.g., setFilter_Coefficients, setMetaParameters).
+        """
+        
+        self.version      = self.getVersion() + 1
+        self.interpolated = {}
+        
+        
+    def getVersion(self):
+        
+        """
+        Return the version of the filter (see setModified). 
+        Filters saved before the version was introduced have version 0.
+        """
+        
+        return getattr(self, 'version', 0)
+        
+
     def getInterpolatedFilter(self, dt) :
         
         """
         Compute and return the interpolated filter as well as its support.
+        
+        The interpolated filter is computed once for each dt and then taken from a cache, as long as the version of the 
+        filter (see setModified) and its coefficients do not change (the coefficients are also compared, in case they 
+        were modified without calling setFilter_Coefficients). The arrays returned are shared by all the callers and 
+        are read-only.
         """
         
-        self.computeInterpolatedFilter(dt)
+        if not hasattr(self, 'interpolated') :
+            self.interpolated = {}
+        
+        cached = self.interpolated.get(dt)
+        
+        if cached != None and cached[0] == self.getVersion() and np.array_equal(cached[1], self.filter_coeff) :
+            
+            (self.filtersupport, self.filter) = cached[2:]
+            
+        else :
+            
+            self.computeInterpolatedFilter(dt)
+            
+            if self.filter_coeffNb == len(self.filter_coeff) :
+                
+                self.filtersupport = np.array(self.filtersupport)
+                self.filter        = np.array(self.filter)
+                self.filtersupport.flags.writeable = False
+                self.filter.flags.writeable        = False
+                
+                self.interpolated[dt] = (self.getVersion(), np.array(self.filter_coeff, copy=True), self.filtersupport, self.filter)
         
         return (self.filtersupport, self.filter)
 
 
+    def getSpikeUpdate(self, dt) :
+        
+        """
+        Return the representation of the filter used by the C kernels to simulate a spike-triggered process 
+        (i.e., a spike train filtered with the filter, see Tools.adaptation_support_code):
+        - filter : interpolated filter
+        - chg    : change points of the interpolated filter (indices at which its value changes, including 0 and len(filter))
+        - exp_b  : amplitudes of the exponential components of the filter, simulated recursively
+        - exp_d  : decay of the exponential components over one time step dt
+        By default all the filter is contained in its interpolated version (no exponential component).
+        For rectangular basis functions the interpolated filter is piecewise constant and has only a few change points.
+        """
+        
+        (filter_support, filter) = self.getInterpolatedFilter(dt)
+        filter = np.array(filter, dtype='double')
+        
+        chg = np.concatenate( ( [0], np.where(np.diff(filter) != 0)[0] + 1, [len(filter)] ) )
+        chg = chg.astype('int32')
+        
+        exp_b = np.zeros(0)
+        exp_d = np.zeros(0)
+        
+        return (filter, chg, exp_b, exp_d)
+        
+
     def getInterpolatedFilter_expFit(self, dt) :
   
         """
@@ -316,6 +395,7 @@ class Filter :
         F_avg.taus = []
    
         F_avg.filter_coeff = np.mean(F_coeff_all, axis=0)
+        F_avg.setModified()
                 
         # If individual filers have been fitted with exponential function, then average the parameters
         if F.expfit_falg :
@@ -2,10 +2,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from scipy.signal import fftconvolve
-from scipy import weave
-from scipy.weave import converters
 
 import Tools
+from Kernel import *
 
 from Filter import *
 
@@ -42,6 +41,7 @@ class Filter_Exps(Filter) :
  
         self.taus = taus
         self.filter_coeffNb = len(taus)
+        self.setModified()
  
      
      
@@ -92,6 +92,27 @@ class Filter_Exps(Filter) :
         
 
         
+    def getSpikeUpdate(self, dt) :
+        
+        """
+        Return the representation of the filter used by the C kernels to simulate a spike-triggered process.
+        Each exponential function is simulated recursively (see Filter.getSpikeUpdate), so that no interpolated 
+        filter is required.
+        """
+        
+        if self.filter_coeffNb != len(self.filter_coeff) :
+            
+            print "Error: number of filter coefficients does not match the number of basis functions!"
+        
+        filter = np.zeros(0)
+        chg    = np.zeros(0, dtype='int32')
+        
+        exp_b = np.array(self.filter_coeff, dtype='double')
+        exp_d = np.exp(-dt/np.array(self.taus, dtype='double'))
+        
+        return (filter, chg, exp_b, exp_d)
+        
+        
     def convolution_ContinuousSignal_basisfunctions(self, I, dt):
 
         """
@@ -123,33 +144,12 @@ class Filter_Exps(Filter) :
         
         # Matrix in which the result is stored
         # ie, spike train filtered with different basis functions
-        X  = np.zeros((p_T,R))
+        X  = np.zeros(p_T*R)                            # X(t,r) is stored in X[t*R+r]
         X  = X.astype("double")
 
-      
-        code =  """
-                #include <math.h>
-                
-                int   T_ind      = int(p_T);                
-                float dt         = float(p_dt); 
-
-
-                // CONVOLUTION
-                
-                for (int t=0; t<T_ind-1; t++) {
-       
-                    for (int r=0; r<R; r++) 
-                        X(t+1,r) = (1.0- dt/p_taus(r))*X(t,r) + I(t)*dt;
-                                          
-                }
-                
-                """
+        kernel_Filter_Exps_convolution_ContinuousSignal.run(locals())
  
-        vars = [ 'p_T', 'p_dt', 'I', 'p_taus', 'X', 'R'] 
-        
-        v = weave.inline(code, vars, type_converters=converters.blitz)
- 
-        return X
+        return X.reshape((p_T, R))
         
         
     def convolution_Spiketrain_basisfunctions(self, spks, T, dt):
@@ -185,19 +185,88 @@ class Filter_Exps(Filter) :
         
         # Matrix in which the result is stored
         # ie, spike train filtered with different basis functions
-        X  = np.zeros((p_T,R))
+        X  = np.zeros(p_T*R)                            # X(t,r) is stored in X[t*R+r]
         X  = X.astype("double")
 
+        kernel_Filter_Exps_convolution_Spiketrain.run(locals())
+
       
-        code =  """
-                #include <math.h>
+        return X.reshape((p_T, R))
+
+
+########################################################################################################
+# KERNELS (see Kernel)
+########################################################################################################
+
+def Filter_Exps_convolution_ContinuousSignal_ref(p_T, p_dt, I, p_taus, X, R):
+    
+    for t in range(p_T-1) :
+        for r in range(R) :
+            X[(t+1)*R + r] = (1.0 - p_dt/p_taus[r])*X[t*R + r] + I[t]*p_dt
+
+
+kernel_Filter_Exps_convolution_ContinuousSignal = Kernel('Filter_Exps_convolution_ContinuousSignal',
+        [ 
+          'int p_T', 'double p_dt', 'double* I', 'double* p_taus', 'double* X', 'int R' 
+        ],
+        """
+                
+                int   T_ind      = int(p_T);                
+                float dt         = float(p_dt); 
+
+
+                // CONVOLUTION
+                
+                for (int t=0; t<T_ind-1; t++) {
+       
+                    for (int r=0; r<R; r++) 
+                        X[(t+1)*R+r] = (1.0- dt/p_taus[r])*X[t*R+r] + I[t]*dt;
+                                          
+                }
+                
+                """,
+        Filter_Exps_convolution_ContinuousSignal_ref)
+
+
+def Filter_Exps_convolution_Spiketrain_ref(p_T, p_dt, p_spks_L, p_spks_i, p_taus, X, R):
+    
+    spks_cnt   = 0
+    next_spike = -1
+    if p_spks_L > 0 :
+        next_spike = int(p_spks_i[0])
+        
+    for t in range(p_T-1) :
+        
+        for r in range(R) :
+            X[(t+1)*R + r] = (1.0 - p_dt/p_taus[r])*X[t*R + r]            # everybody decay
+            
+        if t == next_spike-1 :
+            
+            for r in range(R) :
+                X[(t+1)*R + r] += 1.0                                   # everybody decay and jump
+                
+            spks_cnt  += 1
+            next_spike = -1
+            if spks_cnt < p_spks_L :
+                next_spike = int(p_spks_i[spks_cnt])
+
+
+kernel_Filter_Exps_convolution_Spiketrain = Kernel('Filter_Exps_convolution_Spiketrain',
+        [ 
+          'int p_T', 'double p_dt', 'int p_spks_L', 'double* p_spks_i', 'double* p_taus', 'double* X',
+          'int R' 
+        ],
+        """
                 
                 int   T_ind      = int(p_T);                
                 float dt         = float(p_dt); 
                 
                 int spks_L     = int(p_spks_L);  
                 int spks_cnt   = 0;
-                int next_spike = int(p_spks_i(0));
+                int next_spike = -1;
+                
+                if (spks_L > 0)
+                    next_spike = int(p_spks_i[0]);
 
 
                 // CONVOLUTION
@@ -207,27 +276,24 @@ class Filter_Exps(Filter) :
 
         
                     for (int r=0; r<R; r++) 
-                        X(t+1,r) = (1.0- dt/p_taus(r))*X(t,r);        // everybody decay
+                        X[(t+1)*R+r] = (1.0- dt/p_taus[r])*X[t*R+r];        // everybody decay
       
                     
                     if (t == next_spike-1) {
                     
                         for (int r=0; r<R; r++) { 
-                            X(t+1,r) += 1.0;                          // everybody decay and jump
+                            X[(t+1)*R+r] += 1.0;                          // everybody decay and jump
                         } 
                         
                         spks_cnt += 1;
-                        next_spike = int(p_spks_i(spks_cnt));
+                        next_spike = -1;
+                        
+                        if (spks_cnt < spks_L)
+                            next_spike = int(p_spks_i[spks_cnt]);
                     }
                                     
                 }
                 
-                """
- 
-        vars = [ 'p_T', 'p_dt', 'p_spks_L', 'p_spks_i', 'p_taus', 'X', 'R'] 
-        
-        v = weave.inline(code, vars, type_converters=converters.blitz)
-
-      
-        return X
+                """,
+        Filter_Exps_convolution_Spiketrain_ref)
 
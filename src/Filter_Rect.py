@@ -59,6 +59,7 @@ class Filter_Rect(Filter) :
         
         self.computeBins() 
         self.filter_coeff = f(self.support)
+        self.setModified()
  
               
     def computeInterpolatedFilter(self, dt) :
@@ -67,7 +68,7 @@ class Filter_Rect(Filter) :
         Given a particular dt, the function compute the interpolated filter as well as its temporal support vector.
         """
                 
-        self.computeBins()
+        self.updateBins()
         
         bins_i = Tools.timeToIndex(self.bins, dt)
         
@@ -105,6 +106,19 @@ class Filter_Rect(Filter) :
         self.support = np.array( [ (self.bins[i]+self.bins[i+1])/2 for i in range(len(self.bins)-1) ])
 
 
+    def updateBins(self):
+        
+        """
+        Compute the bins (see computeBins) only if the filter was modified (see Filter.setModified) since they were last computed.
+        """
+        
+        if getattr(self, 'bins_version', None) != self.getVersion() :
+            
+            self.computeBins()
+            
+            self.bins_version = self.getVersion()
+
+
     @abc.abstractmethod    
     def computeBins(self) :
         
@@ -2,16 +2,24 @@ import matplotlib.pyplot as plt
 from matplotlib import rcParams
 import numpy as np
 
-from scipy import weave
 from numpy.linalg import inv
 
 from ThresholdModel import *
 from Filter_Rect_LogSpaced import *
 
 from Tools import reprint
+from PoissonGLM import PoissonGLM
+from Tools import process_new, process_reset, process_advance, process_spike, philox_uniform, sampler_reset, sample_spike
+from Kernel import *
 from numpy import nan, NaN
 
 import math
+import hashlib
+import weakref
+
+
+# Results of GIF.simulateDeterministic_forceSpikes_trace (trace -> list of (key, result), see getForceSpikesKey)
+forceSpikes_cache = weakref.WeakKeyDictionary()
 
 
 class GIF(ThresholdModel) :
@@ -34,9 +42,15 @@ class GIF(ThresholdModel) :
     and \hat t_j denote the spike times.
     """
 
+    forceSpikes_cache_size = 4          # number of results cached per trace by simulateDeterministic_forceSpikes_trace
+
     def __init__(self, dt=0.1):
                    
         self.dt = dt                    # dt used in simulations (eta and gamma are interpolated according to this value)
+
+        self.integrator = 'Euler'       # numerical scheme used to integrate the membrane potential in simulations (see setIntegrator)
+        self.sampling   = 'Bernoulli'   # method used to draw spikes from the firing intensity in simulations (see setSampling)
+        self.forceSpikes_engine = 'loop'    # implementation of simulateDeterministic_forceSpikes (see setForceSpikesEngine)
   
         # Define model parameters
         
@@ -87,6 +101,137 @@ class GIF(ThresholdModel) :
         
         self.dt = dt
 
+
+    def setIntegrator(self, integrator):
+
+        """
+        Define the numerical scheme used to integrate the membrane potential in simulations (simulate and
+        simulateDeterministic_forceSpikes):
+        - 'Euler' : forward Euler (default), V(t+dt) = V(t) + dt/C*( -gl*(V(t)-El) + I(t) - eta_sum(t) )
+        - 'exact' : exact solution of the membrane equation for I and eta_sum constant during each time step.
+                    The error does not depend on the ratio between dt and the membrane time constant C/gl, so that larger
+                    time steps (e.g. 0.5-1.0 ms) can be used to compute rate-level quantities (e.g. computeFIcurve).
+                    In conductance-based models (gGIF), the spike-triggered conductance is also assumed constant during each time step.
+        """
+
+        if integrator not in ['Euler', 'exact'] :
+            raise ValueError("Unknown integrator %s (must be 'Euler' or 'exact')." % (integrator))
+
+        self.integrator = integrator
+
+
+    def getIntegrator(self):
+
+        """
+        Return the numerical scheme used to integrate the membrane potential (see setIntegrator).
+        Models saved (see SpikingModel.save) before the integrator was selectable use forward Euler.
+        """
+
+        return getattr(self, 'integrator', 'Euler')
+
+
+    def setSampling(self, sampling):
+
+        """
+        Define how spikes are drawn from the firing intensity lambda(t) in simulations (see Tools.sampler_support_code):
+        - 'Bernoulli' : one uniform random number per time step, a spike is emitted with probability 1-exp(-lambda(t)*dt) (default)
+        - 'rescaling' : time-rescaling theorem, one exponential random number per spike. The hazard lambda(t)*dt is
+                        accumulated until it exceeds the exponential variate. The spike trains have the same statistics
+                        as with 'Bernoulli', but most of the random numbers are saved at low firing rates.
+        For the same seed, the two samplers produce different spike trains.
+        """
+
+        if sampling not in ['Bernoulli', 'rescaling'] :
+            raise ValueError("Unknown sampling %s (must be 'Bernoulli' or 'rescaling')." % (sampling))
+
+        self.sampling = sampling
+
+
+    def getSampling(self):
+
+        """
+        Return the method used to draw spikes in simulations (see setSampling).
+        Models saved (see SpikingModel.save) before the sampling was selectable use 'Bernoulli'.
+        """
+
+        return getattr(self, 'sampling', 'Bernoulli')
+
+
+    def setForceSpikesEngine(self, engine):
+
+        """
+        Define how simulateDeterministic_forceSpikes (used to fit the threshold) integrates the membrane potential:
+        - 'loop'   : time step by time step in a kernel (default, see Kernel)
+        - 'linear' : vectorized with NumPy. Between two forced spikes the dynamics is linear, so that V is obtained with
+                     IIR filters (scipy.signal.lfilter) and the adaptation current with one FFT convolution of the spike train
+                     (see Tools.solveLinearRecurrence_withResets and Tools.filterSpikeTrain). This engine does not need a
+                     compiled kernel backend. Its results equal those of the loop up to rounding errors.
+        """
+
+        if engine not in ['loop', 'linear'] :
+            raise ValueError("Unknown engine %s (must be 'loop' or 'linear')." % (engine))
+
+        self.forceSpikes_engine = engine
+
+
+    def getForceSpikesEngine(self):
+
+        """
+        Return the implementation of simulateDeterministic_forceSpikes (see setForceSpikesEngine).
+        Models saved (see SpikingModel.save) before the engine was selectable use 'loop'.
+        """
+
+        return getattr(self, 'forceSpikes_engine', 'loop')
+
+
+    def setLikelihoodMethod(self, method):
+
+        """
+        Define the method used to maximize the likelihood when fitting the threshold (see PoissonGLM):
+        - 'Newton' : Newton method with backtracking line search (default)
+        - 'L-BFGS' : limited-memory BFGS preconditioned with the Hessian at the initial condition, which is computed only once
+                     (faster for filters with many basis functions). Its stopping criterion is not comparable to the Newton one.
+        """
+
+        if method not in ['Newton', 'L-BFGS'] :
+            raise ValueError("Unknown method %s (must be 'Newton' or 'L-BFGS')." % (method))
+
+        self.likelihood_method = method
+
+
+    def getLikelihoodMethod(self):
+
+        """
+        Return the method used to maximize the likelihood (see setLikelihoodMethod).
+        Models saved (see SpikingModel.save) before the method was selectable use 'Newton'.
+        """
+
+        return getattr(self, 'likelihood_method', 'Newton')
+
+
+    def setLikelihoodPrecision(self, dtype):
+
+        """
+        Define the precision in which the matrices X used to maximize the likelihood are stored (see PoissonGLM):
+        - 'double'  : double precision (default)
+        - 'float32' : single precision, halves the memory used to fit the threshold on long recordings.
+                      The likelihood and its derivatives are still accumulated in double precision.
+        """
+
+        if dtype not in ['double', 'float32'] :
+            raise ValueError("Unknown precision %s (must be 'double' or 'float32')." % (dtype))
+
+        self.likelihood_dtype = dtype
+
+
+    def getLikelihoodPrecision(self):
+
+        """
+        Return the precision in which the matrices X used to maximize the likelihood are stored (see setLikelihoodPrecision).
+        """
+
+        return getattr(self, 'likelihood_dtype', 'double')
+
     
     ########################################################################################################
     # IMPLEMENT ABSTRACT METHODS OF Spiking model
@@ -102,11 +247,27 @@ class GIF(ThresholdModel) :
         """
         self.setDt(dt)
     
-        (time, V, eta_sum, V_T, spks_times) = self.simulate(I, self.El)
+        spks_times = self.simulate(I, self.El, output='spikes')
         
         return spks_times
 
 
+    def simulateSpikingResponse_batch(self, I, dt, nb_rep, seed=None, rep0=0):
+        
+        """
+        Simulate nb_rep times the spiking response of the GIF model to the same input current I (nA) with time step dt.
+        All the repetitions are simulated in a single call to the C kernel (see simulate_batch, which also describes seed and rep0).
+        Return a list of nb_rep arrays, each containing the spike times (in ms) of one repetition.
+        The initial conditions for each repetition is V(0)=El.
+        """
+        
+        self.setDt(dt)
+        
+        (all_spks_times, V, eta_sum, V_T) = self.simulate_batch(I, self.El, nb_rep, seed=seed, rep0=rep0)
+        
+        return all_spks_times
+
+
     ########################################################################################################
     # IMPLEMENT ABSTRACT METHODS OF Threshold Model
     ########################################################################################################
@@ -121,11 +282,20 @@ class GIF(ThresholdModel) :
         return (spks_times, V, V_T)
 
 
+    def simulateVoltageResponse_atSpikes(self, I, dt) :
+
+        self.setDt(dt)
+    
+        (spks_times, V_spks, V_T_spks) = self.simulate(I, self.El, output='V_at_spikes')
+        
+        return (spks_times, V_spks, V_T_spks)
+
+
     ########################################################################################################
     # METHODS FOR NUMERICAL SIMULATIONS
     ########################################################################################################  
       
-    def simulate(self, I, V0):
+    def simulate(self, I, V0, output='traces', decimation=1):
  
         """
         Simulate the spiking response of the GIF model to an input current I (nA) with time step dt.
@@ -136,11 +306,53 @@ class GIF(ThresholdModel) :
         - eta_sum  : nA, adaptation current
         - V_T      : mV, firing threshold
         - spks     : ms, list of spike times 
+        
+        Use output and decimation to record only part of the response (see Simulator):
+        - output='traces', decimation=k : same as above, but the traces are sampled every k time steps
+        - output='V_at_spikes'          : returns (spks, V_spks, V_T_spks), the spike times and the values of V and V_T at the spike times
+        - output='spikes'               : returns spks
+        In these cases, the input is simulated in chunks and the full traces are never stored.
+        """
+        
+        if output != 'traces' or decimation != 1 :
+            
+            from Simulator import Simulator
+            
+            return Simulator(self, V0=V0, output=output, decimation=decimation).run(I)
+        
+        (all_spks_times, V, eta_sum, V_T) = self.simulate_batch(I, V0, 1)
+        
+        time = np.arange(len(V))*self.dt
+        
+        return (time, V, eta_sum, V_T, all_spks_times[0])
+
+
+    def simulate_batch(self, I, V0, nb_rep, seed=None, rep0=0):
+ 
+        """
+        Simulate nb_rep independent repetitions of the spiking response of the GIF model to an input current I (nA) with time step dt.
+        V0 indicate the initial condition V(0)=V0 (used in all repetitions).
+        
+        The interpolated filters eta and gamma are computed only once and all the repetitions are performed in a single 
+        call to the C kernel. The arrays V, eta_sum and gamma_sum are reused by all the repetitions (memory does not 
+        scale with nb_rep).
+        
+        The random numbers used by the k-th repetition only depend on seed and on rep0+k (see Tools.philox_support_code),
+        so that simulating the repetitions in several calls (e.g., in parallel) with increasing rep0 gives the same result
+        as a single call. If seed is None, a seed is drawn from numpy.random.
+        
+        The function returns:
+        - all_spks : list of nb_rep arrays of spike times (ms), one for each repetition
+        - V        : mV, membrane potential (last repetition)
+        - eta_sum  : nA, adaptation current (last repetition)
+        - V_T      : mV, firing threshold (last repetition)
         """
  
         # Input parameters
         p_T         = len(I)
         p_dt        = self.dt
+        p_exact     = int(self.getIntegrator() == 'exact')
+        p_rescaling = int(self.getSampling() == 'rescaling')
         
         # Model parameters
         p_gl        = self.gl
@@ -151,101 +363,60 @@ class GIF(ThresholdModel) :
         p_Vt_star   = self.Vt_star
         p_DV        = self.DV
         p_lambda0   = self.lambda0
+        p_V0        = V0
         
-        # Model kernels   
-        (p_eta_support, p_eta) = self.eta.getInterpolatedFilter(self.dt)   
-        p_eta       = p_eta.astype('double')
+        # Random number generator (see Tools.philox_support_code)
+        if seed == None :
+            seed = Tools.getRandomSeed()
+        p_seed      = seed
+        
+        # Model kernels (see Filter.getSpikeUpdate)
+        (p_eta, p_eta_chg, p_eta_b, p_eta_d) = self.eta.getSpikeUpdate(self.dt)
         p_eta_l     = len(p_eta)
+        p_eta_chg_l = len(p_eta_chg)
+        p_eta_R     = len(p_eta_b)
 
-        (p_gamma_support, p_gamma) = self.gamma.getInterpolatedFilter(self.dt)   
-        p_gamma     = p_gamma.astype('double')
+        (p_gamma, p_gamma_chg, p_gamma_b, p_gamma_d) = self.gamma.getSpikeUpdate(self.dt)
         p_gamma_l   = len(p_gamma)
+        p_gamma_chg_l = len(p_gamma_chg)
+        p_gamma_R   = len(p_gamma_b)
       
-        # Define arrays
+        # Define arrays (shared by all the repetitions)
         V = np.array(np.zeros(p_T), dtype="double")
         I = np.array(I, dtype="double")
-        spks = np.array(np.zeros(p_T), dtype="double")                      
-        eta_sum = np.array(np.zeros(p_T + 2*p_eta_l), dtype="double")
-        gamma_sum = np.array(np.zeros(p_T + 2*p_gamma_l), dtype="double")            
  
-        # Set initial condition
-        V[0] = V0
+        # Spike indices of each repetition are stored in a flat array (at most p_spks_max spikes per repetition)
+        p_spks_max  = Tools.getMaxSpikeNb(p_T, p_Tref, p_dt)
+        nb_rep_call = Tools.getRepetitionsPerCall(nb_rep, p_spks_max)
+        
+        # Spike-triggered processes (see Tools.adaptation_support_code)
+        eta_sum    = np.array(np.zeros(p_T), dtype="double")
+        eta_evt    = np.array(np.zeros(p_T), dtype="int32")
+        eta_starts = np.array(np.zeros(p_spks_max), dtype="int32")
+        eta_exp    = np.array(np.zeros(p_eta_R), dtype="double")
+        
+        gamma_sum    = np.array(np.zeros(p_T), dtype="double")
+        gamma_evt    = np.array(np.zeros(p_T), dtype="int32")
+        gamma_starts = np.array(np.zeros(p_spks_max), dtype="int32")
+        gamma_exp    = np.array(np.zeros(p_gamma_R), dtype="double")
          
-        code =  """
-                #include <math.h>
-                
-                int   T_ind      = int(p_T);                
-                float dt         = float(p_dt); 
-                
-                float gl         = float(p_gl);
-                float C          = float(p_C);
-                float El         = float(p_El);
-                float Vr         = float(p_Vr);
-                int   Tref_ind   = int(float(p_Tref)/dt);
-                float Vt_star    = float(p_Vt_star);
-                float DeltaV     = float(p_DV);
-                float lambda0    = float(p_lambda0);
-           
-                int eta_l        = int(p_eta_l);
-                int gamma_l      = int(p_gamma_l);
-                
-                                                  
-                float rand_max  = float(RAND_MAX); 
-                float p_dontspike = 0.0 ;
-                float lambda = 0.0 ;            
-                float r = 0.0;
-                
-                                                
-                for (int t=0; t<T_ind-1; t++) {
-    
-    
-                    // INTEGRATE VOLTAGE
-                    V[t+1] = V[t] + dt/C*( -gl*(V[t] - El) + I[t] - eta_sum[t] );
-               
-               
-                    // COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
-                    lambda = lambda0*exp( (V[t+1]-Vt_star-gamma_sum[t])/DeltaV );
-                    p_dontspike = exp(-lambda*(dt/1000.0));                                  // since lambda0 is in Hz, dt must also be in Hz (this is why dt/1000.0)
-                          
-                          
-                    // PRODUCE SPIKE STOCHASTICALLY
-                    r = rand()/rand_max;
-                    if (r > p_dontspike) {
-                                        
-                        if (t+1 < T_ind-1)                
-                            spks[t+1] = 1.0; 
-                        
-                        t = t + Tref_ind;    
-                        
-                        if (t+1 < T_ind-1) 
-                            V[t+1] = Vr;
-                        
-                        
-                        // UPDATE ADAPTATION PROCESSES     
-                        for(int j=0; j<eta_l; j++) 
-                            eta_sum[t+1+j] += p_eta[j]; 
-                        
-                        for(int j=0; j<gamma_l; j++) 
-                            gamma_sum[t+1+j] += p_gamma[j] ;  
-                        
-                    }
-               
-                }
-                
-                """
- 
-        vars = [ 'p_T','p_dt','p_gl','p_C','p_El','p_Vr','p_Tref','p_Vt_star','p_DV','p_lambda0','V','I','p_eta','p_eta_l','eta_sum','p_gamma','gamma_sum','p_gamma_l','spks' ]
         
-        v = weave.inline(code, vars)
-
-        time = np.arange(p_T)*self.dt
+        all_spks = []
         
-        eta_sum   = eta_sum[:p_T]     
-        V_T = gamma_sum[:p_T] + p_Vt_star
-     
-        spks = (np.where(spks==1)[0])*self.dt
+        for rep_start in np.arange(0, nb_rep, nb_rep_call) :
+            
+            p_nb_rep = int(min(nb_rep_call, nb_rep - rep_start))
+            p_rep0   = int(rep0 + rep_start)
+            spks_i   = np.array(np.zeros(p_nb_rep*p_spks_max), dtype="int32")
+            spks_nb  = np.array(np.zeros(p_nb_rep), dtype="int32")
+        
+            kernel_GIF_simulate.run(locals())
+            
+            all_spks.extend( Tools.splitSpikeIndices(spks_i, spks_nb, p_spks_max, self.dt) )
+        
+        V_T = gamma_sum + p_Vt_star
     
-        return (time, V, eta_sum, V_T, spks)
+        return (all_spks, V, eta_sum, V_T)
 
         
     def simulateDeterministic_forceSpikes(self, I, V0, spks):
@@ -266,6 +437,7 @@ class GIF(ThresholdModel) :
         # Input parameters
         p_T          = len(I)
         p_dt         = self.dt
+        p_exact      = int(self.getIntegrator() == 'exact')
           
           
         # Model parameters
@@ -287,66 +459,126 @@ class GIF(ThresholdModel) :
         V        = np.array(np.zeros(p_T), dtype="double")
         I        = np.array(I, dtype="double")
         spks     = np.array(spks, dtype="double")                      
-        spks_i   = Tools.timeToIndex(spks, self.dt)
+        spks_i   = Tools.timeToIndex(spks, self.dt).astype("int32")
+        p_spks_L = len(spks_i)
 
 
         # Compute adaptation current (sum of eta triggered at spike times in spks) 
-        eta_sum  = np.array(np.zeros(p_T + 1.1*p_eta_l + p_Tref_i), dtype="double")   
-        
-        for s in spks_i :
-            eta_sum[s + 1 + p_Tref_i  : s + 1 + p_Tref_i + p_eta_l] += p_eta
+        if self.getForceSpikesEngine() == 'linear' :
+            
+            eta_sum = Tools.filterSpikeTrain(spks_i + 1 + p_Tref_i, p_eta, p_T)
+            
+        else :
         
-        eta_sum  = eta_sum[:p_T]  
+            eta_sum  = np.array(np.zeros(p_T + int(1.1*p_eta_l) + p_Tref_i), dtype="double")   
+            
+            for s in spks_i :
+                eta_sum[s + 1 + p_Tref_i  : s + 1 + p_Tref_i + p_eta_l] += p_eta
+            
+            eta_sum  = eta_sum[:p_T]  
    
    
         # Set initial condition
         V[0] = V0
         
-    
-        code = """ 
-                #include <math.h>
-                
-                int   T_ind      = int(p_T);                
-                float dt         = float(p_dt); 
-                
-                float gl         = float(p_gl);
-                float C          = float(p_C);
-                float El         = float(p_El);
-                float Vr         = float(p_Vr);
-                int   Tref_ind   = int(float(p_Tref)/dt);
+        if self.getForceSpikesEngine() == 'linear' :
+            V = self.simulateDeterministic_forceSpikes_linear(I, V0, spks_i, eta_sum)
+        else :
+            kernel_GIF_forceSpikes.run(locals())
 
+        time = np.arange(p_T)*self.dt
+        eta_sum = eta_sum[:p_T]     
 
-                int next_spike = spks_i[0] + Tref_ind;
-                int spks_cnt = 0;
- 
-                                                                       
-                for (int t=0; t<T_ind-1; t++) {
+        return (time, V, eta_sum)
+
+
+    def simulateDeterministic_forceSpikes_trace(self, tr):
+        
+        """
+        Same as simulateDeterministic_forceSpikes(tr.I, tr.V[0], tr.getSpikeTimes()), but the result is cached for the trace tr.
+        
+        The fit stages that follow fitSubthresholdDynamics (fitStaticThreshold, fitThresholdDynamics, ...) all simulate the
+        subthreshold dynamics on the same traces with the same parameters. The results are stored in forceSpikes_cache
+        (which does not keep the traces alive) and are reused as long as getForceSpikesKey, which depends on the subthreshold
+        parameters, the filter eta and the input current and spike times of tr, does not change. The last forceSpikes_cache_size
+        results are kept for each trace. The arrays returned are shared by all the callers and are therefore read-only.
+        """
+        
+        key     = self.getForceSpikesKey(tr)
+        entries = forceSpikes_cache.setdefault(tr, [])
+        
+        for (key_tmp, result) in entries :
+            if key_tmp == key :
+                return result
+            
+        result = self.simulateDeterministic_forceSpikes(tr.I, tr.V[0], tr.getSpikeTimes())
+        
+        for a in result :
+            a.flags.writeable = False
+            
+        entries.append( (key, result) )
+        del entries[:-self.forceSpikes_cache_size]
+        
+        return result
     
     
-                    // INTEGRATE VOLTAGE
-                    V[t+1] = V[t] + dt/C*( -gl*(V[t] - El) + I[t] - eta_sum[t] );
-               
-               
-                    if ( t == next_spike ) {
-                        spks_cnt = spks_cnt + 1;
-                        next_spike = spks_i[spks_cnt] + Tref_ind;
-                        V[t-1] = 0 ;                  
-                        V[t] = Vr ;
-                        t=t-1;           
-                    }
-               
-                }
+    def getForceSpikesKey(self, tr):
         
-                """
- 
-        vars = [ 'p_T','p_dt','p_gl','p_C','p_El','p_Vr','p_Tref','V','I','eta_sum','spks_i' ]
+        """
+        Return the key under which the result of simulateDeterministic_forceSpikes_trace is cached for the trace tr.
+        """
         
-        v = weave.inline(code, vars)
-
-        time = np.arange(p_T)*self.dt
-        eta_sum = eta_sum[:p_T]     
-
-        return (time, V, eta_sum)
+        (support, eta) = self.eta.getInterpolatedFilter(self.dt)
+        
+        h = hashlib.md5()
+        h.update(np.ascontiguousarray(eta, dtype='double').tostring())
+        h.update(np.ascontiguousarray(tr.I, dtype='double').tostring())
+        h.update(np.ascontiguousarray(tr.getSpikeTimes(), dtype='double').tostring())
+        
+        return (type(self).simulateDeterministic_forceSpikes.__func__, self.dt, self.getIntegrator(), self.getForceSpikesEngine(),
+                self.gl, self.C, self.El, self.Vr, self.Tref, float(tr.V[0]), len(tr.I), h.hexdigest())
+    
+           
+    def getForceSpikesResets(self, spks_i, T):
+        
+        """
+        Return the time indices at which V is reset to Vr in kernel_GIF_forceSpikes (the end of the refractory 
+        period following each spike of spks_i that the kernel processes).
+        """
+        
+        Tref_ind = int(np.float32(self.Tref)/np.float32(self.dt))
+        
+        resets = np.array(spks_i, dtype='int') + Tref_ind
+        
+        # the kernel processes the spikes in the order of spks_i and stops at the first one that is not reached
+        reached = np.logical_and.accumulate( np.concatenate(([True], np.diff(resets) >= 0)) & (resets < T-1) )
+        
+        return resets[reached]
+        
+        
+    def simulateDeterministic_forceSpikes_linear(self, I, V0, spks_i, eta_sum):
+        
+        """
+        Vectorized equivalent of kernel_GIF_forceSpikes (see setForceSpikesEngine). Between two resets, 
+        V(t+1) = a*V(t) + dtC*(gl*El + I(t) - eta_sum(t)) with a = 1 - dtC*gl.
+        Return V.
+        """
+        
+        dtC = self.dt/self.C
+        if self.getIntegrator() == 'exact' :
+            dtC = -np.expm1(-self.dt*self.gl/self.C)/self.gl
+        
+        resets = self.getForceSpikesResets(spks_i, len(I))
+        
+        a = 1.0 - dtC*self.gl
+        u = dtC*( self.gl*self.El + I[:-1] - eta_sum[:-1] )
+        
+        V = Tools.solveLinearRecurrence_withResets(a, u, V0, resets, self.Vr)
+        
+        # as in the kernel, V is set to 0 one time step before each reset
+        V[resets-1] = 0.0
+        
+        return V
 
            
     ########################################################################################################
@@ -375,6 +607,16 @@ class GIF(ThresholdModel) :
         
         self.fitStaticThreshold(experiment)
 
+        self.fitSpecificStages(experiment)
+
+
+    def fitSpecificStages(self, experiment):
+
+        """
+        Fit the parameters that are specific to the GIF model (i.e., the threshold dynamics). This is the last step of fit,
+        which assumes that fitVoltageReset, fitSubthresholdDynamics and fitStaticThreshold have been performed (see ModelFamily).
+        """
+
         self.fitThresholdDynamics(experiment)
 
 
@@ -434,13 +676,14 @@ class GIF(ThresholdModel) :
     ########################################################################################################
 
 
-    def fitSubthresholdDynamics(self, experiment, DT_beforeSpike=5.0):
+    def fitSubthresholdDynamics(self, experiment, DT_beforeSpike=5.0, chunk_size=100000):
           
         """
         Implement Step 2 of the fitting procedure introduced in Pozzorini et al. PLOS Comb. Biol. 2015
         The voltage reset is estimated by computing the spike-triggered average of the voltage.
         experiment: Experiment object on which the model is fitted.
         DT_beforeSpike: in ms, data right before spikes are excluded from the fit. This parameter can be used to define that time interval.
+        chunk_size: number of time steps of a trace processed at once when building the linear regression (bounds the memory used by the fit).
         """  
                   
         print "\nGIF MODEL - Fit subthreshold dynamics..." 
@@ -449,49 +692,17 @@ class GIF(ThresholdModel) :
         self.dt = experiment.dt
         
         
-        # Build X matrix and Y vector to perform linear regression (use all traces in training set)    
-        # For each training set an X matrix and a Y vector is built.   
-        ####################################################################################################
-        X = []
-        Y = []
-    
-        cnt = 0
-        
-        for tr in experiment.trainingset_traces :
-        
-            if tr.useTrace :
-        
-                cnt += 1
-                reprint( "Compute X matrix for repetition %d" % (cnt) )          
-                
-                # Compute the the X matrix and Y=\dot_V_data vector used to perform the multilinear linear regression (see Eq. 17.18 in Pozzorini et al. PLOS Comp. Biol. 2015)
-                (X_tmp, Y_tmp) = self.fitSubthresholdDynamics_Build_Xmatrix_Yvector(tr, DT_beforeSpike=DT_beforeSpike)
-     
-                X.append(X_tmp)
-                Y.append(Y_tmp)
-    
-    
-        # Concatenate matrixes associated with different traces to perform a single multilinear regression
+        # Accumulate the normal equations of the linear regression (use all traces in training set).
+        # X^T X, X^T Y and Y^T Y are accumulated trace by trace and chunk by chunk (X is never stored).
         ####################################################################################################
-        if cnt == 1:
-            X = X[0]
-            Y = Y[0]
-            
-        elif cnt > 1:
-            X = np.concatenate(X, axis=0)
-            Y = np.concatenate(Y, axis=0)
-        
-        else :
-            print "\nError, at least one training set trace should be selected to perform fit."
+        (XTX, XTY, YTY, Y_sum, Y_nb) = self.fitSubthresholdDynamics_NormalEquations(experiment, DT_beforeSpike=DT_beforeSpike, chunk_size=chunk_size)
         
         
         # Perform linear Regression defined in Eq. 17 of Pozzorini et al. PLOS Comp. Biol. 2015
         ####################################################################################################
         
         print "\nPerform linear regression..."
-        XTX     = np.dot(np.transpose(X), X)
         XTX_inv = inv(XTX)
-        XTY     = np.dot(np.transpose(X), Y)
         b       = np.dot(XTX_inv, XTY)
         b       = b.flatten()
    
@@ -511,7 +722,7 @@ class GIF(ThresholdModel) :
         # Compute percentage of variance explained on dV/dt
         ####################################################################################################
 
-        var_explained_dV = 1.0 - np.mean((Y - np.dot(X,b))**2)/np.var(Y)
+        var_explained_dV = self.fitSubthresholdDynamics_VarianceExplained(b, XTX, XTY, YTY, Y_sum, Y_nb)
         print "Percentage of variance explained (on dV/dt): %0.2f" % (var_explained_dV*100.0)
 
         
@@ -526,7 +737,7 @@ class GIF(ThresholdModel) :
             if tr.useTrace :
 
                 # Simulate subthreshold dynamics 
-                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes(tr.I, tr.V[0], tr.getSpikeTimes())
+                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes_trace(tr)
                 
                 indices_tmp = tr.getROI_FarFromSpikes(0.0, self.Tref)
                 
@@ -576,6 +787,121 @@ class GIF(ThresholdModel) :
         Y = np.array( np.concatenate( (np.diff(trace.V)/trace.dt, [0]) ) )[selection]      
 
         return (X, Y)
+
+
+    def fitSubthresholdDynamics_NormalEquations(self, experiment, DT_beforeSpike=5.0, chunk_size=100000):
+
+        """
+        Accumulate the normal equations of the linear regression defined in Eq. 17-18 of Pozzorini et al. 2015
+        over all the traces of the training set, using the chunks returned by fitSubthresholdDynamics_Build_Xmatrix_Yvector_Chunks.
+        Return (XTX, XTY, YTY, Y_sum, Y_nb), where Y_sum and Y_nb are the sum and the number of elements of Y.
+        The memory used does not depend on the length of the recordings.
+        """
+
+        XTX   = 0.0
+        XTY   = 0.0
+        YTY   = 0.0
+        Y_sum = 0.0
+        Y_nb  = 0
+
+        cnt = 0
+
+        for tr in experiment.trainingset_traces :
+
+            if tr.useTrace :
+
+                cnt += 1
+                reprint( "Compute X matrix for repetition %d" % (cnt) )
+
+                for (X_tmp, Y_tmp) in self.fitSubthresholdDynamics_Build_Xmatrix_Yvector_Chunks(tr, DT_beforeSpike=DT_beforeSpike, chunk_size=chunk_size) :
+
+                    XTX   = XTX + np.dot(np.transpose(X_tmp), X_tmp)
+                    XTY   = XTY + np.dot(np.transpose(X_tmp), Y_tmp)
+                    YTY  += np.dot(Y_tmp, Y_tmp)
+                    Y_sum += np.sum(Y_tmp)
+                    Y_nb  += len(Y_tmp)
+
+        if cnt == 0 :
+            print "\nError, at least one training set trace should be selected to perform fit."
+
+        return (XTX, XTY, YTY, Y_sum, Y_nb)
+
+
+    def fitSubthresholdDynamics_VarianceExplained(self, b, XTX, XTY, YTY, Y_sum, Y_nb):
+
+        """
+        Return the percentage of variance explained on dV/dt by the regression coefficients b,
+        computed from the accumulated normal equations (see fitSubthresholdDynamics_NormalEquations).
+        """
+
+        SSE = YTY - 2.0*np.dot(b, XTY) + np.dot(b, np.dot(XTX, b))     # sum of squared errors
+        VAR = YTY - Y_sum**2/Y_nb                                       # Y_nb times the variance of Y
+
+        return 1.0 - SSE/VAR
+
+
+    def fitSubthresholdDynamics_Build_Xmatrix_Yvector_Chunks(self, trace, DT_beforeSpike=5.0, chunk_size=100000):
+
+        """
+        Same as fitSubthresholdDynamics_Build_Xmatrix_Yvector, but iterate over the rows of X and Y
+        in chunks of at most chunk_size time steps of the trace.
+        """
+
+        for (selection, X_eta, Y) in self.fitSubthresholdDynamics_Iterate_Chunks(trace, DT_beforeSpike=DT_beforeSpike, chunk_size=chunk_size) :
+
+            selection_l = len(selection)
+
+            X = np.zeros( (selection_l, 3) )
+            X[:,0] = trace.V[selection]
+            X[:,1] = trace.I[selection]
+            X[:,2] = np.ones(selection_l)
+
+            X = np.concatenate( (X, X_eta), axis=1 )
+
+            yield (X, Y)
+
+
+    def fitSubthresholdDynamics_Iterate_Chunks(self, trace, DT_beforeSpike=5.0, chunk_size=100000):
+
+        """
+        Iterate over the time steps of the trace in chunks of at most chunk_size time steps.
+        For each chunk, yield (selection, X_eta, Y) where selection are the indices of the trace used in the linear regression,
+        X_eta the spike train filtered with the basis functions of eta and Y the voltage derivative (at the indices in selection).
+
+        The spike train is filtered on a window that starts one filter length (plus Tref) before the chunk, so that
+        X_eta is the same as in fitSubthresholdDynamics_Build_Xmatrix_Yvector (for filters of infinite duration,
+        such as Filter_Exps, the contributions of spikes older than the filter length are neglected).
+        """
+
+        T_ind    = len(trace.V)
+        margin_i = int(np.ceil((self.eta.getLength() + self.Tref)/trace.dt)) + 1
+
+        selection = trace.getROI_FarFromSpikes(DT_beforeSpike, self.Tref)
+        spks      = np.array(trace.spks, dtype='int')
+
+        for t0 in np.arange(0, T_ind, chunk_size) :
+
+            t1 = min(t0 + chunk_size, T_ind)
+
+            (i0, i1) = np.searchsorted(selection, [t0, t1])
+
+            if i1 == i0 :
+                continue
+
+            # Spike train filtered with the basis functions of eta on the window [origin, t1)
+            origin    = max(0, t0 - margin_i)
+            spks_tmp  = spks[ (spks >= origin) & (spks < t1) ] - origin
+            X_eta     = self.eta.convolution_Spiketrain_basisfunctions(spks_tmp*trace.dt + self.Tref, (t1 - origin + 0.5)*trace.dt, trace.dt)
+
+            # Voltage derivative (the last time step of the trace is set to 0)
+            Y = np.diff(trace.V[t0:t1+1])/trace.dt
+
+            if t1 == T_ind :
+                Y = np.concatenate( (Y, [0]) )
+
+            selection_tmp = selection[i0:i1]
+
+            yield (selection_tmp, X_eta[selection_tmp - origin,:], Y[selection_tmp - t0])
         
         
         
@@ -671,11 +997,6 @@ class GIF(ThresholdModel) :
           
       
     def maximizeLikelihood(self, experiment, beta0, buildXmatrix, maxIter=10**3, stopCond=10**-6) :
-    
-        ###
-        ### THIS IMPLEMENTATION IS NOT SO COOL :(
-        ### IN NEW VERSION OF THE CODE I SHOULD IMPLEMENT A NEW CLASS THAT TAKES CARE OF MAXLIKELIHOOD ON lambda=exp(Xbeta) model
-        ###
         
         """
         Maximize likelihood. This function can be used to fit any model of the form lambda=exp(Xbeta).
@@ -689,105 +1010,34 @@ class GIF(ThresholdModel) :
         # Precompute all the matrices used in the gradient ascent (see Eq. 20 in Pozzorini et al. 2015)
         ################################################################################################
         
-        # here X refer to the matrix made of y vectors defined in Eq. 21 (Pozzorini et al. 2015)
-        # since the fit can be perfomed on multiple traces, we need lists
-        all_X        = []           
-        
-        # similar to X but only contains temporal samples where experimental spikes have been observed 
-        # storing this matrix is useful to improve speed when computing the likelihood as well as its derivative
-        all_X_spikes = []
-        
-        # sum X_spikes over spikes. Precomputing this quantity improve speed when the gradient is evaluated
-        all_sum_X_spikes = []
-        
-        
-        # variables used to compute the loglikelihood of a Poisson process spiking at the experimental firing rate
-        T_tot = 0.0
-        N_spikes_tot = 0.0
-        
-        traces_nb = 0
+        glm = self.getPoissonGLM(maxIter=maxIter, stopCond=stopCond)
         
         for tr in experiment.trainingset_traces:
             
             if tr.useTrace :              
                 
-                traces_nb += 1
-                
                 # Simulate subthreshold dynamics 
-                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes(tr.I, tr.V[0], tr.getSpikeTimes())
+                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes_trace(tr)
                              
                 # Precomputes matrices to compute gradient ascent on log-likelihood
                 # depeinding on the model being fitted (static vs dynamic threshodl) different buildXmatrix functions can be used
-                (X_tmp, X_spikes_tmp, sum_X_spikes_tmp, N_spikes, T) = buildXmatrix(tr, V_est) 
-                    
-                T_tot        += T
-                N_spikes_tot += N_spikes
-                    
-                all_X.append(X_tmp)
-                all_X_spikes.append(X_spikes_tmp)
-                all_sum_X_spikes.append(sum_X_spikes_tmp)
+                glm.addTrace(*buildXmatrix(tr, V_est))
         
-        # Compute log-likelihood of a poisson process (this quantity is used to normalize the model log-likelihood)
-        ################################################################################################
-        
-        logL_poisson = N_spikes_tot*(np.log(N_spikes_tot/T_tot)-1)
-
 
         # Perform gradient ascent
         ################################################################################################
     
-        print "Maximize log-likelihood (bit/spks)..."
-                        
-        beta = beta0
-        old_L = 1
+        return glm.maximizeLikelihood(beta0)
 
-        for i in range(maxIter) :
-            
-            learning_rate = 1.0
-            
-            # In the first iterations using a small learning rate makes things somehow more stable
-            if i<=10 :                      
-                learning_rate = 0.1
-            
-            
-            L=0; G=0; H=0;  
-               
-            for trace_i in np.arange(traces_nb):
-                
-                # compute log-likelihood, gradient and hessian on a specific trace (note that the fit is performed on multiple traces)
-                (L_tmp,G_tmp,H_tmp) = self.computeLikelihoodGradientHessian(beta, all_X[trace_i], all_X_spikes[trace_i], all_sum_X_spikes[trace_i])
-                
-                # note that since differentiation is linear: gradient of sum = sum of gradient ; hessian of sum = sum of hessian
-                L+=L_tmp; 
-                G+=G_tmp; 
-                H+=H_tmp;
-            
-            
-            # Update optimal parametes (ie, implement Newton step) by tacking into account multiple traces
-            
-            beta = beta - learning_rate*np.dot(inv(H),G)
-                
-            if (i>0 and abs((L-old_L)/old_L) < stopCond) :              # If converged
-                print "\nConverged after %d iterations!\n" % (i+1)
-                break
-            
-            old_L = L
-            
-            # Compute normalized likelihood (for print)
-            # The likelihood is normalized with respect to a poisson process and units are in bit/spks
-            L_norm = (L-logL_poisson)/np.log(2)/N_spikes_tot
-            reprint(L_norm)
-            
-            if math.isnan(L_norm):
-                print "Problem during gradient ascent. Optimizatino stopped."
-                break
-    
-        if (i==maxIter - 1) :                                           # If too many iterations
-            
-            print "\nNot converged after %d iterations.\n" % (maxIter)
 
+    def getPoissonGLM(self, maxIter=10**3, stopCond=10**-6):
 
-        return beta
+        """
+        Return a PoissonGLM (without traces) used to fit the firing threshold by maximum likelihood.
+        """
+
+        return PoissonGLM(self.dt, lambda0=self.lambda0, method=self.getLikelihoodMethod(), maxIter=maxIter, stopCond=stopCond,
+                          dtype=self.getLikelihoodPrecision())
      
         
     def computeLikelihoodGradientHessian(self, beta, X, X_spikes, sum_X_spikes) : 
@@ -797,26 +1047,7 @@ class GIF(ThresholdModel) :
         log-likelihood has the same form as the one defined in Eq. 20 (Pozzorini et al. PLOS Comp. Biol. 2015)
         """
         
-        # IMPORTANT: in general we assume that the lambda_0 = 1 Hz
-        # The parameter lambda0 is redundant with Vt_star, so only one of those has to be fitted.
-        # We genearlly fix lambda_0 adn fit Vt_star
-              
-        dt = self.dt/1000.0     # put dt in units of seconds (to be consistent with lambda_0)
-        
-        X_spikesbeta    = np.dot(X_spikes,beta)
-        Xbeta           = np.dot(X,beta)
-        expXbeta        = np.exp(Xbeta)
-
-        # Compute loglikelihood defined in Eq. 20 Pozzorini et al. 2015
-        L = sum(X_spikesbeta) - self.lambda0*dt*sum(expXbeta)
-                                       
-        # Compute its gradient
-        G = sum_X_spikes - self.lambda0*dt*np.dot(np.transpose(X), expXbeta)
-        
-        # Compute its Hessian
-        H = -self.lambda0*dt*np.dot(np.transpose(X)*expXbeta, X)
-        
-        return (L,G,H)
+        return PoissonGLM.computeLikelihoodGradientHessian_trace(beta, X, X_spikes, sum_X_spikes, self.dt, self.lambda0)
 
 
     def buildXmatrix_staticThreshold(self, tr, V_est) :
@@ -1287,3 +1518,269 @@ class GIF(ThresholdModel) :
         plt.xlabel('DV (mV)')
         Tools.removeAxis(plt.gca(), ['top', 'left', 'right'])
         plt.yticks([])    
+
+
+########################################################################################################
+# KERNELS (see Kernel)
+########################################################################################################
+
+def GIF_simulate_ref(p_T, p_dt, p_exact, p_rescaling, p_gl, p_C, p_El, p_Vr, p_Tref, p_Vt_star, p_DV, p_lambda0, p_V0, V, I, 
+                     p_eta, p_eta_l, p_eta_chg, p_eta_chg_l, p_eta_b, p_eta_d, p_eta_R, eta_sum, eta_evt, eta_starts, eta_exp, 
+                     p_gamma, p_gamma_l, p_gamma_chg, p_gamma_chg_l, p_gamma_b, p_gamma_d, p_gamma_R, gamma_sum, gamma_evt, gamma_starts, gamma_exp, 
+                     p_nb_rep, p_seed, p_rep0, p_spks_max, spks_i, spks_nb):
+    
+    T_ind    = p_T
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    dtC = p_dt/p_C
+    if p_exact == 1 :
+        dtC = -np.expm1(-p_dt*p_gl/p_C)/p_gl
+    
+    eta_proc   = process_new(eta_sum, p_eta, p_eta_chg, eta_evt, eta_starts, p_eta_b, p_eta_d, eta_exp)
+    gamma_proc = process_new(gamma_sum, p_gamma, p_gamma_chg, gamma_evt, gamma_starts, p_gamma_b, p_gamma_d, gamma_exp)
+
+    sampler_i  = np.zeros(1, dtype=np.int32)
+    sampler_d  = np.zeros(2)
+    
+    for rep in range(p_nb_rep) :
+        
+        # RESET STATE VARIABLES
+        V[:] = 0.0
+        process_reset(eta_proc)
+        process_reset(gamma_proc)
+        sampler_reset(sampler_i, sampler_d)
+        
+        V[0] = p_V0
+        
+        spks_cnt = 0
+        
+        t = 0
+        while t < T_ind-1 :
+            
+            # COMPUTE ADAPTATION PROCESSES
+            process_advance(eta_proc, t+1)
+            process_advance(gamma_proc, t+1)
+            
+            # INTEGRATE VOLTAGE
+            V[t+1] = V[t] + dtC*( -p_gl*(V[t] - p_El) + I[t] - eta_sum[t] )
+            
+            # COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+            lambda_t    = p_lambda0*np.exp( (V[t+1]-p_Vt_star-gamma_sum[t])/p_DV )
+            
+            # PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+            if sample_spike(p_rescaling, p_seed, p_rep0 + rep, t, lambda_t, p_dt, sampler_i, sampler_d) :
+                
+                if t+1 < T_ind-1 and spks_cnt < p_spks_max :
+                    spks_i[rep*p_spks_max + spks_cnt] = t+1
+                    spks_cnt += 1
+                    
+                t = t + Tref_ind
+                
+                if t+1 < T_ind-1 :
+                    V[t+1] = p_Vr
+                    
+                # UPDATE ADAPTATION PROCESSES
+                process_spike(eta_proc, t+1)
+                process_spike(gamma_proc, t+1)
+                
+            t += 1
+            
+        process_advance(eta_proc, T_ind)
+        process_advance(gamma_proc, T_ind)
+        
+        spks_nb[rep] = spks_cnt
+
+
+kernel_GIF_simulate = Kernel('GIF_simulate',
+        [ 
+          'int p_T', 'double p_dt', 'int p_exact', 'int p_rescaling', 'double p_gl', 'double p_C', 'double p_El', 'double p_Vr',
+          'double p_Tref', 'double p_Vt_star', 'double p_DV', 'double p_lambda0', 'double p_V0', 'double* V',
+          'double* I', 'double* p_eta', 'int p_eta_l', 'int* p_eta_chg', 'int p_eta_chg_l',
+          'double* p_eta_b', 'double* p_eta_d', 'int p_eta_R', 'double* eta_sum', 'int* eta_evt',
+          'int* eta_starts', 'double* eta_exp', 'double* p_gamma', 'int p_gamma_l', 'int* p_gamma_chg',
+          'int p_gamma_chg_l', 'double* p_gamma_b', 'double* p_gamma_d', 'int p_gamma_R',
+          'double* gamma_sum', 'int* gamma_evt', 'int* gamma_starts', 'double* gamma_exp', 'int p_nb_rep', 'int p_seed', 'int p_rep0',
+          'int p_spks_max', 'int* spks_i', 'int* spks_nb' 
+        ],
+        """
+                
+                int   T_ind      = int(p_T);                
+                float dt         = float(p_dt); 
+                
+                float gl         = float(p_gl);
+                float C          = float(p_C);
+                float El         = float(p_El);
+                float Vr         = float(p_Vr);
+                int   Tref_ind   = int(float(p_Tref)/dt);
+                float dtC        = dt/C;                                     // forward Euler
+                if (p_exact == 1)
+                    dtC = -expm1(-dt*gl/C)/gl;                               // exact integration (I and eta constant during one time step)
+                float Vt_star    = float(p_Vt_star);
+                float DeltaV     = float(p_DV);
+                float lambda0    = float(p_lambda0);
+           
+                int eta_l        = int(p_eta_l);
+                int gamma_l      = int(p_gamma_l);
+                
+                int nb_rep       = int(p_nb_rep);
+                int spks_max     = int(p_spks_max);
+                
+                SpikeProcess eta_proc;
+                SpikeProcess gamma_proc;
+                process_init(&eta_proc, eta_sum, T_ind, p_eta, eta_l, p_eta_chg, int(p_eta_chg_l), eta_evt, eta_starts, spks_max, p_eta_b, p_eta_d, eta_exp, int(p_eta_R));
+                process_init(&gamma_proc, gamma_sum, T_ind, p_gamma, gamma_l, p_gamma_chg, int(p_gamma_chg_l), gamma_evt, gamma_starts, spks_max, p_gamma_b, p_gamma_d, gamma_exp, int(p_gamma_R));
+                                                  
+                float lambda = 0.0 ;            
+                int    sampler_i[1];                                              // state of the spike sampler (see Tools.sampler_support_code)
+                double sampler_d[2];
+                
+                
+                for (int rep=0; rep<nb_rep; rep++) {
+                
+                
+                    // RESET STATE VARIABLES
+                    for (int t=0; t<T_ind; t++)
+                        V[t] = 0.0;
+                        
+                    process_reset(&eta_proc);
+                    process_reset(&gamma_proc);
+                    sampler_reset(sampler_i, sampler_d);
+                    
+                    V[0] = p_V0;
+                    
+                    int spks_cnt = 0;
+                    
+                                                    
+                    for (int t=0; t<T_ind-1; t++) {
+        
+        
+                        // COMPUTE ADAPTATION PROCESSES
+                        process_advance(&eta_proc, t+1);
+                        process_advance(&gamma_proc, t+1);
+        
+        
+                        // INTEGRATE VOLTAGE
+                        V[t+1] = V[t] + dtC*( -gl*(V[t] - El) + I[t] - eta_sum[t] );
+                   
+                   
+                        // COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+                        lambda = lambda0*exp( (V[t+1]-Vt_star-gamma_sum[t])/DeltaV );
+                              
+                              
+                        // PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+                        if (sample_spike(p_rescaling, (unsigned int)(p_seed), (unsigned int)(p_rep0 + rep), (unsigned int)(t), lambda, dt, sampler_i, sampler_d)) {
+                                            
+                            if (t+1 < T_ind-1 && spks_cnt < spks_max) {
+                                spks_i[rep*spks_max + spks_cnt] = t+1;
+                                spks_cnt++;
+                            }
+                            
+                            t = t + Tref_ind;    
+                            
+                            if (t+1 < T_ind-1) 
+                                V[t+1] = Vr;
+                            
+                            
+                            // UPDATE ADAPTATION PROCESSES     
+                            process_spike(&eta_proc, t+1);
+                            process_spike(&gamma_proc, t+1);
+                            
+                        }
+                   
+                    }
+                    
+                    process_advance(&eta_proc, T_ind);
+                    process_advance(&gamma_proc, T_ind);
+                    
+                    spks_nb[rep] = spks_cnt;
+                    
+                }
+                
+                """,
+        GIF_simulate_ref,
+        support_code=Tools.adaptation_support_code + Tools.philox_support_code + Tools.sampler_support_code,
+        helpers=[process_new, process_reset, process_advance, process_spike, philox_uniform, sampler_reset, sample_spike])
+
+
+def GIF_forceSpikes_ref(p_T, p_dt, p_exact, p_gl, p_C, p_El, p_Vr, p_Tref, V, I, eta_sum, spks_i, p_spks_L):
+    
+    T_ind    = p_T
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    dtC = p_dt/p_C
+    if p_exact == 1 :
+        dtC = -np.expm1(-p_dt*p_gl/p_C)/p_gl
+    
+    spks_cnt   = 0
+    next_spike = T_ind
+    if p_spks_L > 0 :
+        next_spike = spks_i[0] + Tref_ind
+    
+    t = 0
+    while t < T_ind-1 :
+        
+        # INTEGRATE VOLTAGE
+        V[t+1] = V[t] + dtC*( -p_gl*(V[t] - p_El) + I[t] - eta_sum[t] )
+        
+        if t == next_spike :
+            spks_cnt = spks_cnt + 1
+            next_spike = T_ind
+            if spks_cnt < p_spks_L :
+                next_spike = spks_i[spks_cnt] + Tref_ind
+            V[t-1] = 0
+            V[t] = p_Vr
+            t = t-1
+            
+        t += 1
+
+
+kernel_GIF_forceSpikes = Kernel('GIF_forceSpikes',
+        [ 
+          'int p_T', 'double p_dt', 'int p_exact', 'double p_gl', 'double p_C', 'double p_El', 'double p_Vr',
+          'double p_Tref', 'double* V', 'double* I', 'double* eta_sum', 'int* spks_i', 'int p_spks_L' 
+        ],
+        """ 
+                
+                int   T_ind      = int(p_T);                
+                float dt         = float(p_dt); 
+                
+                float gl         = float(p_gl);
+                float C          = float(p_C);
+                float El         = float(p_El);
+                float Vr         = float(p_Vr);
+                int   Tref_ind   = int(float(p_Tref)/dt);
+                float dtC        = dt/C;                                     // forward Euler
+                if (p_exact == 1)
+                    dtC = -expm1(-dt*gl/C)/gl;                               // exact integration (I and eta constant during one time step)
+
+
+                int spks_L     = int(p_spks_L);
+                int spks_cnt   = 0;
+                int next_spike = T_ind;
+                
+                if (spks_L > 0)
+                    next_spike = spks_i[0] + Tref_ind;
+ 
+                                                                       
+                for (int t=0; t<T_ind-1; t++) {
+    
+    
+                    // INTEGRATE VOLTAGE
+                    V[t+1] = V[t] + dtC*( -gl*(V[t] - El) + I[t] - eta_sum[t] );
+               
+               
+                    if ( t == next_spike ) {
+                        spks_cnt = spks_cnt + 1;
+                        next_spike = T_ind;
+                        if (spks_cnt < spks_L)
+                            next_spike = spks_i[spks_cnt] + Tref_ind;
+                        V[t-1] = 0 ;                  
+                        V[t] = Vr ;
+                        t=t-1;           
+                    }
+               
+                }
+        
+                """,
+        GIF_forceSpikes_ref)
+
@@ -0,0 +1,137 @@
+import numpy as np
+
+from KernelBackend import *
+from KernelBackend_C import *
+from KernelBackend_Numba import *
+from KernelBackend_NumPy import *
+
+
+class Kernel :
+
+    """
+    A kernel is a loop that cannot be vectorized (e.g., the numerical integration of a model) and that must be compiled to run fast.
+
+    Kernels are executed by the kernel backend selected at runtime (see KernelBackend):
+
+    - C     : the C code of the kernel is compiled into a shared library (stored in a persistent cache) and called via ctypes
+    - Numba : the Python implementation of the kernel is compiled with Numba
+    - NumPy : the Python implementation of the kernel is executed as it is (slow, reference implementation)
+
+    A kernel is defined by:
+
+    - name         : string, unique name of the kernel
+    - args         : list of C declarations of the arguments of the kernel, e.g. ['int p_T', 'double p_dt', 'double* V', 'int* spks_i']
+                     (allowed types: int, double, int*, double*; arrays of type int* must be numpy arrays with dtype int32)
+    - code         : string, C code (body of the function)
+    - function     : Python implementation of the kernel (same arguments as args, in the same order); this function should be
+                     compatible with Numba nopython mode
+    - support_code : string, C code defining auxiliary functions used in code
+    - helpers      : list of Python functions called by function (compiled together with function by the Numba backend)
+
+    All the backends implement the same algorithm, so that results only differ because of floating point precision
+    (most C kernels use single precision for the model parameters) and of the random number generators.
+    Arrays are modified in place; the kernels do not return any value.
+
+    Kernels are compiled the first time they are executed, or all at once with Kernel.prepare.
+    """
+
+    ctypes_arrays = { 'int*' : 'int32', 'double*' : 'double' }
+
+    registry      = []                  # all the kernels defined so far (see prepare)
+
+    modules       = [ 'Tools', 'Trace', 'Filter_Exps', 'GIF', 'gGIF', 'iGIF_NP', 'iGIF_Na', 'Simulator', 'ModelBank' ]    # modules that define kernels
+
+
+    def __init__(self, name, args, code, function, support_code='', helpers=[]):
+
+        self.name         = name
+
+        self.args         = [ a.replace('*', '* ').split() for a in args ]      # list of (type, name)
+
+        self.code         = code
+
+        self.function     = function
+
+        self.support_code = support_code
+
+        self.helpers      = helpers
+
+        Kernel.registry.append(self)
+
+
+    def getArguments(self, local_dict):
+
+        """
+        Given a dictionary of variables (e.g., locals() in the function calling the kernel), return the list of
+        arguments of the kernel converted to the types declared in self.args.
+        """
+
+        args = []
+
+        for (a_type, a_name) in self.args :
+
+            a = local_dict[a_name]
+
+            if a_type == 'int' :
+                args.append( int(a) )
+
+            elif a_type == 'double' :
+                args.append( float(a) )
+
+            else :
+
+                if not ( isinstance(a, np.ndarray) and a.dtype == np.dtype(Kernel.ctypes_arrays[a_type]) and a.flags['C_CONTIGUOUS'] ) :
+                    raise TypeError("Kernel %s: argument %s must be a contiguous numpy array of type %s." % (self.name, a_name, Kernel.ctypes_arrays[a_type]))
+
+                args.append( a )
+
+        return args
+
+
+    def run(self, local_dict):
+
+        """
+        Execute the kernel with the current backend (see KernelBackend.setBackend).
+        The arguments are taken by name from local_dict (typically locals()).
+        """
+
+        KernelBackend.getBackend().run(self, self.getArguments(local_dict))
+
+
+    @classmethod
+    def prepare(cls, backend=None):
+
+        """
+        Compile all the kernels of the toolbox with the current backend (or select the backend named backend first, 
+        see KernelBackend.setBackend) and return their names.
+        
+        Compiled kernels are stored in a persistent cache (see KernelBackend.getCacheDir), so that later processes only 
+        load them. This function can be called:
+        - once after installation (e.g., python Kernel.py [backend]), to fill the persistent cache
+        - at the beginning of a script that starts worker processes (see Tools.parallelMap), so that the workers
+          inherit the compiled kernels and do not compile or load anything
+        """
+
+        for module in cls.modules :
+            __import__(module)
+
+        if backend != None :
+            KernelBackend.setBackend(backend)
+
+        for kernel in cls.registry :
+            KernelBackend.getBackend().prepare(kernel)
+
+        return [ kernel.name for kernel in cls.registry ]
+
+
+if __name__ == '__main__' :
+
+    import sys
+    import time
+
+    import Kernel                       # the kernels register themselves in the module Kernel (not in __main__)
+
+    t0 = time.time()
+    names = Kernel.Kernel.prepare(*sys.argv[1:2])
+
+    print "%d kernels prepared with the %s backend in %0.2f s (cache: %s)" % (len(names), KernelBackend.getBackend().name, time.time()-t0, KernelBackend.getCacheDir())
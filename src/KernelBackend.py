@@ -0,0 +1,149 @@
+import abc
+import os
+
+
+class KernelBackend :
+
+    """
+    Abstract class defining an interface for a kernel backend, i.e. an object that executes the kernels (see Kernel)
+    used by the models (e.g., numerical integration of the GIF model).
+
+    Backends are registered with KernelBackend.register and selected at runtime with:
+
+        KernelBackend.setBackend(name)
+
+    or by setting the environment variable GIFFITTINGTOOLBOX_BACKEND before the first kernel is executed.
+    Compiled kernels are stored in a persistent cache directory (see getCacheDir), so that they are compiled only once
+    per machine (see also Kernel.prepare).
+    By default ('auto'), the first available backend in KernelBackend.auto_order is used (the slow NumPy backend is
+    never selected automatically). If the requested backend is not available an exception is raised, so that
+    the backend never changes silently.
+
+    To define a new backend, inherit from this class and implement the abstract methods.
+    """
+
+    __metaclass__  = abc.ABCMeta
+
+    backends   = {}                     # registered backend classes (name -> class)
+
+    backend    = None                   # backend currently used to execute kernels
+
+    auto_order = ['C', 'Numba']         # backends used by default, in order of preference
+
+
+    def __init__(self):
+
+        self.compiled = {}              # kernels already compiled (Kernel -> callable)
+
+
+    @abc.abstractmethod
+    def isAvailable(self):
+
+        """
+        Return True if the backend can be used on this machine (e.g., compiler or package available).
+        """
+
+
+    @abc.abstractmethod
+    def compile(self, kernel):
+
+        """
+        Compile the kernel and return a callable that takes the arguments of the kernel (in the order defined in kernel.args).
+        """
+
+
+    def run(self, kernel, args):
+
+        """
+        Execute the kernel with the list of arguments args (compile the kernel the first time it is used).
+        """
+
+        self.prepare(kernel)
+
+        self.compiled[kernel](*args)
+
+
+    def prepare(self, kernel):
+
+        """
+        Compile the kernel (or load it from the persistent cache) if it has not been compiled yet by this backend.
+        """
+
+        if kernel not in self.compiled :
+            self.compiled[kernel] = self.compile(kernel)
+
+
+    ########################################################################################################
+    # REGISTRY OF BACKENDS
+    ########################################################################################################
+
+    @classmethod
+    def register(cls, backend_class):
+
+        """
+        Register a new kernel backend (backend_class must inherit from KernelBackend and define the attribute name).
+        """
+
+        cls.backends[backend_class.name] = backend_class
+
+
+    @classmethod
+    def getCacheDir(cls):
+
+        """
+        Return the directory where the backends store the compiled kernels (GIFFITTINGTOOLBOX_CACHE environment variable,
+        by default ~/.cache/GIFFittingToolbox).
+        """
+
+        return os.environ.get('GIFFITTINGTOOLBOX_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'GIFFittingToolbox'))
+
+
+    @classmethod
+    def getAvailableBackends(cls):
+
+        """
+        Return the names of the registered backends that can be used on this machine.
+        """
+
+        return [ name for name in sorted(cls.backends.keys()) if cls.backends[name]().isAvailable() ]
+
+
+    @classmethod
+    def setBackend(cls, name='auto'):
+
+        """
+        Select the backend used to execute the kernels (e.g., 'C', 'Numba', 'NumPy' or 'auto').
+        """
+
+        if name == 'auto' :
+
+            for name_tmp in cls.auto_order :
+                if name_tmp in cls.backends and cls.backends[name_tmp]().isAvailable() :
+                    name = name_tmp
+                    break
+
+            else :
+                raise Exception("No compiled kernel backend is available (install a C compiler or Numba, or select the NumPy backend explicitly).")
+
+        if name not in cls.backends :
+            raise Exception("Unknown kernel backend %s (registered backends: %s)." % (name, ', '.join(sorted(cls.backends.keys()))))
+
+        backend = cls.backends[name]()
+
+        if not backend.isAvailable() :
+            raise Exception("Kernel backend %s is not available on this machine." % (name))
+
+        cls.backend = backend
+
+
+    @classmethod
+    def getBackend(cls):
+
+        """
+        Return the backend currently used to execute the kernels.
+        """
+
+        if cls.backend == None :
+            cls.setBackend(os.environ.get('GIFFITTINGTOOLBOX_BACKEND', 'auto'))
+
+        return cls.backend
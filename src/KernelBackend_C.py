@@ -0,0 +1,136 @@
+import ctypes
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from distutils.ccompiler import new_compiler
+from distutils.sysconfig import customize_compiler
+from distutils.spawn import find_executable
+
+from KernelBackend import *
+
+
+class KernelBackend_C(KernelBackend) :
+
+    """
+    Kernel backend that compiles the C code of each kernel into a shared library with the system C/C++ compiler
+    and calls it via ctypes.
+
+    Shared libraries are stored in the persistent cache directory (see KernelBackend.getCacheDir) and identified
+    by a hash of their source code, so that each kernel is compiled only once per machine.
+    """
+
+    name = 'C'
+
+    headers = ['<math.h>', '<stdlib.h>']
+
+    ctypes_types = { 'int'     : ctypes.c_int,
+                     'double'  : ctypes.c_double,
+                     'int*'    : np.ctypeslib.ndpointer(dtype=np.int32, flags='C_CONTIGUOUS'),
+                     'double*' : np.ctypeslib.ndpointer(dtype=np.double, flags='C_CONTIGUOUS') }
+
+
+    def __init__(self):
+
+        KernelBackend.__init__(self)
+
+        self.cache_dir = KernelBackend.getCacheDir()
+
+
+    def getCompiler(self):
+
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        
+        if hasattr(compiler, 'compiler_so') :                                   # kernels are compiled as C++
+            compiler.compiler_so = [ o for o in compiler.compiler_so if o != '-Wstrict-prototypes' ]
+
+        return compiler
+
+
+    def isAvailable(self):
+
+        try :
+            compiler = self.getCompiler()
+            if hasattr(compiler, 'compiler_so') :
+                return find_executable(compiler.compiler_so[0]) != None
+            return True
+
+        except Exception :
+            return False
+
+
+    def getSource(self, kernel):
+
+        """
+        Return the C++ source code of the shared library that contains the kernel.
+        """
+
+        src  = ''.join([ '#include %s\n' % h for h in KernelBackend_C.headers ])
+        src += kernel.support_code + '\n'
+        src += 'extern "C" void %s(%s) {\n%s\n}\n' % (kernel.name, ', '.join([ '%s %s' % (a_type, a_name) for (a_type, a_name) in kernel.args ]), kernel.code)
+
+        return src
+
+
+    def getLibraryPath(self, kernel):
+
+        src = self.getSource(kernel)
+
+        return os.path.join(self.cache_dir, '%s_%s.so' % (kernel.name, hashlib.md5(src.encode('utf-8')).hexdigest()[:16]))
+
+
+    def build(self, kernel):
+
+        """
+        Compile the kernel into a shared library stored in the cache directory (if not already there).
+        Return the path of the shared library.
+        """
+
+        lib_path = self.getLibraryPath(kernel)
+
+        if os.path.exists(lib_path) :
+            return lib_path
+
+        if not os.path.exists(self.cache_dir) :
+            try :
+                os.makedirs(self.cache_dir)
+            except OSError :
+                pass
+
+        build_dir = tempfile.mkdtemp(dir=self.cache_dir)
+
+        try :
+
+            src_path = os.path.join(build_dir, kernel.name + '.cpp')
+
+            with open(src_path, 'w') as f :
+                f.write(self.getSource(kernel))
+
+            compiler = self.getCompiler()
+            objects  = compiler.compile([src_path], output_dir=build_dir, extra_postargs=['-O3', '-w'])
+            compiler.link_shared_object(objects, os.path.join(build_dir, 'kernel.so'))
+
+            os.rename(os.path.join(build_dir, 'kernel.so'), lib_path)        # atomic, several processes can build the same kernel
+
+        finally :
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+        return lib_path
+
+
+    def compile(self, kernel):
+
+        lib = ctypes.CDLL(self.build(kernel))
+
+        function          = getattr(lib, kernel.name)
+        function.restype  = None
+        function.argtypes = [ KernelBackend_C.ctypes_types[a_type] for (a_type, a_name) in kernel.args ]
+
+        return function
+
+
+KernelBackend.register(KernelBackend_C)
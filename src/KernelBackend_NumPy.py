@@ -0,0 +1,26 @@
+from KernelBackend import *
+
+
+class KernelBackend_NumPy(KernelBackend) :
+
+    """
+    Kernel backend that executes the Python implementation of each kernel as it is.
+
+    No compilation is required, but this backend is much slower than the others. It is meant to be used as a
+    reference implementation (e.g., to test the other backends) and is never selected automatically.
+    """
+
+    name = 'NumPy'
+
+
+    def isAvailable(self):
+
+        return True
+
+
+    def compile(self, kernel):
+
+        return kernel.function
+
+
+KernelBackend.register(KernelBackend_NumPy)
@@ -0,0 +1,129 @@
+import hashlib
+import inspect
+import os
+import types
+
+from KernelBackend import *
+
+
+class KernelBackend_Numba(KernelBackend) :
+
+    """
+    Kernel backend that compiles the Python implementation of each kernel with Numba (nopython mode).
+
+    The helper functions called by a kernel (kernel.helpers) are compiled as well and the compiled kernel calls
+    their compiled version. Compiled functions are cached on disk by Numba (cache=True), so that each kernel
+    is compiled only once per machine.
+
+    Numba only checks the source file of a cached function, not the source of the helpers compiled into it
+    (e.g., the helpers defined in Tools). The cache of each function is therefore stored in a subdirectory of the
+    persistent cache directory (see KernelBackend.getCacheDir) named after a hash of the source code of the function,
+    of the helpers it calls and of the version of Numba.
+    """
+
+    name = 'Numba'
+
+
+    def __init__(self):
+
+        KernelBackend.__init__(self)
+
+        self.jitted = {}                # compiled helper functions (Python function -> compiled function)
+
+        self.cache_dir = os.path.join(KernelBackend.getCacheDir(), 'numba')
+
+
+    def isAvailable(self):
+
+        try :
+            import numba
+            return True
+
+        except ImportError :
+            return False
+
+
+    def getHelpers(self, function, helpers):
+
+        """
+        Return the helpers called by function.
+        """
+
+        return [ h for h in helpers if h is not function and h.__name__ in function.__code__.co_names ]
+
+
+    def getSourceHash(self, function, helpers):
+
+        """
+        Return a hash of the source code of function and of the helpers it calls (recursively).
+        """
+
+        import numba
+
+        src = numba.__version__ + inspect.getsource(function)
+
+        for h in self.getHelpers(function, helpers) :
+            src += self.getSourceHash(h, helpers)
+
+        return hashlib.md5(src.encode('utf-8')).hexdigest()[:16]
+
+
+    def jit(self, function, helpers):
+
+        """
+        Compile function with Numba. The global names of function that refer to one of the helpers
+        are replaced by the compiled version of the helper.
+        """
+
+        import numba
+
+        if function in self.jitted :
+            return self.jitted[function]
+
+        function_globals = dict(function.__globals__)
+
+        for h in self.getHelpers(function, helpers) :
+            function_globals[h.__name__] = self.jit(h, helpers)
+
+        function_tmp = types.FunctionType(function.__code__, function_globals, function.__name__, function.__defaults__, function.__closure__)
+
+        cache_dir = numba.config.CACHE_DIR
+
+        try :
+            numba.config.CACHE_DIR = os.path.join(self.cache_dir, self.getSourceHash(function, helpers))
+            self.jitted[function] = numba.njit(cache=True)(function_tmp)
+
+        finally :
+            numba.config.CACHE_DIR = cache_dir
+
+        return self.jitted[function]
+
+
+    def getArgumentType(self, a_type):
+
+        """
+        Return the Numba type of the arguments of type a_type passed by Kernel.run (see Kernel.getArguments).
+        """
+
+        import numba
+
+        return { 'int'     : numba.int64,
+                 'double'  : numba.float64,
+                 'int*'    : numba.int32[::1],
+                 'double*' : numba.float64[::1] }[a_type]
+
+
+    def compile(self, kernel):
+
+        """
+        Compile the kernel for the types of the arguments passed by Kernel.run (otherwise Numba compiles the
+        kernel at its first call).
+        """
+
+        function = self.jit(kernel.function, kernel.helpers)
+        function.compile( tuple([ self.getArgumentType(a_type) for (a_type, a_name) in kernel.args ]) )
+
+        return function
+
+
+KernelBackend.register(KernelBackend_Numba)
@@ -0,0 +1,402 @@
+import copy
+
+import numpy as np
+
+from GIF import *
+
+import Tools
+from Tools import process_new, process_reset, process_advance, process_spike, philox_uniform, sampler_reset, sample_spike
+from Kernel import *
+
+
+class ModelBank :
+
+    """
+    Bank of N GIF models (e.g., models fitted on different cells or sampled in a parameter sweep) that are
+    simulated with the same input current in a single call to a C kernel:
+
+        bank = ModelBank(GIFs)
+        all_spks = bank.simulateSpikingResponse(I, dt)
+
+    Each model keeps its own parameters (gl, C, El, Vr, Tref, Vt_star, DV, lambda0), its own filters eta and gamma
+    and its own integrator (see GIF.setIntegrator). The filters of the different models do not need to be defined
+    on the same basis functions. Use fromParameters to create a bank from arrays of parameters and of filter
+    coefficients defined on a shared basis.
+
+    The k-th model of the bank uses the stream k of the random number generator (see Tools.philox_support_code),
+    so that its spike train is identical to the one returned by GIFs[k].simulate_batch(I, V0, 1, seed=seed, rep0=k).
+    """
+
+    def __init__(self, GIFs):
+
+        for model in GIFs :
+            if type(model) != GIF :
+                raise ValueError("ModelBank only supports GIF models (not %s)." % (type(model).__name__))
+
+        self.GIFs = GIFs                    # list of GIF models
+
+
+    @classmethod
+    def fromParameters(cls, gl, C, El, Vr, Tref, Vt_star, DV, eta_coeffs, gamma_coeffs, eta, gamma, lambda0=1.0):
+
+        """
+        Create a bank of N GIF models from arrays of N parameters (gl, C, El, Vr, Tref, Vt_star, DV; scalars are
+        used for all the models) and from the N x M arrays of coefficients of the filters eta and gamma on the basis
+        functions defined by the Filter objects eta and gamma (shared by all the models).
+        """
+
+        N = len(eta_coeffs)
+
+        GIFs = []
+
+        for k in range(N) :
+
+            model = GIF()
+
+            model.gl      = np.broadcast_to(gl, N)[k]
+            model.C       = np.broadcast_to(C, N)[k]
+            model.El      = np.broadcast_to(El, N)[k]
+            model.Vr      = np.broadcast_to(Vr, N)[k]
+            model.Tref    = np.broadcast_to(Tref, N)[k]
+            model.Vt_star = np.broadcast_to(Vt_star, N)[k]
+            model.DV      = np.broadcast_to(DV, N)[k]
+            model.lambda0 = np.broadcast_to(lambda0, N)[k]
+
+            model.eta = copy.deepcopy(eta)
+            model.eta.setFilter_Coefficients(np.array(eta_coeffs[k], dtype='double'))
+
+            model.gamma = copy.deepcopy(gamma)
+            model.gamma.setFilter_Coefficients(np.array(gamma_coeffs[k], dtype='double'))
+
+            GIFs.append(model)
+
+        return cls(GIFs)
+
+
+    def getModelNb(self):
+
+        return len(self.GIFs)
+
+
+    def getSpikeUpdates(self, f_name, dt):
+
+        """
+        Return the filters f_name ('eta' or 'gamma') of all the models (see Filter.getSpikeUpdate) concatenated in
+        flat arrays, together with the offsets of each model in these arrays:
+        (f_tab, f_off, chg, chg_off, b, d, R_off).
+        """
+
+        updates = [ getattr(model, f_name).getSpikeUpdate(dt) for model in self.GIFs ]
+
+        f_tab   = np.concatenate( [ np.zeros(0) ] + [ u[0] for u in updates ] ).astype("double")
+        chg     = np.concatenate( [ np.zeros(0) ] + [ u[1] for u in updates ] ).astype("int32")
+        b       = np.concatenate( [ np.zeros(0) ] + [ u[2] for u in updates ] ).astype("double")
+        d       = np.concatenate( [ np.zeros(0) ] + [ u[3] for u in updates ] ).astype("double")
+
+        f_off   = np.concatenate( ( [0], np.cumsum([ len(u[0]) for u in updates ]) ) ).astype("int32")
+        chg_off = np.concatenate( ( [0], np.cumsum([ len(u[1]) for u in updates ]) ) ).astype("int32")
+        R_off   = np.concatenate( ( [0], np.cumsum([ len(u[2]) for u in updates ]) ) ).astype("int32")
+
+        return (f_tab, f_off, chg, chg_off, b, d, R_off)
+
+
+    ########################################################################################################
+    # METHODS FOR NUMERICAL SIMULATIONS
+    ########################################################################################################
+
+    def simulateSpikingResponse(self, I, dt, seed=None, n_jobs=1):
+
+        """
+        Simulate the spiking response of all the models of the bank to an input current I (nA) with time step dt.
+        The initial condition of each model is V(0)=El.
+        The models are distributed among n_jobs worker processes (-1: one per CPU); the result does not depend on n_jobs.
+        Return a list of N arrays, each containing the spike times (in ms) of one model.
+        """
+
+        if seed == None :
+            seed = Tools.getRandomSeed()
+
+        N      = self.getModelNb()
+        blocks = [ (int(k[0]), len(k)) for k in np.array_split(np.arange(N), Tools.getJobsNb(n_jobs)) if len(k) > 0 ]
+
+        all_spks = []
+
+        for spks_block in Tools.parallelMap(simulate_block, blocks, n_jobs=n_jobs, data=(self, I, dt, seed)) :
+            all_spks.extend(spks_block)
+
+        return all_spks
+
+
+    def simulate(self, I, dt, k0=0, N=None, seed=None):
+
+        """
+        Simulate the spiking response of the models k0, ..., k0+N-1 of the bank (by default all the models) to an
+        input current I (nA) with time step dt (the initial condition of each model is V(0)=El).
+        The models are simulated one after the other in a single call to the C kernel (see GIF.simulate_batch, which
+        also describes seed); the arrays used by the simulation are shared by all the models.
+        Return a list of N arrays, each containing the spike times (in ms) of one model.
+        """
+
+        if N == None :
+            N = self.getModelNb() - k0
+
+        if seed == None :
+            seed = Tools.getRandomSeed()
+
+        models = self.GIFs[k0:k0+N]
+
+        # Input parameters
+        p_T         = len(I)
+        p_dt        = dt
+
+        # Model parameters (one value per model)
+        p_gl        = np.array([ m.gl for m in models ], dtype="double")
+        p_C         = np.array([ m.C for m in models ], dtype="double")
+        p_El        = np.array([ m.El for m in models ], dtype="double")
+        p_Vr        = np.array([ m.Vr for m in models ], dtype="double")
+        p_Tref      = np.array([ m.Tref for m in models ], dtype="double")
+        p_Vt_star   = np.array([ m.Vt_star for m in models ], dtype="double")
+        p_DV        = np.array([ m.DV for m in models ], dtype="double")
+        p_lambda0   = np.array([ m.lambda0 for m in models ], dtype="double")
+        p_exact     = np.array([ int(m.getIntegrator() == 'exact') for m in models ], dtype="int32")
+        p_rescaling = np.array([ int(m.getSampling() == 'rescaling') for m in models ], dtype="int32")
+
+        # Random number generator (see Tools.philox_support_code)
+        p_seed      = seed
+
+        # Model kernels (see getSpikeUpdates)
+        bank = ModelBank(models)
+
+        (p_eta, p_eta_off, p_eta_chg, p_eta_chg_off, p_eta_b, p_eta_d, p_eta_R_off)                 = bank.getSpikeUpdates('eta', dt)
+        (p_gamma, p_gamma_off, p_gamma_chg, p_gamma_chg_off, p_gamma_b, p_gamma_d, p_gamma_R_off)   = bank.getSpikeUpdates('gamma', dt)
+
+        # Define arrays (shared by all the models)
+        V = np.array(np.zeros(p_T), dtype="double")
+        I = np.array(I, dtype="double")
+
+        # Spike indices of each model are stored in a flat array (at most p_spks_max spikes per model)
+        p_spks_max  = Tools.getMaxSpikeNb(p_T, np.min(p_Tref), p_dt)
+        nb_call     = Tools.getRepetitionsPerCall(N, p_spks_max)
+
+        # Spike-triggered processes (see Tools.adaptation_support_code)
+        eta_sum    = np.array(np.zeros(p_T), dtype="double")
+        eta_evt    = np.array(np.zeros(p_T), dtype="int32")
+        eta_starts = np.array(np.zeros(p_spks_max), dtype="int32")
+        eta_exp    = np.array(np.zeros(max(1, np.max(np.diff(p_eta_R_off)))), dtype="double")
+
+        gamma_sum    = np.array(np.zeros(p_T), dtype="double")
+        gamma_evt    = np.array(np.zeros(p_T), dtype="int32")
+        gamma_starts = np.array(np.zeros(p_spks_max), dtype="int32")
+        gamma_exp    = np.array(np.zeros(max(1, np.max(np.diff(p_gamma_R_off)))), dtype="double")
+
+        all_spks = []
+
+        for k_start in np.arange(0, N, nb_call) :
+
+            p_k_start = int(k_start)
+            p_nb      = int(min(nb_call, N - k_start))
+            p_stream0 = int(k0 + k_start)
+            spks_i    = np.array(np.zeros(p_nb*p_spks_max), dtype="int32")
+            spks_nb   = np.array(np.zeros(p_nb), dtype="int32")
+
+            kernel_ModelBank_simulate.run(locals())
+
+            all_spks.extend( Tools.splitSpikeIndices(spks_i, spks_nb, p_spks_max, dt) )
+
+        return all_spks
+
+
+def simulate_block(data, block):
+
+    """
+    Simulate a block of models of ModelBank.simulateSpikingResponse (executed by the worker processes).
+    """
+
+    (bank, I, dt, seed) = data
+    (k0, N) = block
+
+    return bank.simulate(I, dt, k0=k0, N=N, seed=seed)
+
+
+
+########################################################################################################
+# KERNELS (see Kernel)
+########################################################################################################
+
+def ModelBank_simulate_ref(p_T, p_dt, p_exact, p_rescaling, p_gl, p_C, p_El, p_Vr, p_Tref, p_Vt_star, p_DV, p_lambda0, V, I,
+                           p_eta, p_eta_off, p_eta_chg, p_eta_chg_off, p_eta_b, p_eta_d, p_eta_R_off, eta_sum, eta_evt, eta_starts, eta_exp,
+                           p_gamma, p_gamma_off, p_gamma_chg, p_gamma_chg_off, p_gamma_b, p_gamma_d, p_gamma_R_off, gamma_sum, gamma_evt, gamma_starts, gamma_exp,
+                           p_k_start, p_nb, p_seed, p_stream0, p_spks_max, spks_i, spks_nb):
+
+    T_ind = p_T
+
+    sampler_i  = np.zeros(1, dtype=np.int32)
+    sampler_d  = np.zeros(2)
+
+    for n in range(p_nb) :
+
+        k = p_k_start + n
+
+        Tref_ind = int(np.float32(p_Tref[k])/np.float32(p_dt))
+
+        dtC = p_dt/p_C[k]
+        if p_exact[k] == 1 :
+            dtC = -np.expm1(-p_dt*p_gl[k]/p_C[k])/p_gl[k]
+
+        eta_R      = p_eta_R_off[k+1] - p_eta_R_off[k]
+        gamma_R    = p_gamma_R_off[k+1] - p_gamma_R_off[k]
+
+        eta_proc   = process_new(eta_sum, p_eta[p_eta_off[k]:p_eta_off[k+1]], p_eta_chg[p_eta_chg_off[k]:p_eta_chg_off[k+1]], eta_evt, eta_starts,
+                                 p_eta_b[p_eta_R_off[k]:p_eta_R_off[k+1]], p_eta_d[p_eta_R_off[k]:p_eta_R_off[k+1]], eta_exp[:eta_R])
+        gamma_proc = process_new(gamma_sum, p_gamma[p_gamma_off[k]:p_gamma_off[k+1]], p_gamma_chg[p_gamma_chg_off[k]:p_gamma_chg_off[k+1]], gamma_evt, gamma_starts,
+                                 p_gamma_b[p_gamma_R_off[k]:p_gamma_R_off[k+1]], p_gamma_d[p_gamma_R_off[k]:p_gamma_R_off[k+1]], gamma_exp[:gamma_R])
+
+        # RESET STATE VARIABLES
+        V[:] = 0.0
+        process_reset(eta_proc)
+        process_reset(gamma_proc)
+        sampler_reset(sampler_i, sampler_d)
+
+        V[0] = p_El[k]
+
+        spks_cnt = 0
+
+        t = 0
+        while t < T_ind-1 :
+
+            # COMPUTE ADAPTATION PROCESSES
+            process_advance(eta_proc, t+1)
+            process_advance(gamma_proc, t+1)
+
+            # INTEGRATE VOLTAGE
+            V[t+1] = V[t] + dtC*( -p_gl[k]*(V[t] - p_El[k]) + I[t] - eta_sum[t] )
+
+            # COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+            lambda_t    = p_lambda0[k]*np.exp( (V[t+1]-p_Vt_star[k]-gamma_sum[t])/p_DV[k] )
+
+            # PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+            if sample_spike(p_rescaling[k], p_seed, p_stream0 + n, t, lambda_t, p_dt, sampler_i, sampler_d) :
+
+                if t+1 < T_ind-1 and spks_cnt < p_spks_max :
+                    spks_i[n*p_spks_max + spks_cnt] = t+1
+                    spks_cnt += 1
+
+                t = t + Tref_ind
+
+                if t+1 < T_ind-1 :
+                    V[t+1] = p_Vr[k]
+
+                # UPDATE ADAPTATION PROCESSES
+                process_spike(eta_proc, t+1)
+                process_spike(gamma_proc, t+1)
+
+            t += 1
+
+        spks_nb[n] = spks_cnt
+
+
+kernel_ModelBank_simulate = Kernel('ModelBank_simulate',
+        [
+          'int p_T', 'double p_dt', 'int* p_exact', 'int* p_rescaling', 'double* p_gl', 'double* p_C', 'double* p_El', 'double* p_Vr',
+          'double* p_Tref', 'double* p_Vt_star', 'double* p_DV', 'double* p_lambda0', 'double* V', 'double* I',
+          'double* p_eta', 'int* p_eta_off', 'int* p_eta_chg', 'int* p_eta_chg_off', 'double* p_eta_b', 'double* p_eta_d',
+          'int* p_eta_R_off', 'double* eta_sum', 'int* eta_evt', 'int* eta_starts', 'double* eta_exp',
+          'double* p_gamma', 'int* p_gamma_off', 'int* p_gamma_chg', 'int* p_gamma_chg_off', 'double* p_gamma_b', 'double* p_gamma_d',
+          'int* p_gamma_R_off', 'double* gamma_sum', 'int* gamma_evt', 'int* gamma_starts', 'double* gamma_exp',
+          'int p_k_start', 'int p_nb', 'int p_seed', 'int p_stream0', 'int p_spks_max', 'int* spks_i', 'int* spks_nb'
+        ],
+        """
+
+                int   T_ind      = int(p_T);
+                float dt         = float(p_dt);
+
+                int spks_max     = int(p_spks_max);
+
+                float lambda = 0.0 ;
+                int    sampler_i[1];                                              // state of the spike sampler (see Tools.sampler_support_code)
+                double sampler_d[2];
+
+
+                for (int n=0; n<p_nb; n++) {
+
+                    int k = p_k_start + n;
+
+                    float gl         = float(p_gl[k]);
+                    float C          = float(p_C[k]);
+                    float El         = float(p_El[k]);
+                    float Vr         = float(p_Vr[k]);
+                    int   Tref_ind   = int(float(p_Tref[k])/dt);
+                    float dtC        = dt/C;                                     // forward Euler
+                    if (p_exact[k] == 1)
+                        dtC = -expm1(-dt*gl/C)/gl;                               // exact integration (I and eta constant during one time step)
+                    float Vt_star    = float(p_Vt_star[k]);
+                    float DeltaV     = float(p_DV[k]);
+                    float lambda0    = float(p_lambda0[k]);
+
+                    SpikeProcess eta_proc;
+                    SpikeProcess gamma_proc;
+                    process_init(&eta_proc, eta_sum, T_ind, p_eta + p_eta_off[k], p_eta_off[k+1] - p_eta_off[k], p_eta_chg + p_eta_chg_off[k], p_eta_chg_off[k+1] - p_eta_chg_off[k],
+                                 eta_evt, eta_starts, spks_max, p_eta_b + p_eta_R_off[k], p_eta_d + p_eta_R_off[k], eta_exp, p_eta_R_off[k+1] - p_eta_R_off[k]);
+                    process_init(&gamma_proc, gamma_sum, T_ind, p_gamma + p_gamma_off[k], p_gamma_off[k+1] - p_gamma_off[k], p_gamma_chg + p_gamma_chg_off[k], p_gamma_chg_off[k+1] - p_gamma_chg_off[k],
+                                 gamma_evt, gamma_starts, spks_max, p_gamma_b + p_gamma_R_off[k], p_gamma_d + p_gamma_R_off[k], gamma_exp, p_gamma_R_off[k+1] - p_gamma_R_off[k]);
+
+
+                    // RESET STATE VARIABLES
+                    for (int t=0; t<T_ind; t++)
+                        V[t] = 0.0;
+
+                    process_reset(&eta_proc);
+                    process_reset(&gamma_proc);
+                    sampler_reset(sampler_i, sampler_d);
+
+                    V[0] = p_El[k];
+
+                    int spks_cnt = 0;
+
+
+                    for (int t=0; t<T_ind-1; t++) {
+
+
+                        // COMPUTE ADAPTATION PROCESSES
+                        process_advance(&eta_proc, t+1);
+                        process_advance(&gamma_proc, t+1);
+
+
+                        // INTEGRATE VOLTAGE
+                        V[t+1] = V[t] + dtC*( -gl*(V[t] - El) + I[t] - eta_sum[t] );
+
+
+                        // COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+                        lambda = lambda0*exp( (V[t+1]-Vt_star-gamma_sum[t])/DeltaV );
+
+
+                        // PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+                        if (sample_spike(p_rescaling[k], (unsigned int)(p_seed), (unsigned int)(p_stream0 + n), (unsigned int)(t), lambda, dt, sampler_i, sampler_d)) {
+
+                            if (t+1 < T_ind-1 && spks_cnt < spks_max) {
+                                spks_i[n*spks_max + spks_cnt] = t+1;
+                                spks_cnt++;
+                            }
+
+                            t = t + Tref_ind;
+
+                            if (t+1 < T_ind-1)
+                                V[t+1] = Vr;
+
+
+                            // UPDATE ADAPTATION PROCESSES
+                            process_spike(&eta_proc, t+1);
+                            process_spike(&gamma_proc, t+1);
+
+                        }
+
+                    }
+
+                    spks_nb[n] = spks_cnt;
+
+                }
+
+                """,
+        ModelBank_simulate_ref,
+        support_code=Tools.adaptation_support_code + Tools.philox_support_code + Tools.sampler_support_code,
+        helpers=[process_new, process_reset, process_advance, process_spike, philox_uniform, sampler_reset, sample_spike])
@@ -0,0 +1,150 @@
+import copy
+
+import numpy as np
+
+from GIF import *
+
+import Tools
+
+
+class ModelFamily :
+
+    """
+    Family of models (e.g., GIF, iGIF_NP and iGIF_Na) fitted on the same experiment:
+
+        family = ModelFamily([GIF_fit, iGIF_NP_fit, iGIF_Na_fit])
+        family.fit(experiment, fit_args=[ {}, {'theta_tau_all' : theta_tau_all}, {'theta_tau' : 5.0, 'ki_all' : ki_all, 'Vi_all' : Vi_all} ])
+
+    These models share the first three steps of their fit (fitVoltageReset, fitSubthresholdDynamics and fitStaticThreshold),
+    which only depend on Tref, on the integrator and on the basis functions of eta. The models must therefore have the same Tref,
+    integrator and basis functions for eta and gamma (see sameBasis). These steps are performed once, on the first model of 
+    the family, and their results (Vr, gl, C, El, eta, Vt_star, DV, lambda0, ...) are copied to the other models, whose filter 
+    gamma is set to zero as in fitStaticThreshold. Then, the
+    model-specific steps (see GIF.fitSpecificStages) are performed in parallel, one model per worker process.
+    Since the subthreshold parameters of all the models are identical, the model-specific steps reuse the subthreshold
+    simulations cached during fitStaticThreshold (see GIF.simulateDeterministic_forceSpikes_trace).
+    """
+
+    # Parameters set by fitVoltageReset, fitSubthresholdDynamics and fitStaticThreshold
+    shared_parameters = [ 'dt', 'Tref', 'Vr', 'avg_spike_shape', 'avg_spike_shape_support', 'gl', 'C', 'El', 'eta', 'Vt_star', 'DV', 'lambda0' ]
+
+    # Fit steps shared by the models of the family
+    shared_stages     = [ 'fitVoltageReset', 'fitSubthresholdDynamics', 'fitStaticThreshold', 'simulateDeterministic_forceSpikes' ]
+
+
+    def __init__(self, models):
+
+        if len(models) == 0 :
+            raise ValueError("A model family must contain at least one model.")
+
+        leader = models[0]
+
+        for model in models :
+
+            for stage in ModelFamily.shared_stages :
+                if getattr(type(model), stage).__func__ is not getattr(GIF, stage).__func__ :
+                    raise ValueError("%s does not share the fit step %s of GIF." % (type(model).__name__, stage))
+
+            if model.Tref != leader.Tref or model.getIntegrator() != leader.getIntegrator() :
+                raise ValueError("The models of a family must have the same Tref and integrator.")
+
+            if not ModelFamily.sameBasis(model.eta, leader.eta) or not ModelFamily.sameBasis(model.gamma, leader.gamma) :
+                raise ValueError("The models of a family must have the same basis functions for eta and gamma.")
+
+        if len(set([ id(model) for model in models ])) != len(models) :
+            raise ValueError("The models of a family must be distinct objects.")
+
+        self.models = models                # list of models, the shared fit steps are performed on models[0]
+
+
+    @classmethod
+    def sameBasis(cls, f1, f2):
+
+        """
+        Return True if the filters f1 and f2 are defined on the same basis functions (their coefficients can differ), i.e.
+        the same bins for rectangular basis functions (see Filter_Rect) or the same timescales for exponentials (see Filter_Exps).
+        """
+
+        if type(f1) != type(f2) or f1.getNbOfBasisFunctions() != f2.getNbOfBasisFunctions() :
+            return False
+
+        for name in [ 'bins', 'taus', 'length_coeff' ] :
+            if not np.array_equal(getattr(f1, name, []), getattr(f2, name, [])) :
+                return False
+
+        return True
+
+
+    def getModelNb(self):
+
+        return len(self.models)
+
+
+    def fit(self, experiment, DT_beforeSpike=5.0, fit_args=None, n_jobs=1):
+
+        """
+        Fit all the models of the family on the training set traces in experiment.
+        DT_beforeSpike is used to fit the subthreshold dynamics (see GIF.fit).
+        fit_args is a list containing, for each model, a dictionary of the arguments passed to its fitSpecificStages method
+        (e.g., theta_tau_all for iGIF_NP, theta_tau, ki_all and Vi_all for iGIF_Na). By default, no argument is passed.
+        The model-specific steps are distributed among n_jobs worker processes (-1: one per CPU, see Tools.parallelMap).
+        In that case, the n_jobs arguments in fit_args are ignored (the worker processes cannot create processes).
+        """
+
+        if fit_args == None :
+            fit_args = [ {} ]*self.getModelNb()
+
+        if len(fit_args) != self.getModelNb() :
+            raise ValueError("fit_args must contain one dictionary per model (%d instead of %d)." % (len(fit_args), self.getModelNb()))
+
+        print "\n################################"
+        print "# Fit model family (%s)" % (", ".join([ type(model).__name__ for model in self.models ]))
+        print "################################\n"
+
+        # Steps shared by all the models
+
+        leader = self.models[0]
+
+        leader.fitVoltageReset(experiment, leader.Tref, do_plot=False)
+
+        leader.fitSubthresholdDynamics(experiment, DT_beforeSpike=DT_beforeSpike)
+
+        leader.fitStaticThreshold(experiment)
+
+        for model in self.models[1:] :
+            self.copySharedParameters(leader, model)
+
+
+        # Model-specific steps (the fitted models are sent back by the worker processes)
+
+        results = Tools.parallelMap(fitSpecificStages_task, range(self.getModelNb()), n_jobs=n_jobs, data=(self.models, experiment, fit_args))
+
+        for (model, result) in zip(self.models, results) :
+            if result is not model :
+                model.__dict__.update(result.__dict__)
+
+
+    def copySharedParameters(self, source, target):
+
+        """
+        Copy the parameters fitted by the shared steps (see shared_parameters) from the model source to the model target
+        and set the filter gamma of target to zero (as fitStaticThreshold does on source).
+        """
+
+        for name in ModelFamily.shared_parameters :
+            setattr(target, name, copy.deepcopy(getattr(source, name)))
+
+        target.gamma.setFilter_toZero()
+
+
+def fitSpecificStages_task(data, k):
+
+    """
+    Perform the model-specific steps of ModelFamily.fit for the k-th model (executed by the worker processes).
+    """
+
+    (models, experiment, fit_args) = data
+
+    models[k].fitSpecificStages(experiment, **fit_args[k])
+
+    return models[k]
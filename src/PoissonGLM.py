@@ -0,0 +1,365 @@
+import numpy as np
+import math
+
+from numpy.linalg import LinAlgError
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from scipy.optimize import fmin_l_bfgs_b
+
+from Tools import reprint
+
+
+
+class PoissonGLM :
+
+    """
+    Maximum likelihood fit of models in which the firing intensity has the form:
+
+    lambda(t) = lambda0 * exp( X(t)beta ),
+
+    where X(t) is a row of the matrix X (see e.g. GIF.buildXmatrix_dynamicThreshold) and beta the parameters to be fitted.
+    The log-likelihood is defined in Eq. 20 of Pozzorini et al. PLOS Comp. Biol. 2015. Since it is a concave function of beta,
+    the maximum is unique and the result does not depend on the initial condition beta0 (which can thus be used as a warm start,
+    e.g., the solution of a similar fit).
+
+    The fit can be performed on multiple traces (see addTrace). Two methods are available:
+    - 'Newton' : Newton method (default). The Newton step is computed with a Cholesky decomposition of the Hessian and its
+                 length is chosen by backtracking line search (Armijo condition), so that the log-likelihood increases at each iteration.
+    - 'L-BFGS' : limited-memory BFGS (scipy.optimize.fmin_l_bfgs_b). The Hessian is computed and factorized only once, at beta0,
+                 to precondition the problem (about the cost of one Newton iteration); the iterations only use the gradient, 
+                 which is faster when the number of parameters (i.e., of basis functions) is large.
+
+    The matrices X can be stored in single precision (dtype='float32') to reduce the memory used by the fit on long recordings.
+    The log-likelihood and its derivatives are always accumulated in double precision.
+
+    With both methods, the fit stops when the largest component of the gradient of the log-likelihood (normalized by the
+    number of spikes) is smaller than stopCond. With 'L-BFGS', the gradient is taken with respect to the preconditioned
+    parameters (see maximizeLikelihood_LBFGS), so that the same stopCond does not give the same accuracy with both methods
+    (the parameters fitted with 'L-BFGS' can differ slightly from the Newton solution, in particular the coefficients that
+    are poorly constrained by the data).
+    """
+
+    def __init__(self, dt, lambda0=1.0, method='Newton', maxIter=10**3, stopCond=10**-6, dtype='double', chunk_size=2**14):
+
+        if method not in ['Newton', 'L-BFGS'] :
+            raise ValueError("Unknown method %s (must be 'Newton' or 'L-BFGS')." % (method))
+
+        if dtype not in ['double', 'float32'] :
+            raise ValueError("Unknown dtype %s (must be 'double' or 'float32')." % (dtype))
+
+        self.dt           = dt              # ms, time step of the traces
+        self.lambda0      = lambda0         # Hz, firing intensity for X(t)beta = 0
+
+        self.method       = method          # 'Newton' or 'L-BFGS'
+        self.maxIter      = maxIter         # maximum number of iterations
+        self.stopCond     = stopCond        # convergence criterion on the gradient (see maximizeLikelihood)
+
+        self.dtype        = dtype           # 'double' or 'float32', precision in which the matrices X are stored
+        self.chunk_size   = chunk_size      # number of rows of X processed at once (see computeLikelihoodGradientHessian_trace)
+
+        self.all_X            = []          # for each trace, the matrix X
+        self.all_X_spikes     = []          # for each trace, the rows of X in which a spike was observed
+        self.all_sum_X_spikes = []          # for each trace, the sum of X_spikes over spikes
+
+        self.T_tot        = 0.0             # s, total duration of the traces used in the fit
+        self.N_spikes_tot = 0.0             # total number of spikes used in the fit
+
+        # Result of the last call to maximizeLikelihood
+        self.beta         = None
+        self.L_norm       = None            # bit/spike, normalized log-likelihood
+        self.iterations   = 0
+        self.converged    = False
+
+
+    def addTrace(self, X, X_spikes, sum_X_spikes, N_spikes, T):
+
+        """
+        Add a trace to the fit. The parameters are returned by the functions buildXmatrix of the models
+        (e.g., GIF.buildXmatrix_dynamicThreshold). T is the duration (in s) of the trace used in the fit.
+        X is stored with the precision defined by self.dtype ('float32' halves the memory used by the fit).
+        """
+
+        if self.dtype != 'double' :
+
+            # Round X_spikes like X, so that the gradient vanishes at the maximum of the likelihood of the stored data
+            X_spikes     = np.asarray(X_spikes, dtype=self.dtype)
+            sum_X_spikes = np.sum(X_spikes, axis=0, dtype='double')
+
+        self.all_X.append(np.asarray(X, dtype=self.dtype))
+        self.all_X_spikes.append(X_spikes)
+        self.all_sum_X_spikes.append(sum_X_spikes)
+
+        self.T_tot        += T
+        self.N_spikes_tot += N_spikes
+
+
+    def getNbOfTraces(self):
+
+        return len(self.all_X)
+
+
+    def getLogLikelihoodPoisson(self):
+
+        """
+        Return the log-likelihood of a Poisson process spiking at the experimental firing rate.
+        This quantity is used to normalize the model log-likelihood.
+        """
+
+        return self.N_spikes_tot*(np.log(self.N_spikes_tot/self.T_tot)-1)
+
+
+    def normalizeLikelihood(self, L):
+
+        """
+        Normalize the log-likelihood L with respect to a Poisson process. The result is in bit/spike.
+        """
+
+        return (L - self.getLogLikelihoodPoisson())/np.log(2)/self.N_spikes_tot
+
+
+    ########################################################################################################
+    # LOG-LIKELIHOOD, GRADIENT AND HESSIAN
+    ########################################################################################################
+
+    def computeLikelihood(self, beta):
+
+        """
+        Compute the log-likelihood defined in Eq. 20 of Pozzorini et al. PLOS Comp. Biol. 2015 (sum over all traces).
+        """
+
+        return self.computeLikelihood_allTraces(beta, 0)[0]
+
+
+    def computeLikelihoodGradient(self, beta):
+
+        """
+        Compute the log-likelihood and its gradient (sum over all traces).
+        """
+
+        return self.computeLikelihood_allTraces(beta, 1)
+
+
+    def computeLikelihoodGradientHessian(self, beta):
+
+        """
+        Compute the log-likelihood, its gradient and its Hessian (sum over all traces).
+        """
+
+        return self.computeLikelihood_allTraces(beta, 2)
+
+
+    def computeLikelihood_allTraces(self, beta, order):
+
+        """
+        Compute the log-likelihood and, depending on order (0, 1 or 2), its gradient and its Hessian (sum over all traces).
+        Since differentiation is linear: gradient of sum = sum of gradient ; hessian of sum = sum of hessian.
+        """
+
+        result = None
+
+        for trace_i in np.arange(self.getNbOfTraces()) :
+
+            result_tmp = PoissonGLM.computeLikelihoodGradientHessian_trace(beta, self.all_X[trace_i], self.all_X_spikes[trace_i], self.all_sum_X_spikes[trace_i],
+                                                                           self.dt, self.lambda0, order=order, chunk_size=self.chunk_size)
+
+            if result is None :
+                result = result_tmp
+            else :
+                result = tuple([ r + r_tmp for (r, r_tmp) in zip(result, result_tmp) ])
+
+        return result
+
+
+    @staticmethod
+    def computeLikelihoodGradientHessian_trace(beta, X, X_spikes, sum_X_spikes, dt, lambda0=1.0, order=2, chunk_size=2**14):
+
+        """
+        Compute the log-likelihood, its gradient and hessian on an individual trace (dt in ms).
+        Return (L,), (L,G) or (L,G,H) depending on order (0, 1 or 2).
+
+        The three quantities are computed in a single pass over blocks of chunk_size rows of X. Only the current block is
+        converted to double precision and weighted by exp(X beta), so that the memory used does not depend on the length of the trace
+        (X can be stored in float32, see PoissonGLM.addTrace). The sums are accumulated in double precision.
+        """
+
+        # IMPORTANT: in general we assume that the lambda_0 = 1 Hz
+        # The parameter lambda0 is redundant with Vt_star, so only one of those has to be fitted.
+        # We genearlly fix lambda_0 adn fit Vt_star
+
+        dt = dt/1000.0          # put dt in units of seconds (to be consistent with lambda_0)
+
+        beta = np.asarray(beta, dtype='double')
+
+        # Terms associated with the spikes (see Eq. 20 Pozzorini et al. 2015)
+        L = np.sum(np.dot(np.asarray(X_spikes, dtype='double'), beta))
+        G = np.array(sum_X_spikes, dtype='double')
+        H = np.zeros( (len(beta), len(beta)) )
+
+        # Terms associated with the firing intensity, one block of rows at a time
+        for r in np.arange(0, len(X), chunk_size) :
+
+            X_tmp      = np.asarray(X[r:r+chunk_size], dtype='double')
+            lambdadt   = lambda0*dt*np.exp(np.dot(X_tmp, beta))
+
+            L -= np.sum(lambdadt)
+
+            if order >= 1 :
+                G -= np.dot(lambdadt, X_tmp)
+
+            if order >= 2 :
+                H -= np.dot(np.transpose(X_tmp)*lambdadt, X_tmp)
+
+        return (L, G, H)[:order+1]
+
+
+    def computeLikelihoodDerivative(self, beta, all_dXbeta, all_dXbeta_spikes):
+
+        """
+        Compute the derivative of the log-likelihood with respect to parameters q on which the matrices X depend (e.g., the
+        parameters of a nonlinear filter used to build a column of X), for fixed beta.
+        For each trace, all_dXbeta contains the matrix (one row per row of X, one column per parameter) of the derivatives of X beta
+        with respect to q, and all_dXbeta_spikes its rows in which a spike was observed.
+
+        If beta maximizes the likelihood for the current q, this is the derivative of the profile log-likelihood max_beta L(beta, q).
+        """
+
+        dt = self.dt/1000.0
+
+        dL = 0.0
+
+        for trace_i in np.arange(self.getNbOfTraces()) :
+
+            dL += np.sum(all_dXbeta_spikes[trace_i], axis=0)
+
+            for r in np.arange(0, len(self.all_X[trace_i]), self.chunk_size) :
+
+                X_tmp    = np.asarray(self.all_X[trace_i][r:r+self.chunk_size], dtype='double')
+                lambdadt = self.lambda0*dt*np.exp(np.dot(X_tmp, beta))
+
+                dL -= np.dot(lambdadt, all_dXbeta[trace_i][r:r+self.chunk_size])
+
+        return dL
+
+
+    ########################################################################################################
+    # MAXIMIZATION
+    ########################################################################################################
+
+    def maximizeLikelihood(self, beta0):
+
+        """
+        Maximize the log-likelihood starting from beta0 and return the optimal parameters beta.
+        The normalized log-likelihood (bit/spike), the number of iterations and whether the fit converged
+        are stored in self.L_norm, self.iterations and self.converged.
+        """
+
+        print "Maximize log-likelihood (bit/spks)..."
+
+        beta0 = np.array(beta0, dtype='double')
+
+        if self.method == 'Newton' :
+            self.maximizeLikelihood_Newton(beta0)
+        else :
+            self.maximizeLikelihood_LBFGS(beta0)
+
+        if self.converged :
+            print "\nConverged after %d iterations!\n" % (self.iterations)
+        else :
+            print "\nNot converged after %d iterations.\n" % (self.iterations)
+
+        return self.beta
+
+
+    def isConverged(self, G):
+
+        return np.max(np.abs(G))/self.N_spikes_tot < self.stopCond
+
+
+    def maximizeLikelihood_Newton(self, beta0, alpha=10**-4, step_min=10**-10):
+
+        """
+        Newton method with backtracking line search. alpha is the fraction of the increase predicted by the
+        linear approximation of the log-likelihood that each step has to achieve (Armijo condition).
+        """
+
+        beta = beta0
+        (L, G, H) = self.computeLikelihoodGradientHessian(beta)
+
+        self.converged = False
+
+        i = -1                          # number of iterations - 1 (no iteration if maxIter = 0)
+
+        for i in range(self.maxIter) :
+
+            L_norm = self.normalizeLikelihood(L)
+            reprint(L_norm)
+
+            if math.isnan(L_norm) :
+                print "Problem during gradient ascent. Optimizatino stopped."
+                break
+
+            if self.isConverged(G) :
+                self.converged = True
+                break
+
+            # Newton direction d = -H^-1 G (-H is positive definite unless X is rank deficient)
+            try :
+                d = cho_solve(cho_factor(-H), G)
+            except LinAlgError :
+                d = np.linalg.lstsq(-H, G, rcond=-1)[0]
+
+            # Backtracking line search
+            slope = np.dot(G, d)
+            step  = 1.0
+
+            while step > step_min :
+
+                beta_new = beta + step*d
+                L_new    = self.computeLikelihood(beta_new)
+
+                if L_new >= L + alpha*step*slope :
+                    break
+
+                step = step/2.0
+
+            if step <= step_min :
+                print "\nLine search failed. Optimization stopped."
+                break
+
+            beta = beta_new
+            (L, G, H) = self.computeLikelihoodGradientHessian(beta)
+
+        self.beta       = beta
+        self.L_norm     = self.normalizeLikelihood(L)
+        self.iterations = i+1
+
+
+    def maximizeLikelihood_LBFGS(self, beta0, memory=10):
+
+        """
+        L-BFGS method (scipy.optimize.fmin_l_bfgs_b) keeping the last memory updates to approximate the Hessian.
+        The columns of X have very different scales (e.g., V and 1), so the problem is preconditioned with the
+        Cholesky factor R of the Hessian at beta0 (beta = beta0 + R^-1 z). The Hessian is computed only once.
+        stopCond applies to the gradient with respect to z (R^-T G), not to the gradient with respect to beta used by Newton.
+        """
+
+        (L0, G0, H0) = self.computeLikelihoodGradientHessian(beta0)
+
+        try :
+            R = cho_factor(-H0, lower=False)[0]
+            R = np.triu(R)
+        except LinAlgError :
+            R = np.diag(np.sqrt(np.abs(np.diag(H0))) + 10**-12)
+
+        # fmin_l_bfgs_b minimizes: use the negative log-likelihood (normalized by the number of spikes)
+        def f(z) :
+            (L, G) = self.computeLikelihoodGradient(beta0 + solve_triangular(R, z))
+            return (-L/self.N_spikes_tot, -solve_triangular(R, G, trans='T')/self.N_spikes_tot)
+
+        (z, f_opt, info) = fmin_l_bfgs_b(f, np.zeros(len(beta0)), m=memory, pgtol=self.stopCond, factr=10.0, maxiter=self.maxIter)
+
+        self.beta       = beta0 + solve_triangular(R, z)
+        self.L_norm     = self.normalizeLikelihood(-f_opt*self.N_spikes_tot)
+        self.iterations = info['nit']
+        self.converged  = (info['warnflag'] == 0)
+
+        reprint(self.L_norm)
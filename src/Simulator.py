@@ -0,0 +1,832 @@
+import numpy as np
+
+from GIF import *
+from gGIF import *
+from iGIF_NP import *
+from iGIF_Na import *
+
+import Tools
+from Tools import philox_uniform, sampler_reset, sample_spike
+from Kernel import *
+
+
+class Simulator :
+
+    """
+    Stateful simulator of a GIF model (GIF, gGIF, iGIF_NP or iGIF_Na) driven by an input current that is
+    provided chunk by chunk (e.g., very long or streamed stimuli):
+
+        simulator = Simulator(model, seed=1)
+
+        for I_chunk in chunks :
+            (time, V, eta_sum, V_T, spks) = simulator.step(I_chunk)
+
+    The state of the model (membrane potential, refractory period, threshold coupling and spike-triggered
+    processes eta and gamma) is carried from one chunk to the next. The spike-triggered processes are simulated as
+    in the other kernels (see Tools.adaptation_support_code) but their state is stored in ring buffers of the length
+    of the interpolated filters, so that memory does not depend on the duration of the simulation, only on the
+    length of the chunks.
+
+    The random numbers are defined by seed and stream (see Tools.philox_support_code) and by the absolute time
+    index. As a consequence, the result does not depend on how the input current is split into chunks and is
+    identical to model.simulate_batch(I, V0, 1, seed=seed, rep0=stream) (except at the last time step, where
+    simulate_batch never emits spikes).
+
+    The output of the simulator is defined by output:
+    - 'traces'      : spike times and traces V, eta_sum and V_T, sampled every decimation time steps
+    - 'V_at_spikes' : spike times and values of V and V_T at the spike times
+    - 'spikes'      : spike times only
+    In the last two cases no trace is returned (the kernel only stores the traces of the current chunk).
+    """
+
+    outputs = ['traces', 'V_at_spikes', 'spikes']
+
+
+    def __init__(self, model, V0=None, seed=None, stream=0, output='traces', decimation=1):
+
+        if output not in Simulator.outputs :
+            raise ValueError("Unknown output %s (must be one of %s)." % (output, ', '.join(Simulator.outputs)))
+
+        self.model       = model                # GIF model to simulate (dt defined by model.dt)
+
+        self.V0          = V0                   # mV, initial condition (by default model.El)
+
+        self.seed        = seed                 # seed of the random number generator (by default drawn from numpy.random)
+
+        self.stream      = stream               # stream of the random number generator used by this simulator
+
+        self.output      = output               # quantities returned by step (see above)
+
+        self.decimation  = int(decimation)      # traces are sampled every decimation time steps (output='traces')
+
+        self.reset()
+
+
+    def reset(self):
+
+        """
+        Restart the simulation from t=0 (the model parameters and the filters are read again from the model).
+        """
+
+        model = self.model
+
+        if self.V0 == None :
+            self.V0 = model.El
+
+        if self.seed == None :
+            self.seed = Tools.getRandomSeed()
+
+        self.Tref_ind = int(np.float32(model.Tref)/np.float32(model.dt))
+
+        # Number of time steps after the end of a chunk whose values can be computed before the next chunk
+        # (refractory period and look-ahead of the threshold)
+        self.carry_l  = self.Tref_ind + 2
+
+        # Spike-triggered processes (see ring_support_code)
+        (self.eta, self.eta_chg, self.eta_b, self.eta_d)       = model.eta.getSpikeUpdate(model.dt)
+        (self.gamma, self.gamma_chg, self.gamma_b, self.gamma_d) = model.gamma.getSpikeUpdate(model.dt)
+
+        self.eta_evt       = np.zeros(len(self.eta)+1, dtype="int32")
+        self.eta_starts    = np.zeros(Tools.getMaxSpikeNb(len(self.eta)+1, model.Tref, model.dt), dtype="int32")
+        self.eta_exp       = np.zeros(len(self.eta_b))
+        self.eta_state_i   = np.zeros(3, dtype="int32")
+        self.eta_state_d   = np.zeros(1)
+
+        self.gamma_evt     = np.zeros(len(self.gamma)+1, dtype="int32")
+        self.gamma_starts  = np.zeros(Tools.getMaxSpikeNb(len(self.gamma)+1, model.Tref, model.dt), dtype="int32")
+        self.gamma_exp     = np.zeros(len(self.gamma_b))
+        self.gamma_state_i = np.zeros(3, dtype="int32")
+        self.gamma_state_d = np.zeros(1)
+
+        # Threshold coupling
+        if isinstance(model, iGIF_NP) :
+            self.theta_type = 1
+            self.theta      = np.zeros(len(model.theta_bins)-1)
+        elif isinstance(model, iGIF_Na) :
+            self.theta_type = 2
+            self.theta      = np.zeros(1)
+        else :
+            self.theta_type = 0
+            self.theta      = np.zeros(1)
+
+        # Values computed beyond the end of the previous chunk
+        self.V_carry      = np.zeros(self.carry_l)
+        self.V_carry[0]   = self.V0
+        self.eta_carry    = np.zeros(self.carry_l)
+        self.gamma_carry  = np.zeros(self.carry_l)
+        self.theta_carry  = np.zeros(self.carry_l)
+
+        self.t0     = 0                                          # time index of the beginning of the next chunk
+        self.state_i = np.array([0], dtype="int32")              # time index of the next integration step
+
+        # Spike sampler (see Tools.sampler_support_code)
+        self.sampler_i = np.zeros(1, dtype="int32")
+        self.sampler_d = np.zeros(2)
+
+
+    def step(self, I):
+
+        """
+        Simulate the response of the model to the next chunk of input current I (nA).
+        If output='traces', the function returns (for the time steps of the chunk):
+        - time     : ms, support for V, eta_sum, V_T (every decimation time steps)
+        - V        : mV, membrane potential (0 during the refractory period, as in GIF.simulate)
+        - eta_sum  : nA, adaptation current
+        - V_T      : mV, firing threshold
+        - spks     : ms, spike times emitted during the chunk
+        If output='V_at_spikes', the function returns:
+        - spks     : ms, spike times emitted during the chunk
+        - V_spks   : mV, membrane potential at the spike times
+        - V_T_spks : mV, firing threshold at the spike times
+        If output='spikes', the function returns spks.
+        """
+
+        model = self.model
+
+        # Input parameters
+        p_T         = len(I)
+        p_t0        = self.t0
+        p_dt        = model.dt
+        p_exact     = int(model.getIntegrator() == 'exact')
+        p_rescaling = int(model.getSampling() == 'rescaling')
+
+        # Model parameters
+        p_gl        = model.gl
+        p_C         = model.C
+        p_El        = model.El
+        p_Vr        = model.Vr
+        p_Tref      = model.Tref
+        p_Vt_star   = model.Vt_star
+        p_DV        = model.DV
+        p_lambda0   = model.lambda0
+
+        p_cond      = int(isinstance(model, gGIF))
+        p_Ek        = model.Ek if p_cond else 0.0
+
+        # Threshold coupling
+        p_theta_type = self.theta_type
+        p_theta_tau  = getattr(model, 'theta_tau', 1.0)
+        p_theta_ka   = getattr(model, 'theta_ka', 0.0)
+        p_theta_ki   = getattr(model, 'theta_ki', 1.0)
+        p_theta_Vi   = getattr(model, 'theta_Vi', 0.0)
+        R            = len(self.theta) if self.theta_type == 1 else 0
+        p_theta_bins = np.array(getattr(model, 'theta_bins', np.zeros(1)), dtype="double")
+        p_theta_i    = np.array(getattr(model, 'theta_i', np.zeros(1)), dtype="double")
+        theta        = self.theta
+
+        # Spike-triggered processes
+        p_eta         = self.eta
+        p_eta_l       = len(p_eta)
+        p_eta_chg     = self.eta_chg
+        p_eta_chg_l   = len(p_eta_chg)
+        p_eta_b       = self.eta_b
+        p_eta_d       = self.eta_d
+        p_eta_R       = len(p_eta_b)
+        eta_evt       = self.eta_evt
+        eta_starts    = self.eta_starts
+        p_eta_starts_max = len(eta_starts)
+        eta_exp       = self.eta_exp
+        eta_state_i   = self.eta_state_i
+        eta_state_d   = self.eta_state_d
+
+        p_gamma       = self.gamma
+        p_gamma_l     = len(p_gamma)
+        p_gamma_chg   = self.gamma_chg
+        p_gamma_chg_l = len(p_gamma_chg)
+        p_gamma_b     = self.gamma_b
+        p_gamma_d     = self.gamma_d
+        p_gamma_R     = len(p_gamma_b)
+        gamma_evt     = self.gamma_evt
+        gamma_starts  = self.gamma_starts
+        p_gamma_starts_max = len(gamma_starts)
+        gamma_exp     = self.gamma_exp
+        gamma_state_i = self.gamma_state_i
+        gamma_state_d = self.gamma_state_d
+
+        state_i     = self.state_i
+
+        # Random number generator
+        p_seed      = self.seed
+        p_stream    = self.stream
+        sampler_i   = self.sampler_i
+        sampler_d   = self.sampler_d
+
+        # Define arrays (chunk followed by the values computed beyond its end)
+        I = np.array(I, dtype="double")
+
+        V           = np.zeros(p_T + self.carry_l)
+        eta_sum     = np.zeros(p_T + self.carry_l)
+        gamma_sum   = np.zeros(p_T + self.carry_l)
+        theta_trace = np.zeros(p_T + self.carry_l)
+
+        V[:self.carry_l]           = self.V_carry
+        eta_sum[:self.carry_l]     = self.eta_carry
+        gamma_sum[:self.carry_l]   = self.gamma_carry
+        theta_trace[:self.carry_l] = self.theta_carry
+
+        p_spks_max  = Tools.getMaxSpikeNb(p_T + self.carry_l, p_Tref, p_dt)
+        spks_i      = np.array(np.zeros(p_spks_max), dtype="int32")
+        spks_V      = np.array(np.zeros(p_spks_max), dtype="double")
+        spks_VT     = np.array(np.zeros(p_spks_max), dtype="double")
+        spks_nb     = np.array(np.zeros(1), dtype="int32")
+
+        kernel_Simulator_step.run(locals())
+
+        self.V_carry     = V[p_T:].copy()
+        self.eta_carry   = eta_sum[p_T:].copy()
+        self.gamma_carry = gamma_sum[p_T:].copy()
+        self.theta_carry = theta_trace[p_T:].copy()
+
+        self.t0 += p_T
+
+        spks = spks_i[:spks_nb[0]]*p_dt
+
+        if self.output == 'spikes' :
+            return spks
+
+        if self.output == 'V_at_spikes' :
+            return (spks, spks_V[:spks_nb[0]], spks_VT[:spks_nb[0]])
+
+        # Traces are sampled at the time indices that are multiples of decimation
+        sel  = np.arange((-p_t0) % self.decimation, p_T, self.decimation)
+
+        time = (p_t0 + sel)*p_dt
+        V_T  = gamma_sum[sel] + p_Vt_star + theta_trace[sel]
+
+        return (time, V[sel], eta_sum[sel], V_T, spks)
+
+
+    def run(self, I, chunk_size=10**5):
+
+        """
+        Simulate the response of the model to the input current I (nA), chunk_size time steps at a time, and
+        concatenate the outputs of step (see step).
+        As in GIF.simulate, spikes emitted at the last time step of I are discarded.
+        """
+
+        T_ind   = self.t0 + len(I)
+
+        outputs = [ self.step(I[c:c+chunk_size]) for c in np.arange(0, len(I), chunk_size) ]
+
+        if self.output == 'spikes' :
+            outputs = [ (o,) for o in outputs ]
+
+        results = [ np.concatenate([ o[k] for o in outputs ]) for k in range(len(outputs[0])) ]
+
+        # Select the spikes emitted before the last time step
+        spks_k  = 4 if self.output == 'traces' else 0
+        keep    = results[spks_k] < (T_ind - 1.5)*self.model.dt
+
+        if self.output == 'traces' :
+            results[spks_k] = results[spks_k][keep]
+        else :
+            results = [ r[keep] for r in results ]
+
+        if self.output == 'spikes' :
+            return results[0]
+
+        return tuple(results)
+
+
+########################################################################################################
+# KERNELS (see Kernel)
+########################################################################################################
+
+# Spike-triggered processes of the stateful simulator. Same algorithm as Tools.adaptation_support_code, except that
+# the arrays whose size depended on the duration of the simulation are replaced by ring buffers: the change points
+# (evt) are counted in a ring buffer of L+1 time steps and the times at which the effect of the spikes starts are
+# stored in a ring buffer of starts_max spikes (the number of spikes that can occur during L time steps).
+# The value of the process is stored in a chunk (out) starting at the time index t0. The values are identical
+# to those computed by Tools.adaptation_support_code.
+
+ring_support_code = """
+
+struct RingProcess {
+
+    double* out;            // value of the process in the current chunk
+    int     t0;
+
+    double* f_tab;          // interpolated filter and its change points
+    int     L;
+    int*    chg;
+    int     chg_l;
+    int*    evt;            // number of change points at each time index (ring buffer of L+1 time steps)
+    int*    starts;         // time indices at which the effect of the spikes starts (ring buffer of starts_max spikes)
+    int     starts_max;
+    int     starts_nb;
+    int     first;          // first spike whose effect is not over
+    double  value;          // current contribution of the interpolated filter
+
+    double* b;              // exponential components
+    double* d;
+    double* x;
+    int     R;
+
+    int     u_next;         // first time index at which the value has not been computed yet
+};
+
+
+void ring_init(RingProcess* p, double* out, int t0, double* f_tab, int L, int* chg, int chg_l, int* evt, int* starts, int starts_max, double* b, double* d, double* x, int R, int* state_i, double* state_d) {
+
+    p->out = out;       p->t0 = t0;
+    p->f_tab = f_tab;   p->L = L;   p->chg = chg;   p->chg_l = chg_l;
+    p->evt = evt;       p->starts = starts;         p->starts_max = starts_max;
+    p->b = b;           p->d = d;   p->x = x;       p->R = R;
+
+    p->starts_nb = state_i[0];
+    p->first     = state_i[1];
+    p->u_next    = state_i[2];
+    p->value     = state_d[0];
+}
+
+
+void ring_save(RingProcess* p, int* state_i, double* state_d) {
+
+    state_i[0] = p->starts_nb;
+    state_i[1] = p->first;
+    state_i[2] = p->u_next;
+    state_d[0] = p->value;
+}
+
+
+void ring_advance(RingProcess* p, int u1) {
+
+    // Compute the process up to the time index u1 (excluded).
+
+    for (int u=p->u_next; u<u1; u++) {
+
+        if (p->L > 0 && p->evt[u % (p->L+1)] > 0) {
+
+            p->evt[u % (p->L+1)] = 0;
+
+            int j = p->first % p->starts_max;                 // position of the first spike in the ring buffer starts
+
+            while (p->first < p->starts_nb && p->starts[j] + p->L <= u) {
+                p->first++;
+                j = (j+1 < p->starts_max) ? j+1 : 0;
+            }
+
+            int n  = p->starts_nb - p->first;                 // the active spikes are starts[j:j+n1] and starts[0:n-n1]
+            int n1 = (j+n < p->starts_max) ? n : p->starts_max-j;
+
+            double v = 0.0;
+            for (int c=j; c<j+n1; c++)
+                v += p->f_tab[u - p->starts[c]];
+            for (int c=0; c<n-n1; c++)
+                v += p->f_tab[u - p->starts[c]];
+
+            p->value = v;
+        }
+
+        double v = 0.0;
+        v += p->value;
+
+        for (int k=0; k<p->R; k++) {
+            v += p->x[k];
+            p->x[k] *= p->d[k];
+        }
+
+        p->out[u - p->t0] = v;
+    }
+
+    if (u1 > p->u_next)
+        p->u_next = u1;
+}
+
+
+double ring_value(RingProcess* p, int u) {
+
+    // Return the value of the process at the time index u <= u_next (the process is not advanced).
+
+    if (u < p->u_next)
+        return p->out[u - p->t0];
+
+    double value = p->value;
+
+    if (p->L > 0 && p->evt[u % (p->L+1)] > 0) {
+
+        value = 0.0;
+        for (int j=p->first; j<p->starts_nb; j++) {
+            if (p->starts[j % p->starts_max] + p->L > u)
+                value += p->f_tab[u - p->starts[j % p->starts_max]];
+        }
+    }
+
+    double v = 0.0;
+    v += value;
+
+    for (int k=0; k<p->R; k++)
+        v += p->x[k];
+
+    return v;
+}
+
+
+void ring_spike(RingProcess* p, int s) {
+
+    // Add a spike whose effect starts at the time index s.
+    // If the process has already been computed at s (s < u_next), its values are corrected.
+
+    ring_advance(p, s);
+
+    if (p->L > 0 && p->starts_nb - p->first < p->starts_max) {
+
+        p->starts[p->starts_nb % p->starts_max] = s;
+        p->starts_nb++;
+
+        for (int c=0; c<p->chg_l; c++) {
+
+            int u = s + p->chg[c];
+
+            if (u >= p->u_next)
+                p->evt[u % (p->L+1)]++;
+        }
+
+        for (int u=s; u<p->u_next && u<s+p->L; u++) {
+
+            p->out[u - p->t0] += p->f_tab[u-s];
+
+            if (u == p->u_next-1)
+                p->value += p->f_tab[u-s];
+        }
+    }
+
+    for (int k=0; k<p->R; k++) {
+
+        double xs = p->b[k];
+
+        for (int u=s; u<p->u_next; u++) {
+            p->out[u - p->t0] += xs;
+            xs *= p->d[k];
+        }
+
+        p->x[k] += xs;
+    }
+}
+
+"""
+
+
+# Python implementation of the functions above. A process is represented by the tuple
+# (out, t0, f_tab, chg, evt, starts, b, d, x, state_i, state_d) where state_i = [starts_nb, first, u_next] and
+# state_d = [value] (the state is stored in these arrays, which are kept by the Simulator between chunks).
+
+def ring_advance(proc, u1):
+
+    (out, t0, f_tab, chg, evt, starts, b, d, x, state_i, state_d) = proc
+
+    L          = len(f_tab)
+    R          = len(b)
+    starts_max = len(starts)
+
+    starts_nb = state_i[0]
+    first     = state_i[1]
+    value     = state_d[0]
+
+    for u in range(state_i[2], u1) :
+
+        if L > 0 and evt[u % (L+1)] > 0 :
+
+            evt[u % (L+1)] = 0
+
+            while first < starts_nb and starts[first % starts_max] + L <= u :
+                first += 1
+
+            v = 0.0
+            for j in range(first, starts_nb) :
+                v += f_tab[u - starts[j % starts_max]]
+
+            value = v
+
+        v = 0.0
+        v += value
+
+        for k in range(R) :
+            v += x[k]
+            x[k] *= d[k]
+
+        out[u - t0] = v
+
+    state_i[1] = first
+    state_d[0] = value
+
+    if u1 > state_i[2] :
+        state_i[2] = u1
+
+
+def ring_value(proc, u):
+
+    (out, t0, f_tab, chg, evt, starts, b, d, x, state_i, state_d) = proc
+
+    if u < state_i[2] :
+        return out[u - t0]
+
+    L          = len(f_tab)
+    starts_max = len(starts)
+
+    value = state_d[0]
+
+    if L > 0 and evt[u % (L+1)] > 0 :
+
+        value = 0.0
+        for j in range(state_i[1], state_i[0]) :
+            if starts[j % starts_max] + L > u :
+                value += f_tab[u - starts[j % starts_max]]
+
+    v = 0.0
+    v += value
+
+    for k in range(len(b)) :
+        v += x[k]
+
+    return v
+
+
+def ring_spike(proc, s):
+
+    (out, t0, f_tab, chg, evt, starts, b, d, x, state_i, state_d) = proc
+
+    ring_advance(proc, s)
+
+    L          = len(f_tab)
+    R          = len(b)
+    starts_max = len(starts)
+
+    u_next = state_i[2]
+
+    if L > 0 and state_i[0] - state_i[1] < starts_max :
+
+        starts[state_i[0] % starts_max] = s
+        state_i[0] += 1
+
+        for c in range(len(chg)) :
+
+            u = s + chg[c]
+
+            if u >= u_next :
+                evt[u % (L+1)] += 1
+
+        for u in range(s, min(u_next, s + L)) :
+
+            out[u - t0] += f_tab[u-s]
+
+            if u == u_next-1 :
+                state_d[0] += f_tab[u-s]
+
+    for k in range(R) :
+
+        xs = b[k]
+
+        for u in range(s, u_next) :
+            out[u - t0] += xs
+            xs *= d[k]
+
+        x[k] += xs
+
+
+def ring_new(out, t0, f_tab, chg, evt, starts, b, d, x, state_i, state_d):
+
+    """
+    Return the tuple representing a spike-triggered process (the arrays are not copied).
+    """
+
+    return (out, t0, f_tab, chg, evt, starts, b, d, x, state_i, state_d)
+
+
+def Simulator_step_ref(p_T, p_t0, state_i, p_dt, p_exact, p_rescaling, p_gl, p_C, p_El, p_Ek, p_cond, p_Vr, p_Tref, p_Vt_star, p_DV, p_lambda0,
+                       p_theta_type, p_theta_tau, p_theta_ka, p_theta_ki, p_theta_Vi, R, p_theta_bins, p_theta_i, theta,
+                       V, I, theta_trace,
+                       p_eta, p_eta_l, p_eta_chg, p_eta_chg_l, eta_evt, eta_starts, p_eta_starts_max, p_eta_b, p_eta_d, p_eta_R,
+                       eta_exp, eta_state_i, eta_state_d, eta_sum,
+                       p_gamma, p_gamma_l, p_gamma_chg, p_gamma_chg_l, gamma_evt, gamma_starts, p_gamma_starts_max, p_gamma_b, p_gamma_d, p_gamma_R,
+                       gamma_exp, gamma_state_i, gamma_state_d, gamma_sum,
+                       sampler_i, sampler_d, p_seed, p_stream, p_spks_max, spks_i, spks_V, spks_VT, spks_nb):
+
+    t0       = p_t0
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    dtC = p_dt/p_C
+    if p_exact == 1 :
+        dtC = -np.expm1(-p_dt*p_gl/p_C)/p_gl
+
+    theta_taufactor = 1.0 - p_dt/p_theta_tau
+
+    gamma_lag = 0
+    if p_theta_type == 1 :
+        gamma_lag = 1
+
+    eta_proc   = ring_new(eta_sum, t0, p_eta, p_eta_chg, eta_evt, eta_starts, p_eta_b, p_eta_d, eta_exp, eta_state_i, eta_state_d)
+    gamma_proc = ring_new(gamma_sum, t0, p_gamma, p_gamma_chg, gamma_evt, gamma_starts, p_gamma_b, p_gamma_d, gamma_exp, gamma_state_i, gamma_state_d)
+
+    spks_cnt = 0
+
+    t = state_i[0]
+    while t < t0 + p_T :
+
+        i = t - t0
+
+        # COMPUTE ADAPTATION PROCESSES
+        ring_advance(eta_proc, t+1)
+        ring_advance(gamma_proc, t+1+gamma_lag)
+
+        # INTEGRATE VOLTAGE
+        if p_exact == 1 and p_cond == 1 :
+            g = p_gl + eta_sum[i]
+            dtC = -np.expm1(-p_dt*g/p_C)/g if g != 0.0 else p_dt/p_C
+        if p_cond == 1 :
+            V[i+1] = V[i] + dtC*( -p_gl*(V[i] - p_El) + I[i] - eta_sum[i]*(V[i]-p_Ek) )
+        else :
+            V[i+1] = V[i] + dtC*( -p_gl*(V[i] - p_El) + I[i] - eta_sum[i] )
+
+        # INTEGRATE THRESHOLD COUPLING
+        if p_theta_type == 1 :
+
+            theta_tot = 0.0
+            for r in range(R) :
+                theta[r] = theta_taufactor*theta[r]
+                if V[i] >= p_theta_bins[r] and V[i] < p_theta_bins[r+1] :
+                    theta[r] += p_dt/p_theta_tau
+                theta_tot += p_theta_i[r]*theta[r]
+
+            theta_trace[i+1] = theta_tot
+
+        elif p_theta_type == 2 :
+
+            theta_trace[i+1] = theta_trace[i] + p_dt/p_theta_tau*(-theta_trace[i] + p_theta_ka*np.log(1+np.exp((V[i]-p_theta_Vi)/p_theta_ki)))
+
+        # COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+        lambda_t    = p_lambda0*np.exp( (V[i+1]-p_Vt_star-gamma_sum[i+gamma_lag]-theta_trace[i+1])/p_DV )
+
+        # PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+        if sample_spike(p_rescaling, p_seed, p_stream, t, lambda_t, p_dt, sampler_i, sampler_d) :
+
+            k = t+1
+
+            t = t + Tref_ind
+
+            V[t+1-t0] = p_Vr
+
+            if p_theta_type == 1 :
+                for r in range(R) :
+                    theta[r] = 0.0
+
+            # UPDATE ADAPTATION PROCESSES
+            ring_spike(eta_proc, t+1)
+            ring_spike(gamma_proc, t+1)
+
+            # STORE SPIKE (AND STATE AT THE SPIKE)
+            if spks_cnt < p_spks_max :
+                spks_i[spks_cnt]  = k
+                spks_V[spks_cnt]  = V[k-t0]
+                spks_VT[spks_cnt] = ring_value(gamma_proc, k) + p_Vt_star + theta_trace[k-t0]
+                spks_cnt += 1
+
+        t += 1
+
+    state_i[0] = t
+    spks_nb[0] = spks_cnt
+
+
+kernel_Simulator_step = Kernel('Simulator_step',
+        [
+          'int p_T', 'int p_t0', 'int* state_i', 'double p_dt', 'int p_exact', 'int p_rescaling', 'double p_gl', 'double p_C', 'double p_El', 'double p_Ek',
+          'int p_cond', 'double p_Vr', 'double p_Tref', 'double p_Vt_star', 'double p_DV', 'double p_lambda0',
+          'int p_theta_type', 'double p_theta_tau', 'double p_theta_ka', 'double p_theta_ki', 'double p_theta_Vi', 'int R',
+          'double* p_theta_bins', 'double* p_theta_i', 'double* theta', 'double* V', 'double* I', 'double* theta_trace',
+          'double* p_eta', 'int p_eta_l', 'int* p_eta_chg', 'int p_eta_chg_l', 'int* eta_evt', 'int* eta_starts',
+          'int p_eta_starts_max', 'double* p_eta_b', 'double* p_eta_d', 'int p_eta_R', 'double* eta_exp',
+          'int* eta_state_i', 'double* eta_state_d', 'double* eta_sum',
+          'double* p_gamma', 'int p_gamma_l', 'int* p_gamma_chg', 'int p_gamma_chg_l', 'int* gamma_evt', 'int* gamma_starts',
+          'int p_gamma_starts_max', 'double* p_gamma_b', 'double* p_gamma_d', 'int p_gamma_R', 'double* gamma_exp',
+          'int* gamma_state_i', 'double* gamma_state_d', 'double* gamma_sum',
+          'int* sampler_i', 'double* sampler_d', 'int p_seed', 'int p_stream', 'int p_spks_max', 'int* spks_i', 'double* spks_V',
+          'double* spks_VT', 'int* spks_nb'
+        ],
+        """
+
+                int   T_ind      = int(p_T);
+                int   t0         = int(p_t0);
+                float dt         = float(p_dt);
+
+                float gl         = float(p_gl);
+                float C          = float(p_C);
+                float El         = float(p_El);
+                float Ek         = float(p_Ek);
+                float Vr         = float(p_Vr);
+                int   Tref_ind   = int(float(p_Tref)/dt);
+                float dtC        = dt/C;                                     // forward Euler
+                if (p_exact == 1)
+                    dtC = -expm1(-dt*gl/C)/gl;                               // exact integration (I and eta constant during one time step)
+                float Vt_star    = float(p_Vt_star);
+                float DeltaV     = float(p_DV);
+                float lambda0    = float(p_lambda0);
+
+                float theta_tau  = float(p_theta_tau);
+                float theta_ka   = float(p_theta_ka);
+                float theta_ki   = float(p_theta_ki);
+                float theta_Vi   = float(p_theta_Vi);
+
+                float theta_taufactor = (1.0-dt/theta_tau);
+
+                int gamma_lag    = (p_theta_type == 1) ? 1 : 0;
+
+                RingProcess eta_proc;
+                RingProcess gamma_proc;
+                ring_init(&eta_proc, eta_sum, t0, p_eta, int(p_eta_l), p_eta_chg, int(p_eta_chg_l), eta_evt, eta_starts, int(p_eta_starts_max), p_eta_b, p_eta_d, eta_exp, int(p_eta_R), eta_state_i, eta_state_d);
+                ring_init(&gamma_proc, gamma_sum, t0, p_gamma, int(p_gamma_l), p_gamma_chg, int(p_gamma_chg_l), gamma_evt, gamma_starts, int(p_gamma_starts_max), p_gamma_b, p_gamma_d, gamma_exp, int(p_gamma_R), gamma_state_i, gamma_state_d);
+
+                float lambda = 0.0 ;
+
+                int spks_cnt = 0;
+
+                int t = state_i[0];
+
+                while (t < t0 + T_ind) {
+
+                    int i = t - t0;
+
+                    // COMPUTE ADAPTATION PROCESSES
+                    ring_advance(&eta_proc, t+1);
+                    ring_advance(&gamma_proc, t+1+gamma_lag);
+
+
+                    // INTEGRATE VOLTAGE
+                    if (p_exact == 1 && p_cond == 1) {                            // exact integration (conductance constant during one time step)
+                        float g = gl + eta_sum[i];
+                        dtC = (g != 0.0) ? -expm1(-dt*g/C)/g : dt/C;
+                    }
+                    if (p_cond == 1)
+                        V[i+1] = V[i] + dtC*( -gl*(V[i] - El) + I[i] - eta_sum[i]*(V[i]-Ek) );
+                    else
+                        V[i+1] = V[i] + dtC*( -gl*(V[i] - El) + I[i] - eta_sum[i] );
+
+
+                    // INTEGRATE THRESHOLD COUPLING
+                    if (p_theta_type == 1) {
+
+                        for (int r=0; r<R; r++) {
+
+                            theta[r] = theta_taufactor*theta[r];                                 // everybody decay
+
+                            if ( V[i] >= p_theta_bins[r] && V[i] < p_theta_bins[r+1] ) {         // identify who integrates
+                                theta[r] += dt/theta_tau;
+                            }
+                        }
+
+                        float theta_tot = 0.0;
+                        for (int r=0; r<R; r++) {
+                            theta_tot += p_theta_i[r]*theta[r];
+                        }
+
+                        theta_trace[i+1] = theta_tot;
+                    }
+                    else if (p_theta_type == 2) {
+
+                        theta_trace[i+1] = theta_trace[i] + dt/theta_tau*(-theta_trace[i] + theta_ka*log(1+exp((V[i]-theta_Vi)/theta_ki)));
+                    }
+
+
+                    // COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+                    lambda = lambda0*exp( (V[i+1]-Vt_star-gamma_sum[i+gamma_lag]-theta_trace[i+1])/DeltaV );
+
+
+                    // PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+                    if (sample_spike(p_rescaling, (unsigned int)(p_seed), (unsigned int)(p_stream), (unsigned int)(t), lambda, dt, sampler_i, sampler_d)) {
+
+                        int k = t+1;
+
+                        t = t + Tref_ind;
+
+                        V[t+1-t0] = Vr;
+
+                        if (p_theta_type == 1) {
+                            for (int r=0; r<R; r++)
+                                theta[r] = 0.0;
+                        }
+
+                        // UPDATE ADAPTATION PROCESSES
+                        ring_spike(&eta_proc, t+1);
+                        ring_spike(&gamma_proc, t+1);
+
+
+                        // STORE SPIKE (AND STATE AT THE SPIKE)
+                        if (spks_cnt < p_spks_max) {
+                            spks_i[spks_cnt]  = k;
+                            spks_V[spks_cnt]  = V[k-t0];
+                            spks_VT[spks_cnt] = ring_value(&gamma_proc, k) + p_Vt_star + theta_trace[k-t0];
+                            spks_cnt++;
+                        }
+                    }
+
+                    t++;
+                }
+
+                state_i[0] = t;
+                ring_save(&eta_proc, eta_state_i, eta_state_d);
+                ring_save(&gamma_proc, gamma_state_i, gamma_state_d);
+                spks_nb[0] = spks_cnt;
+
+                """,
+        Simulator_step_ref,
+        support_code=ring_support_code + Tools.philox_support_code + Tools.sampler_support_code,
+        helpers=[ring_new, ring_advance, ring_value, ring_spike, philox_uniform, sampler_reset, sample_spike])
@@ -25,6 +25,24 @@ class SpikingModel :
         Return an array containing the spike times (in ms) evoked by an input current I(t). 
         Dt define the sampling frequency at which the simulation is performed.
         """
+        
+        
+    def simulateSpikingResponse_batch(self, I, dt, nb_rep, seed=None, rep0=0):
+        
+        """
+        Return a list of nb_rep arrays containing the spike times (in ms) evoked by nb_rep independent 
+        repetitions of the same input current I(t).
+        Models that can simulate several repetitions more efficiently should override this function.
+        Models whose simulations can be replayed should use the random numbers defined by seed and by 
+        the index rep0+k of each repetition (see GIF.simulate_batch); this default implementation ignores them.
+        """
+        
+        all_spks = []
+        
+        for rep in np.arange(nb_rep) :
+            all_spks.append( self.simulateSpikingResponse(I, dt) )
+            
+        return all_spks
    
    
     def computeFIcurve(self, mu, sigma, tau, dt, T, ROI, nbRep=10):
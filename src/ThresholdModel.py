@@ -26,6 +26,22 @@ class ThresholdModel(SpikingModel) :
         Vt   : voltage threshold trace (in mV)
         """
    
+
+    def simulateVoltageResponse_atSpikes(self, I, dt):
+        
+        """
+        Simulate the model response to an input current I and return:
+        spks    : list of spike times (in ms)
+        V_spks  : voltage at the spike times (in mV)
+        Vt_spks : voltage threshold at the spike times (in mV)
+        Models that can record V and Vt at the spike times without storing the full traces should override this function.
+        """
+        
+        (spks, V, V_T) = self.simulateVoltageResponse(I, dt)
+        spks_i = Tools.timeToIndex(spks, dt)
+        
+        return (spks, V[spks_i], V_T[spks_i])
+    
     
     
     def computeRateAndThreshold_vs_I(self, mu, sigma, tau, dt, T, ROI, nbRep=10):
@@ -58,19 +74,17 @@ class ThresholdModel(SpikingModel) :
         
                     I_tmp = Tools.generateOUprocess(T=T, tau=tau, mu=m, sigma=s, dt=dt)
                     
-                    (spks_t, V, V_T) = self.simulateVoltageResponse(I_tmp, dt)
-                    spks_i = Tools.timeToIndex(spks_t, dt)
+                    (spks_t, V_spks, V_T_spks) = self.simulateVoltageResponse_atSpikes(I_tmp, dt)
         
                     spiks_i_sel = np.where( ( ( spks_t > ROI[0] ) & ( spks_t < ROI[1] ) ) == True)[0] 
-                    spiks_i_sel = spks_i[spiks_i_sel]
                     
                     rate = 1000.0*len(spiks_i_sel)/(ROI[1]-ROI[0])
                     FI_all[s_cnt, m_cnt, r] = rate
                                         
-                    theta = np.mean(V[spiks_i_sel])
+                    theta = np.mean(V_spks[spiks_i_sel])
                     thetaI_all[s_cnt, m_cnt, r] = theta
                     
-                    theta_VT = np.mean(V_T[spiks_i_sel])
+                    theta_VT = np.mean(V_T_spks[spiks_i_sel])
                     thetaI_VT_all[s_cnt, m_cnt, r] = theta_VT
          
                                                             
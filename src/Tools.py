@@ -2,9 +2,12 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from scipy.optimize import leastsq
-from scipy import weave
+from scipy.signal import fftconvolve, lfilter
 
 import sys
+import multiprocessing
+
+from Kernel import *
 
 
 ###########################################################
@@ -52,29 +55,7 @@ def generateOUprocess(T=10000.0, tau=3.0, mu=0.0, sigma=1.0, dt=0.1):
     OU_process = np.zeros(T_ind)
     OU_process = OU_process.astype("double")
     
-
-        
-    code =  """
-    
-            #include <math.h>
-                
-            int cT_ind    = int(T_ind); 
-            float cdt     = float(dt);
-            float ctau    = float(tau);
-            float cmu     = float(mu);            
-            float csigma  = float(sigma);    
-                        
-            float OU_k1 = cdt / ctau ;
-            float OU_k2 = sqrt(2.0*cdt/ctau) ;            
-
-            for (int t=0; t < cT_ind-1; t++) {
-                OU_process[t+1] = OU_process[t] + (cmu - OU_process[t])*OU_k1 +  csigma*OU_k2*white_noise[t] ;
-            }
-            
-            """
-    
-    vars = ['T_ind', 'dt', 'tau', 'sigma','mu', 'OU_process', 'white_noise']
-    v = weave.inline(code,vars)
+    kernel_OUprocess.run(locals())
     
     return OU_process
 
@@ -121,6 +102,33 @@ def generateOUprocess_sinMean(f=1.0, T=10000.0, tau=3.0, mu=0.2, delta_mu=0.5, s
     return I
 
 
+def OUprocess_ref(T_ind, dt, tau, sigma, mu, OU_process, white_noise):
+    
+    OU_k1 = dt / tau 
+    OU_k2 = np.sqrt(2.0*dt/tau) 
+    
+    for t in range(T_ind-1) :
+        OU_process[t+1] = OU_process[t] + (mu - OU_process[t])*OU_k1 +  sigma*OU_k2*white_noise[t]
+    
+    
+kernel_OUprocess = Kernel('OUprocess', ['int T_ind', 'double dt', 'double tau', 'double sigma', 'double mu', 'double* OU_process', 'double* white_noise'],
+            """
+            int cT_ind    = int(T_ind); 
+            float cdt     = float(dt);
+            float ctau    = float(tau);
+            float cmu     = float(mu);            
+            float csigma  = float(sigma);    
+                        
+            float OU_k1 = cdt / ctau ;
+            float OU_k2 = sqrt(2.0*cdt/ctau) ;            
+
+            for (int t=0; t < cT_ind-1; t++) {
+                OU_process[t+1] = OU_process[t] + (cmu - OU_process[t])*OU_k1 +  csigma*OU_k2*white_noise[t] ;
+            }
+            """,
+            OUprocess_ref)
+
+
 ###########################################################
 # Functin to convert spike times in spike indices
 ###########################################################
@@ -133,6 +141,634 @@ def timeToIndex(x_t, dt):
     return x_i 
 
 
+###########################################################
+# Functions to store the spikes of multiple repetitions
+###########################################################
+
+def getMaxSpikeNb(T_ind, Tref, dt):
+    
+    """
+    Return an upper bound on the number of spikes that a model with absolute refractory period Tref (ms)
+    can emit in a simulation of T_ind time steps of size dt (ms).
+    This value is used to preallocate the arrays in which the C kernels store spike indices.
+    """
+    
+    Tref_ind = max(int(Tref/dt) - 1, 0)
+    
+    return int(T_ind/(Tref_ind + 1)) + 1
+
+
+def getRepetitionsPerCall(nb_rep, spks_max, max_size=10**7):
+    
+    """
+    Return the number of repetitions that can be simulated in a single call to a C kernel
+    without allocating more than max_size spike indices.
+    """
+    
+    return int(max(1, min(nb_rep, max_size/spks_max)))
+
+
+def splitSpikeIndices(spks_i, spks_nb, spks_max, dt):
+    
+    """
+    Convert the flat array spks_i filled by a C kernel (spks_max entries per repetition, of which only the 
+    first spks_nb[rep] are used) into a list of arrays of spike times (in ms), one for each repetition.
+    """
+    
+    all_spks = []
+    
+    for rep in np.arange(len(spks_nb)) :
+        
+        all_spks.append( spks_i[ rep*spks_max : rep*spks_max + spks_nb[rep] ]*dt )
+        
+    return all_spks
+
+
+###########################################################
+# Random number generator used by the kernels
+###########################################################
+
+# The stochastic kernels (e.g., GIF.simulate) draw their random numbers from the counter-based generator Philox4x32-10
+# (Salmon et al., SC 2011). The random number used at time step t of repetition (stream) k is a function of (seed, k, t) 
+# only: it does not depend on the other repetitions, on the order in which they are simulated or on the number of 
+# processes/threads used, so that every repetition can be replayed bit for bit.
+
+philox_support_code = """
+double philox_uniform(unsigned int seed, unsigned int stream, unsigned int t) {
+
+    // Philox4x32-10 with counter (t, stream, 0, 0) and key (seed, 0), return a uniform random number in (0,1)
+
+    unsigned int c0 = t;
+    unsigned int c1 = stream;
+    unsigned int c2 = 0;
+    unsigned int c3 = 0;
+    unsigned int k0 = seed;
+    unsigned int k1 = 0;
+
+    for (int i=0; i<10; i++) {
+
+        if (i > 0) {
+            k0 += 0x9E3779B9;
+            k1 += 0xBB67AE85;
+        }
+
+        unsigned long long p0 = 0xD2511F53ULL*c0;
+        unsigned long long p1 = 0xCD9E8D57ULL*c2;
+
+        c0 = (unsigned int)(p1 >> 32) ^ c1 ^ k0;
+        c1 = (unsigned int)(p1);
+        c2 = (unsigned int)(p0 >> 32) ^ c3 ^ k1;
+        c3 = (unsigned int)(p0);
+    }
+
+    return (double(c0) + 0.5)*(1.0/4294967296.0);
+}
+"""
+
+def philox_uniform(seed, stream, t):
+    
+    """
+    Python implementation of philox_uniform (see philox_support_code).
+    """
+    
+    mask = np.uint64(0xFFFFFFFF)
+    s32  = np.uint64(32)
+    
+    c0 = np.uint64(t)
+    c1 = np.uint64(stream)
+    c2 = np.uint64(0)
+    c3 = np.uint64(0)
+    k0 = np.uint64(seed)
+    k1 = np.uint64(0)
+    
+    for i in range(10) :
+        
+        if i > 0 :
+            k0 = (k0 + np.uint64(0x9E3779B9)) & mask
+            k1 = (k1 + np.uint64(0xBB67AE85)) & mask
+            
+        p0 = np.uint64(0xD2511F53)*c0
+        p1 = np.uint64(0xCD9E8D57)*c2
+        
+        c0_new = (p1 >> s32) ^ c1 ^ k0
+        c1     = p1 & mask
+        c2_new = (p0 >> s32) ^ c3 ^ k1
+        c3     = p0 & mask
+        c0     = c0_new
+        c2     = c2_new
+        
+    return (np.float64(c0) + 0.5)*(1.0/4294967296.0)
+
+
+def getRandomSeed():
+    
+    """
+    Return a seed for the random number generator of the kernels drawn from numpy.random
+    (so that simulations are reproducible with numpy.random.seed).
+    """
+    
+    return int(np.random.randint(0, 2**31-1))
+
+
+# Spikes are generated from the firing intensity lambda(t) (Hz) of the models with one of two samplers (see GIF.setSampling):
+#
+# - Bernoulli : at each time step t, a spike is emitted if philox_uniform(seed, k, t) > exp(-lambda(t)*dt). One random
+#               number is drawn per time step.
+#
+# - rescaling : time-rescaling theorem (Brown et al., Neural Comput 2002). The hazard lambda(t)*dt is accumulated since
+#               the end of the last refractory period and a spike is emitted when it exceeds an exponential variate 
+#               -log(philox_uniform(seed, k, n)), where n counts the variates drawn in the repetition (stream) k. 
+#               One random number is drawn per spike. The spike trains have the same distribution as with the 
+#               Bernoulli sampler, but are not identical for the same seed.
+#
+# The state of the sampler is stored in state_i = [n] and state_d = [accumulated hazard, exponential variate], so that 
+# a simulation can be continued from one call to the next (see Simulator).
+
+sampler_support_code = """
+void sampler_reset(int* state_i, double* state_d) {
+
+    state_i[0] = 0;
+    state_d[0] = 0.0;
+    state_d[1] = 0.0;
+}
+
+int sample_spike(int rescaling, unsigned int seed, unsigned int stream, unsigned int t, float lambda, float dt, int* state_i, double* state_d) {
+
+    // return 1 if a spike is emitted at time step t, given the firing intensity lambda (Hz)
+
+    if (rescaling == 0) {
+
+        float p_dontspike = exp(-lambda*(dt/1000.0));                   // since lambda is in Hz, dt must also be in Hz (this is why dt/1000.0)
+
+        return philox_uniform(seed, stream, t) > p_dontspike;
+    }
+
+    if (state_d[1] == 0.0) {
+        state_d[1] = -log(philox_uniform(seed, stream, (unsigned int)(state_i[0])));
+        state_i[0]++;
+    }
+
+    state_d[0] += lambda*(dt/1000.0);
+
+    if (state_d[0] > state_d[1]) {
+        state_d[0] = 0.0;
+        state_d[1] = 0.0;
+        return 1;
+    }
+
+    return 0;
+}
+"""
+
+
+def sampler_reset(state_i, state_d):
+    
+    state_i[0] = 0
+    state_d[0] = 0.0
+    state_d[1] = 0.0
+    
+    
+def sample_spike(rescaling, seed, stream, t, lambda_t, dt, state_i, state_d):
+    
+    """
+    Python implementation of sample_spike (see sampler_support_code).
+    """
+    
+    if rescaling == 0 :
+        
+        p_dontspike = np.exp(-lambda_t*(dt/1000.0))
+        
+        return philox_uniform(seed, stream, t) > p_dontspike
+    
+    if state_d[1] == 0.0 :
+        state_d[1] = -np.log(philox_uniform(seed, stream, state_i[0]))
+        state_i[0] += 1
+        
+    state_d[0] += lambda_t*(dt/1000.0)
+    
+    if state_d[0] > state_d[1] :
+        state_d[0] = 0.0
+        state_d[1] = 0.0
+        return True
+    
+    return False
+
+
+###########################################################
+# Parallel execution
+###########################################################
+
+# Data shared with the worker processes. The workers are created with fork and inherit this variable,
+# so that large objects (e.g., models, input currents) are not pickled for each task.
+parallel_data = None
+
+def parallelMap(function, tasks, n_jobs=1, data=None):
+
+    """
+    Return [ function(data, task) for task in tasks ], computed with n_jobs worker processes (-1: one per CPU).
+    function must be defined at the top level of a module (so that it can be sent to the workers);
+    tasks and results must be picklable. The results are returned in the order of tasks.
+    The workers inherit the kernels already compiled by the calling process (see Kernel.prepare).
+    When called from a worker process (which cannot create processes), the tasks are computed in that process.
+    """
+
+    global parallel_data
+
+    n_jobs = min(getJobsNb(n_jobs), len(tasks))
+
+    if n_jobs <= 1 or multiprocessing.current_process().daemon :
+        return [ function(data, task) for task in tasks ]
+
+    parallel_data = data
+    pool = multiprocessing.Pool(n_jobs)
+
+    try :
+        results = pool.map(parallelCall, [ (function, task) for task in tasks ])
+
+    finally :
+        pool.close()
+        pool.join()
+        parallel_data = None
+
+    return results
+
+
+def getJobsNb(n_jobs):
+
+    """
+    Return the number of worker processes corresponding to n_jobs (-1: one per CPU).
+    """
+
+    if n_jobs == -1 :
+        return multiprocessing.cpu_count()
+
+    return max(1, int(n_jobs))
+
+
+def parallelCall(function_task):
+
+    (function, task) = function_task
+
+    return function(parallel_data, task)
+
+
+###########################################################
+# C code shared by the simulation kernels
+###########################################################
+
+# Spike-triggered processes (eta, gamma) are simulated as x(t) = sum_j f(t - s_j), where s_j is the time index at 
+# which the effect of the j-th spike starts. The filter f is given by (see Filter.getSpikeUpdate):
+#
+# - an interpolated filter f_tab (L samples) with change points chg (time indices at which f_tab changes value). 
+#   For rectangular basis functions, f_tab is piecewise constant and has only a few change points. The contribution 
+#   of f_tab to x(t) is only recomputed at the times s_j + chg[c], which are counted in the array evt.
+#   Between these times, x(t) is constant. Since the recomputation sums the contributions of the spikes in the order 
+#   in which they were emitted, the result is identical to adding f_tab sample by sample after each spike.
+#   The cost of a spike scales with the number of change points and not with the length of the filter.
+#
+# - a sum of exponential components (amplitudes b, decays over one time step d=exp(-dt/tau)) that are simulated 
+#   recursively: each component decays at each time step and jumps by b after each spike. The cost of a time step 
+#   does not depend on the length of the filter.
+#
+# The value of the process is stored in x_sum (T samples).
+
+adaptation_support_code = """
+
+struct SpikeProcess {
+
+    double* x_sum;          // value of the process
+    int     T;
+
+    double* f_tab;          // interpolated filter and its change points
+    int     L;
+    int*    chg;
+    int     chg_l;
+    int*    evt;            // number of change points at each time index
+    int*    starts;         // time indices at which the effect of the spikes starts
+    int     starts_max;
+    int     starts_nb;
+    int     first;          // first spike whose effect is not over
+    double  value;          // current contribution of the interpolated filter
+
+    double* b;              // exponential components
+    double* d;
+    double* x;
+    int     R;
+
+    int     u_next;         // first time index at which x_sum has not been computed yet
+};
+
+
+void process_init(SpikeProcess* p, double* x_sum, int T, double* f_tab, int L, int* chg, int chg_l, int* evt, int* starts, int starts_max, double* b, double* d, double* x, int R) {
+
+    p->x_sum = x_sum;   p->T = T;
+    p->f_tab = f_tab;   p->L = L;   p->chg = chg;   p->chg_l = chg_l;   
+    p->evt = evt;       p->starts = starts;         p->starts_max = starts_max;
+    p->b = b;           p->d = d;   p->x = x;       p->R = R;
+}
+
+
+void process_reset(SpikeProcess* p) {
+
+    for (int u=0; u<p->T; u++) {
+        p->x_sum[u] = 0.0;
+        p->evt[u]   = 0;
+    }
+
+    for (int k=0; k<p->R; k++)
+        p->x[k] = 0.0;
+
+    p->starts_nb = 0;
+    p->first     = 0;
+    p->value     = 0.0;
+    p->u_next    = 0;
+}
+
+
+void process_advance(SpikeProcess* p, int u1) {
+
+    // Compute x_sum up to the time index u1 (excluded).
+
+    for (int u=p->u_next; u<u1; u++) {
+
+        if (u < p->T) {
+
+            if (p->evt[u] > 0) {
+
+                while (p->first < p->starts_nb && p->starts[p->first] + p->L <= u)
+                    p->first++;
+
+                double v = 0.0;
+                for (int j=p->first; j<p->starts_nb; j++)
+                    v += p->f_tab[u - p->starts[j]];
+
+                p->value = v;
+            }
+
+            p->x_sum[u] += p->value;
+        }
+
+        for (int k=0; k<p->R; k++) {
+
+            if (u < p->T)
+                p->x_sum[u] += p->x[k];
+
+            p->x[k] *= p->d[k];
+        }
+    }
+
+    if (u1 > p->u_next)
+        p->u_next = u1;
+}
+
+
+void process_spike(SpikeProcess* p, int s) {
+
+    // Add a spike whose effect starts at the time index s.
+    // If x_sum has already been computed at s (s < u_next), its values are corrected.
+
+    process_advance(p, s);
+
+    if (p->L > 0 && p->starts_nb < p->starts_max) {
+
+        p->starts[p->starts_nb] = s;
+        p->starts_nb++;
+
+        for (int c=0; c<p->chg_l; c++) {
+
+            int u = s + p->chg[c];
+
+            if (u >= p->u_next && u < p->T)
+                p->evt[u]++;
+        }
+
+        for (int u=s; u<p->u_next && u<s+p->L; u++) {
+
+            if (u < p->T)
+                p->x_sum[u] += p->f_tab[u-s];
+
+            if (u == p->u_next-1)
+                p->value += p->f_tab[u-s];
+        }
+    }
+
+    for (int k=0; k<p->R; k++) {
+
+        double xs = p->b[k];
+
+        for (int u=s; u<p->u_next; u++) {
+
+            if (u < p->T)
+                p->x_sum[u] += xs;
+
+            xs *= p->d[k];
+        }
+
+        p->x[k] += xs;
+    }
+}
+
+"""
+
+
+# Python implementation of the functions above, used by the Python implementation of the kernels (see Kernel).
+# A spike-triggered process is represented by the tuple:
+# proc = (x_sum, f_tab, chg, evt, starts, b, d, x, state_i, state_d)
+# where state_i = [starts_nb, first, u_next] and state_d = [value].
+
+def process_reset(proc):
+    
+    (x_sum, f_tab, chg, evt, starts, b, d, x, state_i, state_d) = proc
+    
+    x_sum[:]   = 0.0
+    evt[:]     = 0
+    x[:]       = 0.0
+    state_i[:] = 0
+    state_d[:] = 0.0
+    
+
+def process_advance(proc, u1):
+    
+    (x_sum, f_tab, chg, evt, starts, b, d, x, state_i, state_d) = proc
+    
+    T = len(x_sum)
+    L = len(f_tab)
+    R = len(b)
+    
+    starts_nb = state_i[0]
+    first     = state_i[1]
+    value     = state_d[0]
+    
+    for u in range(state_i[2], u1) :
+        
+        if u < T :
+            
+            if evt[u] > 0 :
+                
+                while first < starts_nb and starts[first] + L <= u :
+                    first += 1
+                    
+                v = 0.0
+                for j in range(first, starts_nb) :
+                    v += f_tab[u - starts[j]]
+                    
+                value = v
+                
+            x_sum[u] += value
+            
+        for k in range(R) :
+            
+            if u < T :
+                x_sum[u] += x[k]
+                
+            x[k] *= d[k]
+            
+    state_i[1] = first
+    state_d[0] = value
+    
+    if u1 > state_i[2] :
+        state_i[2] = u1
+        
+        
+def process_spike(proc, s):
+    
+    (x_sum, f_tab, chg, evt, starts, b, d, x, state_i, state_d) = proc
+    
+    process_advance(proc, s)
+    
+    T = len(x_sum)
+    L = len(f_tab)
+    R = len(b)
+    
+    u_next = state_i[2]
+    
+    if L > 0 and state_i[0] < len(starts) :
+        
+        starts[state_i[0]] = s
+        state_i[0] += 1
+        
+        for c in range(len(chg)) :
+            
+            u = s + chg[c]
+            
+            if u >= u_next and u < T :
+                evt[u] += 1
+                
+        for u in range(s, min(u_next, s + L)) :
+            
+            if u < T :
+                x_sum[u] += f_tab[u-s]
+                
+            if u == u_next-1 :
+                state_d[0] += f_tab[u-s]
+                
+    for k in range(R) :
+        
+        xs = b[k]
+        
+        for u in range(s, u_next) :
+            
+            if u < T :
+                x_sum[u] += xs
+                
+            xs *= d[k]
+            
+        x[k] += xs
+        
+        
+def process_new(x_sum, f_tab, chg, evt, starts, b, d, x):
+    
+    """
+    Return the tuple representing a spike-triggered process (the arrays are not copied).
+    """
+    
+    state_i = np.zeros(3, dtype=np.int32)
+    state_d = np.zeros(1)
+    
+    return (x_sum, f_tab, chg, evt, starts, b, d, x, state_i, state_d)
+
+
+###########################################################
+# Vectorized linear dynamics (see GIF.setForceSpikesEngine)
+###########################################################
+
+def filterSpikeTrain(spks_i, f, T):
+    
+    """
+    Return the sum of the filters f (one sample per time step) triggered at the time indices spks_i, on T time steps.
+    The sum is computed with a single FFT convolution of the spike train (instead of one addition per spike).
+    """
+    
+    spks_i = np.array(spks_i, dtype='int')
+    spks_i = spks_i[ (spks_i >= 0) & (spks_i < T) ]
+    
+    if len(spks_i) == 0 or len(f) == 0 :
+        return np.zeros(T)
+    
+    spks_train = np.bincount(spks_i, minlength=T).astype('double')
+    
+    return fftconvolve(spks_train, np.array(f, dtype='double'))[:T]
+
+
+def solveLinearRecurrence_withResets(a, u, V0, resets, Vr):
+    
+    """
+    Return V (len(u)+1 samples) such that V[0] = V0 and V[t+1] = a*V[t] + u[t] (a is a scalar), except at the 
+    time indices resets (sorted) where V is set to Vr before the recurrence continues.
+    
+    The response without resets is computed with an IIR filter (scipy.signal.lfilter). Since the recurrence is 
+    linear, each reset adds an exponentially decaying term c_k*a^(t-r_k) to the response; the amplitudes c_k are 
+    such that V[r_k] = Vr and the sum of these terms is computed with a second IIR filter.
+    """
+    
+    T = len(u) + 1
+    
+    V      = np.zeros(T)
+    V[0]   = V0
+    V[1:]  = lfilter([1.0], [1.0, -a], u, zi=[a*V0])[0]
+    
+    resets = np.array(resets, dtype='int')
+    
+    if len(resets) > 0 :
+        
+        err    = Vr - V[resets]
+        c      = err.copy()
+        c[1:] -= err[:-1]*a**np.diff(resets)
+        
+        impulses = np.zeros(T)
+        np.add.at(impulses, resets, c)
+        
+        V += lfilter([1.0], [1.0, -a], impulses)
+        V[resets] = Vr
+    
+    return V
+
+
+def solveAffineRecurrence(a, u, V0):
+    
+    """
+    Return V (len(u)+1 samples) such that V[0] = V0 and V[t+1] = a[t]*V[t] + u[t] (a varies in time).
+    
+    The affine maps x -> a[t]*x + u[t] are composed with a parallel prefix scan (log2(len(u)) vectorized passes).
+    Resets to a value Vr at time index r can be included by setting a[r-1] = 0 and u[r-1] = Vr.
+    """
+    
+    A = np.array(a, dtype='double')
+    B = np.array(u, dtype='double')
+    
+    k = 1
+    while k < len(B) :
+        B[k:] = A[k:]*B[:-k] + B[k:]
+        A[k:] = A[k:]*A[:-k]
+        k *= 2
+    
+    V     = np.zeros(len(B)+1)
+    V[0]  = V0
+    V[1:] = A*V0 + B
+    
+    return V
+
+
 ###########################################################
 # Functions to perform exponential fit
 ###########################################################
@@ -1,7 +1,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
 
-from scipy import weave
+from Kernel import *
 
 import ReadIBW
 
@@ -225,32 +225,8 @@ class Trace :
                 
         spike_train = np.zeros(p_T_i)
         spike_train = np.array(spike_train, dtype='double')
-        
-                
-        code =  """
-                #include <math.h>
-                
-                int T_i = int(p_T_i)-1;                
-                int ref_ind = int(p_ref_ind);   
-                float threshold = p_threshold;
-            
-                int t = 0;
-                                                                
-                while (t < T_i) {
-                    
-                    if (V[t] >= threshold && V[t-1] < threshold) {
-                        spike_train[t] = 1.0;
-                        t += ref_ind;
-                    }
-                    
-                    t++;
-               
-                }  
-                """
- 
-        vars = [ 'p_T_i', 'p_ref_ind', 'p_threshold', 'V', 'spike_train' ]
-        
-        v = weave.inline(code, vars)
+
+        kernel_Trace_detectSpikes.run(locals())
 
         spks_ind = np.where(spike_train==1.0)[0]
 
@@ -440,4 +416,49 @@ class Trace :
         plt.ylim([min(self.V)-5.0, max(self.V)+5.0])
         plt.ylabel('V rec (mV)')
         plt.xlabel('Time (ms)')
-        plt.show()
\ No newline at end of file
+        plt.show()
+
+
+########################################################################################################
+# KERNELS (see Kernel)
+########################################################################################################
+
+def Trace_detectSpikes_ref(p_T_i, p_ref_ind, p_threshold, V, spike_train):
+    
+    T_i = p_T_i - 1
+    
+    t = 1
+    while t < T_i :
+        
+        if V[t] >= p_threshold and V[t-1] < p_threshold :
+            spike_train[t] = 1.0
+            t += p_ref_ind
+            
+        t += 1
+
+
+kernel_Trace_detectSpikes = Kernel('Trace_detectSpikes',
+        [ 
+          'int p_T_i', 'int p_ref_ind', 'double p_threshold', 'double* V', 'double* spike_train' 
+        ],
+        """
+                
+                int T_i = int(p_T_i)-1;                
+                int ref_ind = int(p_ref_ind);   
+                float threshold = p_threshold;
+            
+                int t = 1;
+                                                                
+                while (t < T_i) {
+                    
+                    if (V[t] >= threshold && V[t-1] < threshold) {
+                        spike_train[t] = 1.0;
+                        t += ref_ind;
+                    }
+                    
+                    t++;
+               
+                }  
+                """,
+        Trace_detectSpikes_ref)
+
@@ -1,7 +1,6 @@
 import matplotlib.pyplot as plt
 import numpy as np
 
-from scipy import weave
 from numpy.linalg import inv
 
 from ThresholdModel import *
@@ -10,6 +9,8 @@ from Filter_Rect_LogSpaced import *
 from GIF import *
 
 from Tools import reprint
+from Tools import process_new, process_reset, process_advance, process_spike, philox_uniform, sampler_reset, sample_spike
+from Kernel import *
 
 
 class gGIF(GIF) :
@@ -50,29 +51,32 @@ class gGIF(GIF) :
               
               
        
-    def simulate(self, I, V0):
+    def simulate_batch(self, I, V0, nb_rep, seed=None, rep0=0):
  
         """
-        Simulate the spiking response of the gGIF model to an input current I (nA) with time step dt.
+        Simulate nb_rep independent repetitions of the spiking response of the gGIF model to an input current I (nA) with time step dt.
+        V0 indicate the initial condition V(0)=V0 (used in all repetitions).
         
-        V0 indicate the initial condition V(0)=V0.
-        
-        The function returns:
-        
-        - time     : ms, support for V, eta_sum, V_T, spks
-        
-        - V        : mV, membrane potential
-        
-        - eta_sum  : nA, adaptation current
+        The interpolated filters eta and gamma are computed only once and all the repetitions are performed in a single 
+        call to the C kernel. The arrays V, eta_sum and gamma_sum are reused by all the repetitions (memory does not 
+        scale with nb_rep).
         
-        - V_T      : mV, firing threshold
+        The random numbers used by the k-th repetition only depend on seed and on rep0+k (see Tools.philox_support_code),
+        so that simulating the repetitions in several calls (e.g., in parallel) with increasing rep0 gives the same result
+        as a single call. If seed is None, a seed is drawn from numpy.random.
         
-        - spks     : ms, list of spike times 
+        The function returns:
+        - all_spks : list of nb_rep arrays of spike times (ms), one for each repetition
+        - V        : mV, membrane potential (last repetition)
+        - eta_sum  : nA, adaptation current (last repetition)
+        - V_T      : mV, firing threshold (last repetition)
         """
-                 
+ 
         # Input parameters
         p_T         = len(I)
         p_dt        = self.dt
+        p_exact     = int(self.getIntegrator() == 'exact')
+        p_rescaling = int(self.getSampling() == 'rescaling')
         
         # Model parameters
         p_gl        = self.gl
@@ -84,105 +88,62 @@ class gGIF(GIF) :
         p_Vt_star   = self.Vt_star
         p_DV        = self.DV
         p_lambda0   = self.lambda0
+        p_V0        = V0
         
-        # Model kernels   
-        (p_eta_support, p_eta) = self.eta.getInterpolatedFilter(self.dt)   
-        p_eta       = p_eta.astype('double')
+        # Random number generator (see Tools.philox_support_code)
+        if seed == None :
+            seed = Tools.getRandomSeed()
+        p_seed      = seed
+        
+        # Model kernels (see Filter.getSpikeUpdate)
+        (p_eta, p_eta_chg, p_eta_b, p_eta_d) = self.eta.getSpikeUpdate(self.dt)
         p_eta_l     = len(p_eta)
+        p_eta_chg_l = len(p_eta_chg)
+        p_eta_R     = len(p_eta_b)
 
-        (p_gamma_support, p_gamma) = self.gamma.getInterpolatedFilter(self.dt)   
-        p_gamma     = p_gamma.astype('double')
+        (p_gamma, p_gamma_chg, p_gamma_b, p_gamma_d) = self.gamma.getSpikeUpdate(self.dt)
         p_gamma_l   = len(p_gamma)
+        p_gamma_chg_l = len(p_gamma_chg)
+        p_gamma_R   = len(p_gamma_b)
       
-        # Define arrays
+        # Define arrays (shared by all the repetitions)
         V = np.array(np.zeros(p_T), dtype="double")
         I = np.array(I, dtype="double")
-        spks = np.array(np.zeros(p_T), dtype="double")                      
-        eta_sum = np.array(np.zeros(p_T + 2*p_eta_l), dtype="double")
-        gamma_sum = np.array(np.zeros(p_T + 2*p_gamma_l), dtype="double")            
  
-        # Set initial condition
-        V[0] = V0
+        # Spike indices of each repetition are stored in a flat array (at most p_spks_max spikes per repetition)
+        p_spks_max  = Tools.getMaxSpikeNb(p_T, p_Tref, p_dt)
+        nb_rep_call = Tools.getRepetitionsPerCall(nb_rep, p_spks_max)
+        
+        # Spike-triggered processes (see Tools.adaptation_support_code)
+        eta_sum    = np.array(np.zeros(p_T), dtype="double")
+        eta_evt    = np.array(np.zeros(p_T), dtype="int32")
+        eta_starts = np.array(np.zeros(p_spks_max), dtype="int32")
+        eta_exp    = np.array(np.zeros(p_eta_R), dtype="double")
+        
+        gamma_sum    = np.array(np.zeros(p_T), dtype="double")
+        gamma_evt    = np.array(np.zeros(p_T), dtype="int32")
+        gamma_starts = np.array(np.zeros(p_spks_max), dtype="int32")
+        gamma_exp    = np.array(np.zeros(p_gamma_R), dtype="double")
          
-        code =  """
-                #include <math.h>
-                
-                int   T_ind      = int(p_T);                
-                float dt         = float(p_dt); 
-                
-                float gl         = float(p_gl);
-                float C          = float(p_C);
-                float El         = float(p_El);
-                float Ek         = float(p_Ek);
-                float Vr         = float(p_Vr);
-                int   Tref_ind   = int(float(p_Tref)/dt);
-                float Vt_star    = float(p_Vt_star);
-                float DeltaV     = float(p_DV);
-                float lambda0    = float(p_lambda0);
-           
-                int eta_l        = int(p_eta_l);
-                int gamma_l      = int(p_gamma_l);
-                
-                                                  
-                float rand_max  = float(RAND_MAX); 
-                float p_dontspike = 0.0 ;
-                float lambda = 0.0 ;            
-                float r = 0.0;
-                
-                                                
-                for (int t=0; t<T_ind-1; t++) {
-    
-    
-                    // INTEGRATE VOLTAGE
-                    V[t+1] = V[t] + dt/C*( -gl*(V[t] - El) + I[t] - eta_sum[t]*(V[t]-Ek) );
-               
-               
-                    // COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
-                    lambda = lambda0*exp( (V[t+1]-Vt_star-gamma_sum[t])/DeltaV );
-                    p_dontspike = exp(-lambda*(dt/1000.0));                                  // since lambda0 is in Hz, dt must also be in Hz (this is why dt/1000.0)
-                          
-                          
-                    // PRODUCE SPIKE STOCHASTICALLY
-                    r = rand()/rand_max;
-                    if (r > p_dontspike) {
-                                        
-                        if (t+1 < T_ind-1)                
-                            spks[t+1] = 1.0; 
-                        
-                        t = t + Tref_ind;    
-                        
-                        if (t+1 < T_ind-1) 
-                            V[t+1] = Vr;
-                        
-                        
-                        // UPDATE ADAPTATION PROCESSES     
-                        for(int j=0; j<eta_l; j++) 
-                            eta_sum[t+1+j] += p_eta[j]; 
-                        
-                        for(int j=0; j<gamma_l; j++) 
-                            gamma_sum[t+1+j] += p_gamma[j] ;  
-                        
-                    }
-               
-                }
-                
-                """
- 
-        vars = [ 'p_T','p_dt','p_gl','p_C','p_Ek','p_El','p_Vr','p_Tref','p_Vt_star','p_DV','p_lambda0','V','I','p_eta','p_eta_l','eta_sum','p_gamma','gamma_sum','p_gamma_l','spks' ]
         
-        v = weave.inline(code, vars)
-
-        time = np.arange(p_T)*self.dt
+        all_spks = []
         
-        eta_sum   = eta_sum[:p_T]     
-        V_T = gamma_sum[:p_T] + p_Vt_star
-     
-        spks = (np.where(spks==1)[0])*self.dt
+        for rep_start in np.arange(0, nb_rep, nb_rep_call) :
+            
+            p_nb_rep = int(min(nb_rep_call, nb_rep - rep_start))
+            p_rep0   = int(rep0 + rep_start)
+            spks_i   = np.array(np.zeros(p_nb_rep*p_spks_max), dtype="int32")
+            spks_nb  = np.array(np.zeros(p_nb_rep), dtype="int32")
+        
+            kernel_gGIF_simulate.run(locals())
+            
+            all_spks.extend( Tools.splitSpikeIndices(spks_i, spks_nb, p_spks_max, self.dt) )
+        
+        V_T = gamma_sum + p_Vt_star
     
-        return (time, V, eta_sum, V_T, spks)
+        return (all_spks, V, eta_sum, V_T)
 
         
-        
     def simulateDeterministic_forceSpikes(self, I, V0, spks):
         
         """
@@ -200,6 +161,7 @@ class gGIF(GIF) :
         # Input parameters
         p_T          = len(I)
         p_dt         = self.dt
+        p_exact      = int(self.getIntegrator() == 'exact')
           
           
         # Model parameters
@@ -222,62 +184,32 @@ class gGIF(GIF) :
         V        = np.array(np.zeros(p_T), dtype="double")
         I        = np.array(I, dtype="double")
         spks     = np.array(spks, dtype="double")                      
-        spks_i   = Tools.timeToIndex(spks, self.dt)
+        spks_i   = Tools.timeToIndex(spks, self.dt).astype("int32")
+        p_spks_L = len(spks_i)
 
 
         # Compute adaptation current (sum of eta triggered at spike times in spks) 
-        eta_sum  = np.array(np.zeros(p_T + 1.1*p_eta_l + p_Tref_i), dtype="double")   
-        
-        for s in spks_i :
-            eta_sum[s  + p_Tref_i  : s  + p_Tref_i + p_eta_l] += p_eta
+        if self.getForceSpikesEngine() == 'linear' :
+            
+            eta_sum = Tools.filterSpikeTrain(spks_i + p_Tref_i, p_eta, p_T)
+            
+        else :
         
-        eta_sum  = eta_sum[:p_T]  
+            eta_sum  = np.array(np.zeros(p_T + int(1.1*p_eta_l) + p_Tref_i), dtype="double")   
+            
+            for s in spks_i :
+                eta_sum[s  + p_Tref_i  : s  + p_Tref_i + p_eta_l] += p_eta
+            
+            eta_sum  = eta_sum[:p_T]  
    
    
         # Set initial condition
         V[0] = V0
         
-    
-        code = """ 
-                #include <math.h>
-                
-                int   T_ind      = int(p_T);                
-                float dt         = float(p_dt); 
-                
-                float gl         = float(p_gl);
-                float C          = float(p_C);
-                float El         = float(p_El);
-                float Ek         = float(p_Ek);
-                float Vr         = float(p_Vr);
-                int   Tref_ind   = int(float(p_Tref)/dt);
-
-
-                int next_spike = spks_i[0] + Tref_ind;
-                int spks_cnt = 0;
- 
-                                                                       
-                for (int t=0; t<T_ind-1; t++) {
-    
-    
-                    // INTEGRATE VOLTAGE
-                    V[t+1] = V[t] + dt/C*( -gl*(V[t] - El) + I[t] - eta_sum[t]*(V[t]-Ek) );
-               
-               
-                    if ( t == next_spike ) {
-                        spks_cnt = spks_cnt + 1;
-                        next_spike = spks_i[spks_cnt] + Tref_ind;
-                        V[t-1] = 0 ;                  
-                        V[t] = Vr ;
-                        t=t-1;           
-                    }
-               
-                }
-        
-                """
- 
-        vars = [ 'p_T','p_dt','p_gl','p_C','p_El','p_Ek','p_Vr','p_Tref','V','I','eta_sum','spks_i' ]
-        
-        v = weave.inline(code, vars)
+        if self.getForceSpikesEngine() == 'linear' :
+            V = self.simulateDeterministic_forceSpikes_linear(I, V0, spks_i, eta_sum)
+        else :
+            kernel_gGIF_forceSpikes.run(locals())
 
         time = np.arange(p_T)*self.dt
         eta_sum = eta_sum[:p_T]     
@@ -286,6 +218,51 @@ class gGIF(GIF) :
         
         
         
+    def simulateDeterministic_forceSpikes_linear(self, I, V0, spks_i, eta_sum):
+        
+        """
+        Vectorized equivalent of kernel_gGIF_forceSpikes (see GIF.setForceSpikesEngine). Since eta is a conductance, 
+        V(t+1) = a(t)*V(t) + dtC(t)*(gl*El + I(t) + eta_sum(t)*Ek) with a(t) = 1 - dtC(t)*(gl + eta_sum(t)) varies in time 
+        and the recurrence is solved with Tools.solveAffineRecurrence.
+        Return V.
+        """
+        
+        g   = self.gl + eta_sum[:-1]
+        dtC = self.dt/self.C*np.ones(len(g))
+        
+        if self.getIntegrator() == 'exact' :
+            g_nz      = g != 0.0
+            dtC[g_nz] = -np.expm1(-self.dt*g[g_nz]/self.C)/g[g_nz]
+        
+        a = 1.0 - dtC*g
+        u = dtC*( self.gl*self.El + I[:-1] + eta_sum[:-1]*self.Ek )
+        
+        # reset V to Vr at the end of the refractory periods
+        resets = self.getForceSpikesResets(spks_i, len(I))
+        
+        if len(resets) > 0 and resets[0] == 0 :
+            V0 = self.Vr
+        
+        a[resets[resets > 0]-1] = 0.0
+        u[resets[resets > 0]-1] = self.Vr
+        
+        V = Tools.solveAffineRecurrence(a, u, V0)
+        
+        # as in the kernel, V is set to 0 one time step before each reset
+        V[resets-1] = 0.0
+        
+        return V
+        
+        
+    def getForceSpikesKey(self, tr):
+        
+        """
+        Return the key under which the result of simulateDeterministic_forceSpikes_trace is cached for the trace tr (see GIF).
+        """
+        
+        return GIF.getForceSpikesKey(self, tr) + (self.Ek,)
+        
+        
     def fit(self, experiment, Ek_all, DT_beforeSpike = 5.0, do_plot=False):
         
         """
@@ -326,65 +303,40 @@ class gGIF(GIF) :
     # FUNCTIONS RELATED TO FIT OF SUBTHRESHOLD DYNAMICS (step 2)
     ########################################################################################################
 
-    def fitSubthresholdDynamics(self, experiment, Ek_all, DT_beforeSpike=5.0, do_plot=False):
+    def fitSubthresholdDynamics(self, experiment, Ek_all, DT_beforeSpike=5.0, do_plot=False, chunk_size=100000):
                     
         print "\ngGIF MODEL - Fit subthreshold dynamics..." 
            
         var_explained_dV_all = []   
         b_all = []
         
+        # Expand eta in basis functions
+        self.dt = experiment.dt
+        self.eta.computeBins()
         
-        for Ek in Ek_all :
-        
-            print "\nTest Ek = %0.2f mV..." % (Ek)
-        
-            # Expand eta in basis functions
-            self.dt = experiment.dt
-            self.eta.computeBins()
-            
-            # Build X matrix and Y vector to perform linear regression (use all traces in training set)            
-            X = []
-            Y = []
+        # Accumulate the normal equations of the linear regression for the columns V, I, 1, eta_i*V and eta_i
+        # (use all traces in training set). The regression associated with each Ek is a linear combination of these columns.
+        (ZTZ, ZTY, YTY, Y_sum, Y_nb) = self.fitSubthresholdDynamics_NormalEquations(experiment, DT_beforeSpike=DT_beforeSpike, chunk_size=chunk_size)
         
-            cnt = 0
-            
-            for tr in experiment.trainingset_traces :
-            
-                if tr.useTrace :
-            
-                    cnt += 1
-                    reprint( "Compute X matrix for repetition %d" % (cnt) )        
-                    
-                    (X_tmp, Y_tmp) = self.fitSubthresholdDynamics_Build_Xmatrix_Yvector(tr, Ek, DT_beforeSpike=DT_beforeSpike)
-         
-                    X.append(X_tmp)
-                    Y.append(Y_tmp)
         
+        for Ek in Ek_all :
         
-            # Concatenate matrixes associated with different traces to perform a single multilinear regression
-            if cnt == 1:
-                X = X[0]
-                Y = Y[0]
-                
-            elif cnt > 1:
-                X = np.concatenate(X, axis=0)
-                Y = np.concatenate(Y, axis=0)
-            
-            else :
-                print "\nError, at least one training set trace should be selected to perform fit."
+            print "\nTest Ek = %0.2f mV..." % (Ek)
             
+            # Normal equations associated with the columns V, I, 1, eta_i*(V-Ek)
+            M   = self.fitSubthresholdDynamics_Ek_Matrix(Ek)
+            XTX = np.dot(np.transpose(M), np.dot(ZTZ, M))
+            XTY = np.dot(np.transpose(M), ZTY)
             
             # Linear Regression
-            print "\nPerform linear regression..."
-            XTX     = np.dot(np.transpose(X), X)
+            print "Perform linear regression..."
             XTX_inv = inv(XTX)
-            XTY     = np.dot(np.transpose(X), Y)
             b       = np.dot(XTX_inv, XTY)
             b       = b.flatten()
        
       
             # Compute percentage of variance explained on dV/dt
-            var_explained_dV = 1.0 - np.mean((Y - np.dot(X,b))**2)/np.var(Y)
+            var_explained_dV = self.fitSubthresholdDynamics_VarianceExplained(b, XTX, XTY, YTY, Y_sum, Y_nb)
             print "Done! Percentage of variance explained (on dV/dt): %0.2f" % (var_explained_dV*100.0)
     
             # Save results    
@@ -422,7 +374,7 @@ class gGIF(GIF) :
             if tr.useTrace :
 
                 # Simulate subthreshold dynamics 
-                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes(tr.I, tr.V[0], tr.getSpikeTimes())
+                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes_trace(tr)
                 
                 indices_tmp = tr.getROI_FarFromSpikes(0.0, self.Tref)
                 
@@ -480,6 +432,45 @@ class gGIF(GIF) :
         Y = np.array( np.concatenate( (np.diff(trace.V)/trace.dt, [0]) ) )[selection]      
 
         return (X, Y)
+
+
+    def fitSubthresholdDynamics_Build_Xmatrix_Yvector_Chunks(self, trace, DT_beforeSpike=5.0, chunk_size=100000):
+
+        """
+        Iterate over the rows of the matrix Z (and of the vector Y) in chunks of at most chunk_size time steps of the trace.
+        The columns of Z are V, I, 1, eta_i*V and eta_i, so that the matrix X returned by fitSubthresholdDynamics_Build_Xmatrix_Yvector
+        is given by X = Z M, with M returned by fitSubthresholdDynamics_Ek_Matrix.
+        """
+
+        for (selection, X_eta, Y) in self.fitSubthresholdDynamics_Iterate_Chunks(trace, DT_beforeSpike=DT_beforeSpike, chunk_size=chunk_size) :
+
+            selection_l = len(selection)
+
+            Z = np.zeros( (selection_l, 3) )
+            Z[:,0] = trace.V[selection]
+            Z[:,1] = trace.I[selection]
+            Z[:,2] = np.ones(selection_l)
+
+            Z = np.concatenate( (Z, X_eta*Z[:,0:1], X_eta), axis=1 )
+
+            yield (Z, Y)
+
+
+    def fitSubthresholdDynamics_Ek_Matrix(self, Ek):
+
+        """
+        Return the matrix M that maps the columns V, I, 1, eta_i*V, eta_i (see fitSubthresholdDynamics_Build_Xmatrix_Yvector_Chunks)
+        on the columns V, I, 1, eta_i*(V-Ek) used to perform the linear regression.
+        """
+
+        eta_nb = self.eta.getNbOfBasisFunctions()
+
+        M = np.zeros( (3 + 2*eta_nb, 3 + eta_nb) )
+        M[0:3, 0:3] = np.eye(3)
+        M[3:3+eta_nb, 3:] = np.eye(eta_nb)
+        M[3+eta_nb:, 3:]  = -Ek*np.eye(eta_nb)
+
+        return M
         
         
     ##############################################################################################################
@@ -501,4 +492,286 @@ class gGIF(GIF) :
         print "Vr (mV):\t%0.3f"     % (self.Vr)     
         print "Vt* (mV):\t%0.3f"    % (self.Vt_star)    
         print "DV (mV):\t%0.3f"     % (self.DV)          
-        print "-------------------------\n"
\ No newline at end of file
+        print "-------------------------\n"
+
+
+########################################################################################################
+# KERNELS (see Kernel)
+########################################################################################################
+
+def gGIF_simulate_ref(p_T, p_dt, p_exact, p_rescaling, p_gl, p_C, p_El, p_Ek, p_Vr, p_Tref, p_Vt_star, p_DV, p_lambda0, p_V0, V, I, 
+                      p_eta, p_eta_l, p_eta_chg, p_eta_chg_l, p_eta_b, p_eta_d, p_eta_R, eta_sum, eta_evt, eta_starts, eta_exp, 
+                      p_gamma, p_gamma_l, p_gamma_chg, p_gamma_chg_l, p_gamma_b, p_gamma_d, p_gamma_R, gamma_sum, gamma_evt, gamma_starts, gamma_exp, 
+                      p_nb_rep, p_seed, p_rep0, p_spks_max, spks_i, spks_nb):
+    
+    T_ind    = p_T
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    dtC = p_dt/p_C
+    if p_exact == 1 :
+        dtC = -np.expm1(-p_dt*p_gl/p_C)/p_gl
+    
+    eta_proc   = process_new(eta_sum, p_eta, p_eta_chg, eta_evt, eta_starts, p_eta_b, p_eta_d, eta_exp)
+    gamma_proc = process_new(gamma_sum, p_gamma, p_gamma_chg, gamma_evt, gamma_starts, p_gamma_b, p_gamma_d, gamma_exp)
+
+    sampler_i  = np.zeros(1, dtype=np.int32)
+    sampler_d  = np.zeros(2)
+    
+    for rep in range(p_nb_rep) :
+        
+        # RESET STATE VARIABLES
+        V[:] = 0.0
+        process_reset(eta_proc)
+        process_reset(gamma_proc)
+        sampler_reset(sampler_i, sampler_d)
+        
+        V[0] = p_V0
+        
+        spks_cnt = 0
+        
+        t = 0
+        while t < T_ind-1 :
+            
+            # COMPUTE ADAPTATION PROCESSES
+            process_advance(eta_proc, t+1)
+            process_advance(gamma_proc, t+1)
+            
+            # INTEGRATE VOLTAGE
+            if p_exact == 1 :
+                g = p_gl + eta_sum[t]
+                dtC = -np.expm1(-p_dt*g/p_C)/g if g != 0.0 else p_dt/p_C
+            V[t+1] = V[t] + dtC*( -p_gl*(V[t] - p_El) + I[t] - eta_sum[t]*(V[t]-p_Ek) )
+            
+            # COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+            lambda_t    = p_lambda0*np.exp( (V[t+1]-p_Vt_star-gamma_sum[t])/p_DV )
+            
+            # PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+            if sample_spike(p_rescaling, p_seed, p_rep0 + rep, t, lambda_t, p_dt, sampler_i, sampler_d) :
+                
+                if t+1 < T_ind-1 and spks_cnt < p_spks_max :
+                    spks_i[rep*p_spks_max + spks_cnt] = t+1
+                    spks_cnt += 1
+                    
+                t = t + Tref_ind
+                
+                if t+1 < T_ind-1 :
+                    V[t+1] = p_Vr
+                    
+                # UPDATE ADAPTATION PROCESSES
+                process_spike(eta_proc, t+1)
+                process_spike(gamma_proc, t+1)
+                
+            t += 1
+            
+        process_advance(eta_proc, T_ind)
+        process_advance(gamma_proc, T_ind)
+        
+        spks_nb[rep] = spks_cnt
+
+
+kernel_gGIF_simulate = Kernel('gGIF_simulate',
+        [ 
+          'int p_T', 'double p_dt', 'int p_exact', 'int p_rescaling', 'double p_gl', 'double p_C', 'double p_El', 'double p_Ek', 'double p_Vr',
+          'double p_Tref', 'double p_Vt_star', 'double p_DV', 'double p_lambda0', 'double p_V0', 'double* V',
+          'double* I', 'double* p_eta', 'int p_eta_l', 'int* p_eta_chg', 'int p_eta_chg_l',
+          'double* p_eta_b', 'double* p_eta_d', 'int p_eta_R', 'double* eta_sum', 'int* eta_evt',
+          'int* eta_starts', 'double* eta_exp', 'double* p_gamma', 'int p_gamma_l', 'int* p_gamma_chg',
+          'int p_gamma_chg_l', 'double* p_gamma_b', 'double* p_gamma_d', 'int p_gamma_R',
+          'double* gamma_sum', 'int* gamma_evt', 'int* gamma_starts', 'double* gamma_exp', 'int p_nb_rep', 'int p_seed', 'int p_rep0',
+          'int p_spks_max', 'int* spks_i', 'int* spks_nb' 
+        ],
+        """
+                
+                int   T_ind      = int(p_T);                
+                float dt         = float(p_dt); 
+                
+                float gl         = float(p_gl);
+                float C          = float(p_C);
+                float El         = float(p_El);
+                float Ek         = float(p_Ek);
+                float Vr         = float(p_Vr);
+                int   Tref_ind   = int(float(p_Tref)/dt);
+                float dtC        = dt/C;                                     // forward Euler
+                if (p_exact == 1)
+                    dtC = -expm1(-dt*gl/C)/gl;                               // exact integration (I and eta constant during one time step)
+                float Vt_star    = float(p_Vt_star);
+                float DeltaV     = float(p_DV);
+                float lambda0    = float(p_lambda0);
+           
+                int eta_l        = int(p_eta_l);
+                int gamma_l      = int(p_gamma_l);
+                
+                int nb_rep       = int(p_nb_rep);
+                int spks_max     = int(p_spks_max);
+                
+                SpikeProcess eta_proc;
+                SpikeProcess gamma_proc;
+                process_init(&eta_proc, eta_sum, T_ind, p_eta, eta_l, p_eta_chg, int(p_eta_chg_l), eta_evt, eta_starts, spks_max, p_eta_b, p_eta_d, eta_exp, int(p_eta_R));
+                process_init(&gamma_proc, gamma_sum, T_ind, p_gamma, gamma_l, p_gamma_chg, int(p_gamma_chg_l), gamma_evt, gamma_starts, spks_max, p_gamma_b, p_gamma_d, gamma_exp, int(p_gamma_R));
+                                                  
+                float lambda = 0.0 ;            
+                int    sampler_i[1];                                              // state of the spike sampler (see Tools.sampler_support_code)
+                double sampler_d[2];
+                
+                
+                for (int rep=0; rep<nb_rep; rep++) {
+                
+                
+                    // RESET STATE VARIABLES
+                    for (int t=0; t<T_ind; t++)
+                        V[t] = 0.0;
+                        
+                    process_reset(&eta_proc);
+                    process_reset(&gamma_proc);
+                    sampler_reset(sampler_i, sampler_d);
+                    
+                    V[0] = p_V0;
+                    
+                    int spks_cnt = 0;
+                    
+                                                    
+                    for (int t=0; t<T_ind-1; t++) {
+        
+        
+                        // COMPUTE ADAPTATION PROCESSES
+                        process_advance(&eta_proc, t+1);
+                        process_advance(&gamma_proc, t+1);
+        
+        
+                        // INTEGRATE VOLTAGE
+                        if (p_exact == 1) {                                           // exact integration (conductance constant during one time step)
+                            float g = gl + eta_sum[t];
+                            dtC = (g != 0.0) ? -expm1(-dt*g/C)/g : dt/C;
+                        }
+                        V[t+1] = V[t] + dtC*( -gl*(V[t] - El) + I[t] - eta_sum[t]*(V[t]-Ek) );
+                   
+                   
+                        // COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+                        lambda = lambda0*exp( (V[t+1]-Vt_star-gamma_sum[t])/DeltaV );
+                              
+                              
+                        // PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+                        if (sample_spike(p_rescaling, (unsigned int)(p_seed), (unsigned int)(p_rep0 + rep), (unsigned int)(t), lambda, dt, sampler_i, sampler_d)) {
+                                            
+                            if (t+1 < T_ind-1 && spks_cnt < spks_max) {
+                                spks_i[rep*spks_max + spks_cnt] = t+1;
+                                spks_cnt++;
+                            }
+                            
+                            t = t + Tref_ind;    
+                            
+                            if (t+1 < T_ind-1) 
+                                V[t+1] = Vr;
+                            
+                            
+                            // UPDATE ADAPTATION PROCESSES     
+                            process_spike(&eta_proc, t+1);
+                            process_spike(&gamma_proc, t+1);
+                            
+                        }
+                   
+                    }
+                    
+                    process_advance(&eta_proc, T_ind);
+                    process_advance(&gamma_proc, T_ind);
+                    
+                    spks_nb[rep] = spks_cnt;
+                    
+                }
+                
+                """,
+        gGIF_simulate_ref,
+        support_code=Tools.adaptation_support_code + Tools.philox_support_code + Tools.sampler_support_code,
+        helpers=[process_new, process_reset, process_advance, process_spike, philox_uniform, sampler_reset, sample_spike])
+
+
+def gGIF_forceSpikes_ref(p_T, p_dt, p_exact, p_gl, p_C, p_El, p_Ek, p_Vr, p_Tref, V, I, eta_sum, spks_i, p_spks_L):
+    
+    T_ind    = p_T
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    dtC = p_dt/p_C
+    if p_exact == 1 :
+        dtC = -np.expm1(-p_dt*p_gl/p_C)/p_gl
+    
+    spks_cnt   = 0
+    next_spike = T_ind
+    if p_spks_L > 0 :
+        next_spike = spks_i[0] + Tref_ind
+    
+    t = 0
+    while t < T_ind-1 :
+        
+        # INTEGRATE VOLTAGE
+        if p_exact == 1 :
+            g = p_gl + eta_sum[t]
+            dtC = -np.expm1(-p_dt*g/p_C)/g if g != 0.0 else p_dt/p_C
+        V[t+1] = V[t] + dtC*( -p_gl*(V[t] - p_El) + I[t] - eta_sum[t]*(V[t]-p_Ek) )
+        
+        if t == next_spike :
+            spks_cnt = spks_cnt + 1
+            next_spike = T_ind
+            if spks_cnt < p_spks_L :
+                next_spike = spks_i[spks_cnt] + Tref_ind
+            V[t-1] = 0
+            V[t] = p_Vr
+            t = t-1
+            
+        t += 1
+
+
+kernel_gGIF_forceSpikes = Kernel('gGIF_forceSpikes',
+        [ 
+          'int p_T', 'double p_dt', 'int p_exact', 'double p_gl', 'double p_C', 'double p_El', 'double p_Ek', 'double p_Vr',
+          'double p_Tref', 'double* V', 'double* I', 'double* eta_sum', 'int* spks_i', 'int p_spks_L' 
+        ],
+        """ 
+                
+                int   T_ind      = int(p_T);                
+                float dt         = float(p_dt); 
+                
+                float gl         = float(p_gl);
+                float C          = float(p_C);
+                float El         = float(p_El);
+                float Ek         = float(p_Ek);
+                float Vr         = float(p_Vr);
+                int   Tref_ind   = int(float(p_Tref)/dt);
+                float dtC        = dt/C;                                     // forward Euler
+                if (p_exact == 1)
+                    dtC = -expm1(-dt*gl/C)/gl;                               // exact integration (I and eta constant during one time step)
+
+
+                int spks_L     = int(p_spks_L);
+                int spks_cnt   = 0;
+                int next_spike = T_ind;
+                
+                if (spks_L > 0)
+                    next_spike = spks_i[0] + Tref_ind;
+ 
+                                                                       
+                for (int t=0; t<T_ind-1; t++) {
+    
+    
+                    // INTEGRATE VOLTAGE
+                    if (p_exact == 1) {                                           // exact integration (conductance constant during one time step)
+                        float g = gl + eta_sum[t];
+                        dtC = (g != 0.0) ? -expm1(-dt*g/C)/g : dt/C;
+                    }
+                    V[t+1] = V[t] + dtC*( -gl*(V[t] - El) + I[t] - eta_sum[t]*(V[t]-Ek) );
+               
+               
+                    if ( t == next_spike ) {
+                        spks_cnt = spks_cnt + 1;
+                        next_spike = T_ind;
+                        if (spks_cnt < spks_L)
+                            next_spike = spks_i[spks_cnt] + Tref_ind;
+                        V[t-1] = 0 ;                  
+                        V[t] = Vr ;
+                        t=t-1;           
+                    }
+               
+                }
+        
+                """,
+        gGIF_forceSpikes_ref)
+
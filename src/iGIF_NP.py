@@ -1,8 +1,6 @@
 import matplotlib.pyplot as plt
 import numpy as np
 
-from scipy import weave
-from scipy.weave import converters
 from numpy.linalg import inv
 
 from SpikingModel import *
@@ -12,6 +10,8 @@ from Filter_Rect_LogSpaced import *
 
 import Tools
 from Tools import reprint
+from Tools import process_new, process_reset, process_advance, process_spike, philox_uniform, sampler_reset, sample_spike
+from Kernel import *
 
 
 
@@ -94,7 +94,7 @@ class iGIF_NP(iGIF) :
         """
         self.setDt(dt)
     
-        (time, V, eta_sum, V_T, spks_times) = self.simulate(I, self.El)
+        spks_times = self.simulate(I, self.El, output='spikes')
         
         return spks_times
     
@@ -116,25 +116,28 @@ class iGIF_NP(iGIF) :
     
     
     
-    def simulate(self, I, V0):
+    def simulate_batch(self, I, V0, nb_rep, seed=None, rep0=0):
  
         """
-        Simulate the spiking response of the GIF model to an input current I (nA) with time step dt.
-        V0 (mV) indicate the initial condition V(0)=V0.
+        Simulate nb_rep independent repetitions of the spiking response of the iGIF_NP model to an input current I (nA) with time step dt.
+        V0 (mV) indicate the initial condition V(0)=V0 (used in all repetitions).
+        
+        All the repetitions are performed in a single call to the C kernel (see GIF.simulate_batch, which also describes seed and rep0).
         
         The function returns:
         
-        - time     : ms, support for V, eta_sum, V_T, spks
-        - V        : mV, membrane potential
-        - eta_sum  : nA, adaptation current
-        - V_T      : mV, firing threshold
-        - spks     : ms, list of spike times 
+        - all_spks : list of nb_rep arrays of spike times (ms), one for each repetition
+        - V        : mV, membrane potential (last repetition)
+        - eta_sum  : nA, adaptation current (last repetition)
+        - V_T      : mV, firing threshold (last repetition)
         
         """
  
         # Input parameters
         p_T         = len(I)
         p_dt        = self.dt
+        p_exact     = int(self.getIntegrator() == 'exact')
+        p_rescaling = int(self.getSampling() == 'rescaling')
         
         # Model parameters
         p_gl        = self.gl
@@ -145,6 +148,12 @@ class iGIF_NP(iGIF) :
         p_Vt_star   = self.Vt_star
         p_DV        = self.DV
         p_lambda0   = self.lambda0
+        p_V0        = V0
+        
+        # Random number generator (see Tools.philox_support_code)
+        if seed == None :
+            seed = Tools.getRandomSeed()
+        p_seed      = seed
 
 
         # Model parameters  definin threshold coupling      
@@ -155,134 +164,63 @@ class iGIF_NP(iGIF) :
         p_theta_i    = p_theta_i.astype("double")
               
                 
-        # Model kernels   
-        (p_eta_support, p_eta) = self.eta.getInterpolatedFilter(self.dt)   
-        p_eta       = p_eta.astype('double')
+        # Model kernels (see Filter.getSpikeUpdate)
+        (p_eta, p_eta_chg, p_eta_b, p_eta_d) = self.eta.getSpikeUpdate(self.dt)
         p_eta_l     = len(p_eta)
+        p_eta_chg_l = len(p_eta_chg)
+        p_eta_R     = len(p_eta_b)
 
-        (p_gamma_support, p_gamma) = self.gamma.getInterpolatedFilter(self.dt)   
-        p_gamma     = p_gamma.astype('double')
+        (p_gamma, p_gamma_chg, p_gamma_b, p_gamma_d) = self.gamma.getSpikeUpdate(self.dt)
         p_gamma_l   = len(p_gamma)
+        p_gamma_chg_l = len(p_gamma_chg)
+        p_gamma_R   = len(p_gamma_b)
       
-        # Define arrays
+        # Define arrays (shared by all the repetitions)
         V = np.array(np.zeros(p_T), dtype="double")
         I = np.array(I, dtype="double")
 
         theta_trace = np.array(np.zeros(p_T), dtype="double")        
-        R     = len(self.theta_bins)-1                 # subthreshold coupling theta
-        theta = np.zeros((p_T,R))
+        R     = len(self.theta_bins)-1                 # subthreshold coupling theta (only the current value of each component is stored)
+        theta = np.zeros(R)
         theta = theta.astype("double")
 
-        
-        spks = np.array(np.zeros(p_T), dtype="double")                      
-        eta_sum = np.array(np.zeros(p_T + 2*p_eta_l), dtype="double")
-        gamma_sum = np.array(np.zeros(p_T + 2*p_gamma_l), dtype="double")            
  
-        # Set initial condition
-        V[0] = V0
+        # Spike indices of each repetition are stored in a flat array (at most p_spks_max spikes per repetition)
+        p_spks_max  = Tools.getMaxSpikeNb(p_T, p_Tref, p_dt)
+        nb_rep_call = Tools.getRepetitionsPerCall(nb_rep, p_spks_max)
+        
+        # Spike-triggered processes (see Tools.adaptation_support_code)
+        eta_sum    = np.array(np.zeros(p_T), dtype="double")
+        eta_evt    = np.array(np.zeros(p_T), dtype="int32")
+        eta_starts = np.array(np.zeros(p_spks_max), dtype="int32")
+        eta_exp    = np.array(np.zeros(p_eta_R), dtype="double")
+        
+        gamma_sum    = np.array(np.zeros(p_T), dtype="double")
+        gamma_evt    = np.array(np.zeros(p_T), dtype="int32")
+        gamma_starts = np.array(np.zeros(p_spks_max), dtype="int32")
+        gamma_exp    = np.array(np.zeros(p_gamma_R), dtype="double")
          
-        code =  """
-                #include <math.h>
-                
-                int   T_ind      = int(p_T);                
-                float dt         = float(p_dt); 
-                
-                float gl         = float(p_gl);
-                float C          = float(p_C);
-                float El         = float(p_El);
-                float Vr         = float(p_Vr);
-                int   Tref_ind   = int(float(p_Tref)/dt);
-                float Vt_star    = float(p_Vt_star);
-                float DeltaV     = float(p_DV);
-                float lambda0    = float(p_lambda0);
-                float theta_tau  = float(p_theta_tau);
-
-                int eta_l        = int(p_eta_l);
-                int gamma_l      = int(p_gamma_l);
-                                            
-                float rand_max  = float(RAND_MAX); 
-                float p_dontspike = 0.0 ;
-                float lambda = 0.0 ;            
-                float rr = 0.0;
-
-                float theta_taufactor = (1.0-dt/theta_tau);                 
-                                                
-                for (int t=0; t<T_ind-1; t++) {
-    
-    
-                    // INTEGRATE VOLTAGE
-                    V[t+1] = V[t] + dt/C*( -gl*(V[t] - El) + I[t] - eta_sum[t] );
-               
-               
-                    // INTEGRATION THRESHOLD DYNAMICS                
-                    //////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
-                    for (int r=0; r<R; r++) { 
-                
-                        theta[t+1,r] = theta_taufactor*theta[t,r];                           // everybody decay
-                        
-                        if ( V[t] >= p_theta_bins[r] && V[t] < p_theta_bins[r+1] ) {         // identify who integrates
-                            theta[t+1,r] += dt/theta_tau;
-                        }
-                    }
-                    
-                    float theta_tot = 0.0;
-                    for (int r=0; r<R; r++) { 
-                        theta_tot += p_theta_i[r]*theta[t+1,r];
-                    }                
-                    
-                    theta_trace[t+1] = theta_tot;
-                    //////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
-               
-               
-    
-                    // COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
-                    lambda = lambda0*exp( (V[t+1]-Vt_star-gamma_sum[t+1]-theta_trace[t+1])/DeltaV );
-                    p_dontspike = exp(-lambda*(dt/1000.0));                                  // since lambda0 is in Hz, dt must also be in Hz (this is why dt/1000.0)
-                          
-                          
-                    // PRODUCE SPIKE STOCHASTICALLY
-                    rr = rand()/rand_max;
-                    if (rr > p_dontspike) {
-                                        
-                        if (t+1 < T_ind-1)                
-                            spks[t+1] = 1.0; 
-                        
-                        t = t + Tref_ind;    
-                        
-                        if (t+1 < T_ind-1){ 
-                            V[t+1] = Vr;
-                            
-                            for (int r=0; r<R; r++) 
-                                theta[t+1,r] = 0.0;
-                        }
-                        
-                        // UPDATE ADAPTATION PROCESSES     
-                        for(int j=0; j<eta_l; j++) 
-                            eta_sum[t+1+j] += p_eta[j]; 
-                        
-                        for(int j=0; j<gamma_l; j++) 
-                            gamma_sum[t+1+j] += p_gamma[j] ;  
-                        
-                    }
-               
-                }
-                
-                """
- 
-        vars = [ 'theta_trace', 'theta', 'R', 'p_theta_tau', 'p_theta_bins', 'p_theta_i', 'p_T','p_dt','p_gl','p_C','p_El','p_Vr','p_Tref','p_Vt_star','p_DV','p_lambda0','V','I','p_eta','p_eta_l','eta_sum','p_gamma','gamma_sum','p_gamma_l','spks' ]
         
-        v = weave.inline(code, vars)
+        all_spks = []
+        
+        for rep_start in np.arange(0, nb_rep, nb_rep_call) :
+            
+            p_nb_rep = int(min(nb_rep_call, nb_rep - rep_start))
+            p_rep0   = int(rep0 + rep_start)
+            spks_i   = np.array(np.zeros(p_nb_rep*p_spks_max), dtype="int32")
+            spks_nb  = np.array(np.zeros(p_nb_rep), dtype="int32")
+        
+            kernel_iGIF_NP_simulate.run(locals())
+            
+            all_spks.extend( Tools.splitSpikeIndices(spks_i, spks_nb, p_spks_max, self.dt) )
 
-        time      = np.arange(p_T)*self.dt
-        eta_sum   = eta_sum[:p_T]     
-        V_T       = gamma_sum[:p_T] + p_Vt_star + theta_trace[:p_T]
-        spks      = (np.where(spks==1)[0])*self.dt
+        V_T       = gamma_sum + p_Vt_star + theta_trace[:p_T]
     
-        return (time, V, eta_sum, V_T, spks)
+        return (all_spks, V, eta_sum, V_T)
 
                
      
-    def fit(self, experiment, DT_beforeSpike = 5.0, theta_inf_nbbins=5, theta_tau_all=np.linspace(1.0, 10.0, 5), last_bin_constrained=False, do_plot=False):
+    def fit(self, experiment, DT_beforeSpike = 5.0, theta_inf_nbbins=5, theta_tau_all=np.linspace(1.0, 10.0, 5), last_bin_constrained=False, do_plot=False, n_jobs=1):
         
         """
         Fit the iGIF_NP model on experimental data (details of the mehtod can be found in Mensi et al. 2016).
@@ -303,6 +241,8 @@ class iGIF_NP(iGIF) :
         
         - do_plot          : if True, a plot is made which shows the max likelihood as a function of the timescale tau_theta.
         
+        - n_jobs           : number of worker processes among which the timescales in theta_tau_all are distributed (-1: one per CPU, see Tools.parallelMap).
+        
         The parameter DT_beforeSpike (in ms) defines the region that is cut before each spike when fitting the subthreshold dynamics of the membrane potential.
         Only training set traces in experiment are used to perform the fit.
         """
@@ -317,11 +257,22 @@ class iGIF_NP(iGIF) :
         
         self.fitSubthresholdDynamics(experiment, DT_beforeSpike=DT_beforeSpike)
         
-        self.defineBinningForThetaInf(experiment, theta_inf_nbbins, last_bin_constrained=last_bin_constrained) 
-        
         self.fitStaticThreshold(experiment)
         
-        self.fitThresholdDynamics(experiment, theta_tau_all, do_plot=do_plot)
+        self.fitSpecificStages(experiment, theta_inf_nbbins=theta_inf_nbbins, theta_tau_all=theta_tau_all, last_bin_constrained=last_bin_constrained, do_plot=do_plot, n_jobs=n_jobs)
+        
+        
+    def fitSpecificStages(self, experiment, theta_inf_nbbins=5, theta_tau_all=np.linspace(1.0, 10.0, 5), last_bin_constrained=False, do_plot=False, n_jobs=1):
+        
+        """
+        Fit the parameters that are specific to the iGIF_NP model (binning of theta_inf and threshold dynamics, see fit for the
+        input parameters). This is the last step of fit, which assumes that fitVoltageReset, fitSubthresholdDynamics and 
+        fitStaticThreshold have been performed (see ModelFamily).
+        """
+        
+        self.defineBinningForThetaInf(experiment, theta_inf_nbbins, last_bin_constrained=last_bin_constrained) 
+        
+        self.fitThresholdDynamics(experiment, theta_tau_all, do_plot=do_plot, n_jobs=n_jobs)
 
         self.fit_flag = True
   
@@ -346,7 +297,7 @@ class iGIF_NP(iGIF) :
             if tr.useTrace :              
                                 
                 # Simulate subthreshold dynamics 
-                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes(tr.I, tr.V[0], tr.getSpikeTimes())
+                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes_trace(tr)
                   
                 all_V_spikes.append(V_est[tr.getSpikeIndices()])
  
@@ -378,7 +329,7 @@ class iGIF_NP(iGIF) :
     # FUNCTIONS TO FIT DYNAMIC THRESHLD
     ########################################################################################################
     
-    def fitThresholdDynamics(self, experiment, theta_tau_all, do_plot=False):
+    def fitThresholdDynamics(self, experiment, theta_tau_all, do_plot=False, n_jobs=1):
                         
         self.setDt(experiment.dt)
         
@@ -388,7 +339,7 @@ class iGIF_NP(iGIF) :
         
         # Perform fit        
         beta0_dynamicThreshold = np.concatenate( ( [1/self.DV], [-self.Vt_star/self.DV], self.gamma.getCoefficients()/self.DV, self.theta_i))        
-        (beta_opt, theta_tau_opt) = self.maximizeLikelihood_dynamicThreshold(experiment, beta0_dynamicThreshold, theta_tau_all, do_plot=do_plot)
+        (beta_opt, theta_tau_opt) = self.maximizeLikelihood_dynamicThreshold(experiment, beta0_dynamicThreshold, theta_tau_all, do_plot=do_plot, n_jobs=n_jobs)
         
         # Store result
         self.DV      = 1.0/beta_opt[0]
@@ -402,91 +353,39 @@ class iGIF_NP(iGIF) :
       
       
          
-    def maximizeLikelihood_dynamicThreshold(self, experiment, beta0, theta_tau_all, maxIter=10**3, stopCond=10**-6, do_plot=False) :
+    def maximizeLikelihood_dynamicThreshold(self, experiment, beta0, theta_tau_all, maxIter=10**3, stopCond=10**-6, do_plot=False, n_jobs=1) :
     
-        beta_all = []
-        L_all = []
-    
-        for theta_tau in theta_tau_all :
-    
-            print "\nTest tau_theta = %0.1f ms... \n" % (theta_tau)
-
-            # Precompute all the matrices used in the gradient ascent
-            
-            all_X        = []
-            all_X_spikes = []
-            all_sum_X_spikes = []
-            
-            T_tot = 0.0
-            N_spikes_tot = 0.0
-            
-            traces_nb = 0
-            
-    
-            
-            for tr in experiment.trainingset_traces:
-                
-                if tr.useTrace :              
-                    
-                    traces_nb += 1
-                    
-                    # Simulate subthreshold dynamics 
-                    (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes(tr.I, tr.V[0], tr.getSpikeTimes())
-                    
-                    # Precomputes matrices to perform gradient ascent on log-likelihood
-                    (X_tmp, X_spikes_tmp, sum_X_spikes_tmp, N_spikes, T) = self.buildXmatrix_dynamicThreshold(tr, V_est, theta_tau) 
-                        
-                    T_tot        += T
-                    N_spikes_tot += N_spikes
-                        
-                    all_X.append(X_tmp)
-                    all_X_spikes.append(X_spikes_tmp)
-                    all_sum_X_spikes.append(sum_X_spikes_tmp)
-            
+        """
+        Maximize the likelihood for each timescale in theta_tau_all and retain the best one.
+        The fits associated with different timescales are independent. They are distributed in contiguous blocks among n_jobs
+        worker processes (see Tools.parallelMap), which share the training traces, the subthreshold voltage V_est and the
+        columns of X that do not depend on theta_tau (see buildXmatrix_dynamicThreshold_shared).
+        Within a block, each fit starts from the solution obtained with the previous timescale.
+        """
     
+        # Simulate subthreshold dynamics and compute the columns of X that do not depend on theta_tau
+        
+        traces = []
+        
+        for tr in experiment.trainingset_traces:
             
-            logL_poisson = N_spikes_tot*(np.log(N_spikes_tot/T_tot)-1)
-    
-    
-            # Perform gradient ascent
-    
-            print "Maximize log-likelihood (bit/spks)..."
-                            
-            beta = beta0
-            old_L = 1
-    
-            for i in range(maxIter) :
-                
-                learning_rate = 1.0
-                
-                if i<=10 :                      # be careful in the first iterations (using a small learning rate in the first step makes the fit more stable)
-                    learning_rate = 0.1
-                
-                
-                L=0; G=0; H=0;  
-                    
-                for trace_i in np.arange(traces_nb):
-                    (L_tmp,G_tmp,H_tmp) = self.computeLikelihoodGradientHessian(beta, all_X[trace_i], all_X_spikes[trace_i], all_sum_X_spikes[trace_i])
-                    L+=L_tmp; G+=G_tmp; H+=H_tmp;
-                
-                beta = beta - learning_rate*np.dot(inv(H),G)
-                    
-                if (i>0 and abs((L-old_L)/old_L) < stopCond) :              # If converged
-                    print "\nConverged after %d iterations!\n" % (i+1)
-                    break
-                
-                old_L = L
+            if tr.useTrace :              
                 
-                # Compute normalized likelihood (for print)
-                # The likelihood is normalized with respect to a poisson process and units are in bit/spks
-                L_norm = (L-logL_poisson)/np.log(2)/N_spikes_tot
-                reprint(L_norm)
+                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes_trace(tr)
+                traces.append( (tr, V_est, self.buildXmatrix_dynamicThreshold_shared(tr, V_est)) )
         
-            if (i==maxIter - 1) :                                           # If too many iterations
-                print "\nNot converged after %d iterations.\n" % (maxIter)
-    
-            L_all.append(L_norm)
-            beta_all.append(beta)
+        
+        # Distribute the timescales among the worker processes (in contiguous blocks)
+        
+        blocks = np.array_split(np.array(theta_tau_all, dtype='double'), min(Tools.getJobsNb(n_jobs), len(theta_tau_all)))
+        
+        results = []
+        
+        for results_block in Tools.parallelMap(maximizeLikelihood_thetaTau_task, blocks, n_jobs=n_jobs, data=(self, traces, beta0, maxIter, stopCond)) :
+            results.extend(results_block)
+        
+        beta_all = [ beta for (beta, L_norm) in results ]
+        L_all    = [ L_norm for (beta, L_norm) in results ]
         
         ind_opt = np.argmax(L_all)
         
@@ -516,12 +415,52 @@ class iGIF_NP(iGIF) :
        
    
         
+    def maximizeLikelihood_thetaTau(self, traces, theta_tau, beta0, maxIter=10**3, stopCond=10**-6) :
+        
+        """
+        Maximize the likelihood for a given timescale theta_tau.
+        traces is a list of tuples (tr, V_est, X_shared), where V_est is the subthreshold voltage simulated on the trace tr
+        and X_shared is returned by buildXmatrix_dynamicThreshold_shared.
+        Return the optimal parameters beta and the normalized log-likelihood (bit/spike).
+        """
+        
+        print "\nTest tau_theta = %0.1f ms... \n" % (theta_tau)
+        
+        # Precompute all the matrices used in the gradient ascent
+        
+        glm = self.getPoissonGLM(maxIter=maxIter, stopCond=stopCond)
+        
+        for (tr, V_est, X_shared) in traces :
+            glm.addTrace(*self.buildXmatrix_dynamicThreshold_thetaTau(tr, V_est, X_shared, theta_tau))
+        
+        # Perform gradient ascent
+        
+        beta = glm.maximizeLikelihood(beta0)
+        
+        return (beta, glm.L_norm)
+       
+   
+        
     def buildXmatrix_dynamicThreshold(self, tr, V_est, theta_tau) :
 
         """
         Use this function to fit a model in which the firing threshold dynamics is defined as:
         V_T(t) = Vt_star + sum_i gamma(t-\hat t_i) (i.e., model with spike-triggered movement of the threshold)
         """
+        
+        X_shared = self.buildXmatrix_dynamicThreshold_shared(tr, V_est)
+        
+        return self.buildXmatrix_dynamicThreshold_thetaTau(tr, V_est, X_shared, theta_tau)
+        
+        
+    def buildXmatrix_dynamicThreshold_shared(self, tr, V_est) :
+
+        """
+        Compute the columns of the matrix X that do not depend on theta_tau (V, 1 and gamma), as well as the
+        selection of the time steps used in the fit. The result is used by buildXmatrix_dynamicThreshold_thetaTau
+        and can be shared by all the timescales tested during the fit.
+        Return (X, X_spikes, sum_X_spikes, N_spikes, T_l, selection, spks_i_afterselection).
+        """
            
         # Get indices be removing absolute refractory periods (-self.dt is to not include the time of spike)       
         selection = tr.getROI_FarFromSpikes(-tr.dt, self.Tref)
@@ -547,15 +486,31 @@ class iGIF_NP(iGIF) :
         X_gamma = self.gamma.convolution_Spiketrain_basisfunctions(tr.getSpikeTimes() + self.Tref, tr.T, tr.dt)
         X = np.concatenate( (X, X_gamma[selection,:]), axis=1 )
   
-        # Fill columns related with nonlinera coupling
-        X_theta = self.exponentialFiltering_ref(V_est, tr.getSpikeIndices(), theta_tau)
-        X = np.concatenate( (X, X_theta[selection,:]), axis=1 )  
-  
   
         # Precompute other quantities
         X_spikes = X[spks_i_afterselection,:]
         sum_X_spikes = np.sum( X_spikes, axis=0)
         
+        return (X, X_spikes, sum_X_spikes,  N_spikes, T_l, selection, spks_i_afterselection)
+
+
+    def buildXmatrix_dynamicThreshold_thetaTau(self, tr, V_est, X_shared, theta_tau) :
+
+        """
+        Append the columns related with the nonlinear coupling (which depend on theta_tau) to the columns
+        computed by buildXmatrix_dynamicThreshold_shared. Only one exponential filtering of V_est is performed.
+        """
+
+        (X, X_spikes, sum_X_spikes, N_spikes, T_l, selection, spks_i_afterselection) = X_shared
+
+        # Fill columns related with nonlinera coupling
+        X_theta = self.exponentialFiltering_ref(V_est, tr.getSpikeIndices(), theta_tau)[selection,:]
+        X_theta_spikes = X_theta[spks_i_afterselection,:]
+
+        X            = np.concatenate( (X, X_theta), axis=1 )
+        X_spikes     = np.concatenate( (X_spikes, X_theta_spikes), axis=1 )
+        sum_X_spikes = np.concatenate( (sum_X_spikes, np.sum(X_theta_spikes, axis=0)) )
+
         return (X, X_spikes, sum_X_spikes,  N_spikes, T_l)
 
 
@@ -594,15 +549,353 @@ class iGIF_NP(iGIF) :
         V = np.array(V, dtype="double")
 
         R      = len(self.theta_bins)-1                 # subthreshold coupling theta
-        theta  = np.zeros((p_T,R))
+        theta  = np.zeros(p_T*R)                        # theta(t,r) is stored in theta[t*R+r]
         theta  = theta.astype("double")
 
         spks   = np.array(spks_ind, dtype='double')
         p_spks_L = len(spks)
+
+        kernel_iGIF_NP_exponentialFiltering.run(locals())
+            
+        return theta.reshape((p_T, R))
+     
+         
+    ########################################################################################################
+    # PLOT AND PRINT FUNCTIONS
+    ########################################################################################################     
+
+    def printParameters(self):
+
+        print "\n-------------------------"        
+        print "iGIF_NP model parameters:"
+        print "-------------------------"
+        print "tau_m (ms):\t%0.3f"  % (self.C/self.gl)
+        print "R (MOhm):\t%0.6f"    % (1.0/self.gl)
+        print "C (nF):\t\t%0.3f"    % (self.C)
+        print "gl (nS):\t%0.3f"     % (self.gl)
+        print "El (mV):\t%0.3f"     % (self.El)
+        print "Tref (ms):\t%0.3f"   % (self.Tref)
+        print "Vr (mV):\t%0.3f"     % (self.Vr)     
+        print "Vt* (mV):\t%0.3f"    % (self.Vt_star)    
+        print "DV (mV):\t%0.3f"     % (self.DV)  
+        print "tau_theta (ms):\t%0.3f"     % (self.theta_tau)        
+        print "-------------------------\n"
+                  
+                      
+    def plotParameters(self) :
         
+        super(iGIF_NP, self).plotParameters()
+
+        if self.fit_flag :
+            
+            plt.subplot(1,4,4)
+            plt.plot(self.fit_all_tau_theta, self.fit_all_likelihood, '.-', color='black')
+            plt.plot([self.theta_tau], [np.max(self.fit_all_likelihood)], '.', color='red')            
+            plt.xlabel('Threshold coupling timescale (ms)')
+            plt.ylabel('Max log-likelihood (bit/spike)')
+
+
+        plt.subplots_adjust(left=0.07, bottom=0.2, right=0.98, top=0.90, wspace=0.35, hspace=0.10)
+        
+        plt.show()
+
+
+def maximizeLikelihood_thetaTau_task(data, theta_tau_block):
+
+    """
+    Fits of iGIF_NP.maximizeLikelihood_dynamicThreshold for a block of timescales (executed by the worker processes).
+    Each fit starts from the solution obtained with the previous timescale of the block.
+    """
+
+    (model, traces, beta0, maxIter, stopCond) = data
+
+    results = []
+
+    for theta_tau in theta_tau_block :
+
+        (beta, L_norm) = model.maximizeLikelihood_thetaTau(traces, theta_tau, beta0, maxIter=maxIter, stopCond=stopCond)
+        beta0 = beta
+
+        results.append( (beta, L_norm) )
+
+    return results
+
+
+########################################################################################################
+# KERNELS (see Kernel)
+########################################################################################################
+
+def iGIF_NP_simulate_ref(theta_trace, theta, R, p_theta_tau, p_theta_bins, p_theta_i,
+                         p_T, p_dt, p_exact, p_rescaling, p_gl, p_C, p_El, p_Vr, p_Tref, p_Vt_star, p_DV, p_lambda0, p_V0, V, I, 
+                         p_eta, p_eta_l, p_eta_chg, p_eta_chg_l, p_eta_b, p_eta_d, p_eta_R, eta_sum, eta_evt, eta_starts, eta_exp, 
+                         p_gamma, p_gamma_l, p_gamma_chg, p_gamma_chg_l, p_gamma_b, p_gamma_d, p_gamma_R, gamma_sum, gamma_evt, gamma_starts, gamma_exp, 
+                         p_nb_rep, p_seed, p_rep0, p_spks_max, spks_i, spks_nb):
+    
+    T_ind    = p_T
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    dtC = p_dt/p_C
+    if p_exact == 1 :
+        dtC = -np.expm1(-p_dt*p_gl/p_C)/p_gl
+    
+    theta_taufactor = 1.0 - p_dt/p_theta_tau
+    
+    eta_proc   = process_new(eta_sum, p_eta, p_eta_chg, eta_evt, eta_starts, p_eta_b, p_eta_d, eta_exp)
+    gamma_proc = process_new(gamma_sum, p_gamma, p_gamma_chg, gamma_evt, gamma_starts, p_gamma_b, p_gamma_d, gamma_exp)
+
+    sampler_i  = np.zeros(1, dtype=np.int32)
+    sampler_d  = np.zeros(2)
+    
+    for rep in range(p_nb_rep) :
+        
+        # RESET STATE VARIABLES
+        V[:]           = 0.0
+        theta_trace[:] = 0.0
+        theta[:]       = 0.0
+        process_reset(eta_proc)
+        process_reset(gamma_proc)
+        sampler_reset(sampler_i, sampler_d)
+        
+        V[0] = p_V0
+        
+        spks_cnt = 0
+        
+        t = 0
+        while t < T_ind-1 :
+            
+            # COMPUTE ADAPTATION PROCESSES
+            process_advance(eta_proc, t+1)
+            process_advance(gamma_proc, t+2)
+            
+            # INTEGRATE VOLTAGE
+            V[t+1] = V[t] + dtC*( -p_gl*(V[t] - p_El) + I[t] - eta_sum[t] )
+            
+            # INTEGRATION THRESHOLD DYNAMICS
+            theta_tot = 0.0
+            for r in range(R) :
+                theta[r] = theta_taufactor*theta[r]
+                if V[t] >= p_theta_bins[r] and V[t] < p_theta_bins[r+1] :
+                    theta[r] += p_dt/p_theta_tau
+                theta_tot += p_theta_i[r]*theta[r]
+                
+            theta_trace[t+1] = theta_tot
+            
+            # COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+            lambda_t    = p_lambda0*np.exp( (V[t+1]-p_Vt_star-gamma_sum[t+1]-theta_trace[t+1])/p_DV )
+            
+            # PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+            if sample_spike(p_rescaling, p_seed, p_rep0 + rep, t, lambda_t, p_dt, sampler_i, sampler_d) :
+                
+                if t+1 < T_ind-1 and spks_cnt < p_spks_max :
+                    spks_i[rep*p_spks_max + spks_cnt] = t+1
+                    spks_cnt += 1
+                    
+                t = t + Tref_ind
+                
+                if t+1 < T_ind-1 :
+                    V[t+1]   = p_Vr
+                    theta[:] = 0.0
+                    
+                # UPDATE ADAPTATION PROCESSES
+                process_spike(eta_proc, t+1)
+                process_spike(gamma_proc, t+1)
+                
+            t += 1
+            
+        process_advance(eta_proc, T_ind)
+        process_advance(gamma_proc, T_ind)
+        
+        spks_nb[rep] = spks_cnt
+
+
+kernel_iGIF_NP_simulate = Kernel('iGIF_NP_simulate',
+        [ 
+          'double* theta_trace', 'double* theta', 'int R', 'double p_theta_tau', 'double* p_theta_bins',
+          'double* p_theta_i', 'int p_T', 'double p_dt', 'int p_exact', 'int p_rescaling', 'double p_gl', 'double p_C', 'double p_El',
+          'double p_Vr', 'double p_Tref', 'double p_Vt_star', 'double p_DV', 'double p_lambda0',
+          'double p_V0', 'double* V', 'double* I', 'double* p_eta', 'int p_eta_l', 'int* p_eta_chg',
+          'int p_eta_chg_l', 'double* p_eta_b', 'double* p_eta_d', 'int p_eta_R', 'double* eta_sum',
+          'int* eta_evt', 'int* eta_starts', 'double* eta_exp', 'double* p_gamma', 'int p_gamma_l',
+          'int* p_gamma_chg', 'int p_gamma_chg_l', 'double* p_gamma_b', 'double* p_gamma_d', 'int p_gamma_R',
+          'double* gamma_sum', 'int* gamma_evt', 'int* gamma_starts', 'double* gamma_exp', 'int p_nb_rep', 'int p_seed', 'int p_rep0',
+          'int p_spks_max', 'int* spks_i', 'int* spks_nb' 
+        ],
+        """
+                
+                int   T_ind      = int(p_T);                
+                float dt         = float(p_dt); 
+                
+                float gl         = float(p_gl);
+                float C          = float(p_C);
+                float El         = float(p_El);
+                float Vr         = float(p_Vr);
+                int   Tref_ind   = int(float(p_Tref)/dt);
+                float dtC        = dt/C;                                     // forward Euler
+                if (p_exact == 1)
+                    dtC = -expm1(-dt*gl/C)/gl;                               // exact integration (I and eta constant during one time step)
+                float Vt_star    = float(p_Vt_star);
+                float DeltaV     = float(p_DV);
+                float lambda0    = float(p_lambda0);
+                float theta_tau  = float(p_theta_tau);
+
+                int eta_l        = int(p_eta_l);
+                int gamma_l      = int(p_gamma_l);
+                
+                int nb_rep       = int(p_nb_rep);
+                int spks_max     = int(p_spks_max);
+                
+                SpikeProcess eta_proc;
+                SpikeProcess gamma_proc;
+                process_init(&eta_proc, eta_sum, T_ind, p_eta, eta_l, p_eta_chg, int(p_eta_chg_l), eta_evt, eta_starts, spks_max, p_eta_b, p_eta_d, eta_exp, int(p_eta_R));
+                process_init(&gamma_proc, gamma_sum, T_ind, p_gamma, gamma_l, p_gamma_chg, int(p_gamma_chg_l), gamma_evt, gamma_starts, spks_max, p_gamma_b, p_gamma_d, gamma_exp, int(p_gamma_R));
+                                            
+                float lambda = 0.0 ;            
+                int    sampler_i[1];                                              // state of the spike sampler (see Tools.sampler_support_code)
+                double sampler_d[2];
+
+                float theta_taufactor = (1.0-dt/theta_tau);                 
+                
+                
+                for (int rep=0; rep<nb_rep; rep++) {
+                
+                
+                    // RESET STATE VARIABLES
+                    for (int t=0; t<T_ind; t++) {
+                        V[t] = 0.0;
+                        theta_trace[t] = 0.0;
+                    }
+                    
+                    for (int r=0; r<R; r++)
+                        theta[r] = 0.0;
+                        
+                    process_reset(&eta_proc);
+                    process_reset(&gamma_proc);
+                    sampler_reset(sampler_i, sampler_d);
+                    
+                    V[0] = p_V0;
+                    
+                    int spks_cnt = 0;
+                    
+                                                    
+                    for (int t=0; t<T_ind-1; t++) {
+        
+        
+                        // COMPUTE ADAPTATION PROCESSES
+                        process_advance(&eta_proc, t+1);
+                        process_advance(&gamma_proc, t+2);
+        
+        
+                        // INTEGRATE VOLTAGE
+                        V[t+1] = V[t] + dtC*( -gl*(V[t] - El) + I[t] - eta_sum[t] );
+                   
+                   
+                        // INTEGRATION THRESHOLD DYNAMICS                
+                        //////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+                        for (int r=0; r<R; r++) { 
+                    
+                            theta[r] = theta_taufactor*theta[r];                                 // everybody decay
+                            
+                            if ( V[t] >= p_theta_bins[r] && V[t] < p_theta_bins[r+1] ) {         // identify who integrates
+                                theta[r] += dt/theta_tau;
+                            }
+                        }
+                        
+                        float theta_tot = 0.0;
+                        for (int r=0; r<R; r++) { 
+                            theta_tot += p_theta_i[r]*theta[r];
+                        }                
+                        
+                        theta_trace[t+1] = theta_tot;
+                        //////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+                   
+                   
         
-        code =  """
-                #include <math.h>
+                        // COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+                        lambda = lambda0*exp( (V[t+1]-Vt_star-gamma_sum[t+1]-theta_trace[t+1])/DeltaV );
+                              
+                              
+                        // PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+                        if (sample_spike(p_rescaling, (unsigned int)(p_seed), (unsigned int)(p_rep0 + rep), (unsigned int)(t), lambda, dt, sampler_i, sampler_d)) {
+                                            
+                            if (t+1 < T_ind-1 && spks_cnt < spks_max) {
+                                spks_i[rep*spks_max + spks_cnt] = t+1;
+                                spks_cnt++;
+                            }
+                            
+                            t = t + Tref_ind;    
+                            
+                            if (t+1 < T_ind-1){ 
+                                V[t+1] = Vr;
+                                
+                                for (int r=0; r<R; r++) 
+                                    theta[r] = 0.0;
+                            }
+                            
+                            // UPDATE ADAPTATION PROCESSES     
+                            process_spike(&eta_proc, t+1);
+                            process_spike(&gamma_proc, t+1);
+                            
+                        }
+                   
+                    }
+                    
+                    process_advance(&eta_proc, T_ind);
+                    process_advance(&gamma_proc, T_ind);
+                    
+                    spks_nb[rep] = spks_cnt;
+                    
+                }
+                
+                """,
+        iGIF_NP_simulate_ref,
+        support_code=Tools.adaptation_support_code + Tools.philox_support_code + Tools.sampler_support_code,
+        helpers=[process_new, process_reset, process_advance, process_spike, philox_uniform, sampler_reset, sample_spike])
+
+
+def iGIF_NP_exponentialFiltering_ref(spks, p_spks_L, theta, R, p_theta_tau, p_theta_bins, p_T, p_dt, p_Tref, V):
+    
+    T_ind    = p_T
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    theta_taufactor = 1.0 - p_dt/p_theta_tau
+    
+    spks_cnt   = 0
+    next_spike = T_ind + 1
+    if p_spks_L > 0 :
+        next_spike = int(spks[0])
+        
+    t = 0
+    while t < T_ind-1 :
+        
+        # INTEGRATION THRESHOLD DYNAMICS
+        for r in range(R) :
+            theta[(t+1)*R + r] = theta_taufactor*theta[t*R + r]
+            if V[t] >= p_theta_bins[r] and V[t] < p_theta_bins[r+1] :
+                theta[(t+1)*R + r] += p_dt/p_theta_tau
+                
+        # MANAGE RESET
+        if t+1 >= next_spike :
+            
+            spks_cnt  += 1
+            next_spike = T_ind + 1
+            if spks_cnt < p_spks_L :
+                next_spike = int(spks[spks_cnt])
+                
+            if t + Tref_ind < T_ind-1 :
+                for r in range(R) :
+                    theta[(t + Tref_ind)*R + r] = 0.0
+                    
+            t = t + Tref_ind
+            
+        t += 1
+
+
+kernel_iGIF_NP_exponentialFiltering = Kernel('iGIF_NP_exponentialFiltering',
+        [ 
+          'double* spks', 'int p_spks_L', 'double* theta', 'int R', 'double p_theta_tau',
+          'double* p_theta_bins', 'int p_T', 'double p_dt', 'double p_Tref', 'double* V' 
+        ],
+        """
                 
                 int   T_ind      = int(p_T);                
                 float dt         = float(p_dt); 
@@ -613,7 +906,10 @@ class iGIF_NP(iGIF) :
                 
                 int spks_L     = int(p_spks_L);  
                 int spks_cnt   = 0;
-                int next_spike = int(spks(0));
+                int next_spike = T_ind+1;
+                
+                if (spks_L > 0)
+                    next_spike = int(spks[0]);
                                              
                 for (int t=0; t<T_ind-1; t++) {
     
@@ -622,10 +918,10 @@ class iGIF_NP(iGIF) :
                               
                     for (int r=0; r<R; r++) { 
                 
-                        theta(t+1,r) = theta_taufactor*theta(t,r);                           // everybody decay
+                        theta[(t+1)*R+r] = theta_taufactor*theta[t*R+r];                           // everybody decay
                         
-                        if ( V(t) >= p_theta_bins(r) && V(t) < p_theta_bins(r+1) ) {         // identify who integrates
-                            theta(t+1,r) += dt/theta_tau;
+                        if ( V[t] >= p_theta_bins[r] && V[t] < p_theta_bins[r+1] ) {         // identify who integrates
+                            theta[(t+1)*R+r] += dt/theta_tau;
                         }
                     }
        
@@ -634,18 +930,16 @@ class iGIF_NP(iGIF) :
                     
                     if ( t+1 >= next_spike ) {                                        
                    
-                        if(spks_cnt < spks_L) {
-                            spks_cnt  += 1;
-                            next_spike = int(spks(spks_cnt));
-                        }
-                        else {
-                            next_spike = T_ind+1;
-                        }
+                        spks_cnt  += 1;
+                        next_spike = T_ind+1;
+                        
+                        if (spks_cnt < spks_L)
+                            next_spike = int(spks[spks_cnt]);
                         
                         
                         if ( t + Tref_ind < T_ind-1 ) { 
                             for (int r=0; r<R; r++)  
-                                theta(t + Tref_ind ,r) = 0.0;                                // reset         
+                                theta[(t+Tref_ind)*R+r] = 0.0;                                // reset         
                         }   
                           
                         t = t + Tref_ind; 
@@ -654,50 +948,6 @@ class iGIF_NP(iGIF) :
                           
                 }
                 
-                """
- 
-        vars = [ 'spks', 'p_spks_L', 'theta', 'R', 'p_theta_tau', 'p_theta_bins', 'p_T','p_dt','p_Tref','V' ]
-        
-        v = weave.inline(code, vars, type_converters=converters.blitz)
-            
-        return theta
-     
-         
-    ########################################################################################################
-    # PLOT AND PRINT FUNCTIONS
-    ########################################################################################################     
-
-    def printParameters(self):
+                """,
+        iGIF_NP_exponentialFiltering_ref)
 
-        print "\n-------------------------"        
-        print "iGIF_NP model parameters:"
-        print "-------------------------"
-        print "tau_m (ms):\t%0.3f"  % (self.C/self.gl)
-        print "R (MOhm):\t%0.6f"    % (1.0/self.gl)
-        print "C (nF):\t\t%0.3f"    % (self.C)
-        print "gl (nS):\t%0.3f"     % (self.gl)
-        print "El (mV):\t%0.3f"     % (self.El)
-        print "Tref (ms):\t%0.3f"   % (self.Tref)
-        print "Vr (mV):\t%0.3f"     % (self.Vr)     
-        print "Vt* (mV):\t%0.3f"    % (self.Vt_star)    
-        print "DV (mV):\t%0.3f"     % (self.DV)  
-        print "tau_theta (ms):\t%0.3f"     % (self.theta_tau)        
-        print "-------------------------\n"
-                  
-                      
-    def plotParameters(self) :
-        
-        super(iGIF_NP, self).plotParameters()
-
-        if self.fit_flag :
-            
-            plt.subplot(1,4,4)
-            plt.plot(self.fit_all_tau_theta, self.fit_all_likelihood, '.-', color='black')
-            plt.plot([self.theta_tau], [np.max(self.fit_all_likelihood)], '.', color='red')            
-            plt.xlabel('Threshold coupling timescale (ms)')
-            plt.ylabel('Max log-likelihood (bit/spike)')
-
-
-        plt.subplots_adjust(left=0.07, bottom=0.2, right=0.98, top=0.90, wspace=0.35, hspace=0.10)
-        
-        plt.show()
\ No newline at end of file
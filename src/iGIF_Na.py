@@ -1,8 +1,9 @@
 import matplotlib.pyplot as plt
 import numpy as np
+import hashlib
 
-from scipy import weave
 from numpy.linalg import inv
+from scipy.optimize import fmin_l_bfgs_b
 
 from SpikingModel import *
 from iGIF import *
@@ -10,6 +11,8 @@ from Filter_Rect_LogSpaced import *
 
 import Tools
 from Tools import reprint
+from Tools import process_new, process_reset, process_advance, process_spike, philox_uniform, sampler_reset, sample_spike
+from Kernel import *
 
 
 class iGIF_Na(iGIF) :
@@ -58,6 +61,8 @@ class iGIF_Na(iGIF) :
         self.fit_all_Vi = 0                     # mV, list containing all the values tested during the fit for Vi        
         
         self.fit_all_likelihood = 0             # 2D matrix containing all the log-likelihood obtained with different (ki, Vi)
+        
+        self.fit_continuous_path = None         # array (ki, Vi, theta_tau, LL) evaluated by fitThresholdDynamics_continuous (None for a grid search)
 
           
             
@@ -90,7 +95,7 @@ class iGIF_Na(iGIF) :
         
         self.setDt(dt)
     
-        (time, V, eta_sum, V_T, spks_times) = self.simulate(I, self.El)
+        spks_times = self.simulate(I, self.El, output='spikes')
         
         return spks_times
    
@@ -111,22 +116,24 @@ class iGIF_Na(iGIF) :
     
     
     
-    def simulate(self, I, V0):
+    def simulate_batch(self, I, V0, nb_rep, seed=None, rep0=0):
  
         """
-        Simulate the spiking response of the GIF model to an input current I (nA) with time step dt.
-        V0 indicate the initial condition V(0)=V0.
+        Simulate nb_rep independent repetitions of the spiking response of the iGIF_Na model to an input current I (nA) with time step dt.
+        V0 indicate the initial condition V(0)=V0 (used in all repetitions).
+        All the repetitions are performed in a single call to the C kernel (see GIF.simulate_batch, which also describes seed and rep0).
         The function returns:
-        - time     : ms, support for V, eta_sum, V_T, spks
-        - V        : mV, membrane potential
-        - eta_sum  : nA, adaptation current
-        - V_T      : mV, firing threshold
-        - spks     : ms, list of spike times 
+        - all_spks : list of nb_rep arrays of spike times (ms), one for each repetition
+        - V        : mV, membrane potential (last repetition)
+        - eta_sum  : nA, adaptation current (last repetition)
+        - V_T      : mV, firing threshold (last repetition)
         """
  
         # Input parameters
         p_T         = len(I)
         p_dt        = self.dt
+        p_exact     = int(self.getIntegrator() == 'exact')
+        p_rescaling = int(self.getSampling() == 'rescaling')
         
         # Model parameters
         p_gl        = self.gl
@@ -137,6 +144,12 @@ class iGIF_Na(iGIF) :
         p_Vt_star   = self.Vt_star
         p_DV        = self.DV
         p_lambda0   = self.lambda0
+        p_V0        = V0
+        
+        # Random number generator (see Tools.philox_support_code)
+        if seed == None :
+            seed = Tools.getRandomSeed()
+        p_seed      = seed
         
         # Model parameters  definin threshold coupling      
         p_theta_ka  = self.theta_ka
@@ -145,108 +158,54 @@ class iGIF_Na(iGIF) :
         p_theta_tau = self.theta_tau
               
         
-        # Model kernels   
-        (p_eta_support, p_eta) = self.eta.getInterpolatedFilter(self.dt)   
-        p_eta       = p_eta.astype('double')
+        # Model kernels (see Filter.getSpikeUpdate)
+        (p_eta, p_eta_chg, p_eta_b, p_eta_d) = self.eta.getSpikeUpdate(self.dt)
         p_eta_l     = len(p_eta)
+        p_eta_chg_l = len(p_eta_chg)
+        p_eta_R     = len(p_eta_b)
 
-        (p_gamma_support, p_gamma) = self.gamma.getInterpolatedFilter(self.dt)   
-        p_gamma     = p_gamma.astype('double')
+        (p_gamma, p_gamma_chg, p_gamma_b, p_gamma_d) = self.gamma.getSpikeUpdate(self.dt)
         p_gamma_l   = len(p_gamma)
+        p_gamma_chg_l = len(p_gamma_chg)
+        p_gamma_R   = len(p_gamma_b)
       
-        # Define arrays
+        # Define arrays (shared by all the repetitions)
         V         = np.array(np.zeros(p_T), dtype="double")
         theta     = np.array(np.zeros(p_T), dtype="double")        
         I         = np.array(I, dtype="double")
-        spks      = np.array(np.zeros(p_T), dtype="double")                      
-        eta_sum   = np.array(np.zeros(p_T + 2*p_eta_l), dtype="double")
-        gamma_sum = np.array(np.zeros(p_T + 2*p_gamma_l), dtype="double")            
  
-        # Set initial condition
-        V[0] = V0
+        # Spike indices of each repetition are stored in a flat array (at most p_spks_max spikes per repetition)
+        p_spks_max  = Tools.getMaxSpikeNb(p_T, p_Tref, p_dt)
+        nb_rep_call = Tools.getRepetitionsPerCall(nb_rep, p_spks_max)
+        
+        # Spike-triggered processes (see Tools.adaptation_support_code)
+        eta_sum    = np.array(np.zeros(p_T), dtype="double")
+        eta_evt    = np.array(np.zeros(p_T), dtype="int32")
+        eta_starts = np.array(np.zeros(p_spks_max), dtype="int32")
+        eta_exp    = np.array(np.zeros(p_eta_R), dtype="double")
+        
+        gamma_sum    = np.array(np.zeros(p_T), dtype="double")
+        gamma_evt    = np.array(np.zeros(p_T), dtype="int32")
+        gamma_starts = np.array(np.zeros(p_spks_max), dtype="int32")
+        gamma_exp    = np.array(np.zeros(p_gamma_R), dtype="double")
          
-        code =  """
-                #include <math.h>
-                
-                int   T_ind      = int(p_T);                
-                float dt         = float(p_dt); 
-                
-                float gl         = float(p_gl);
-                float C          = float(p_C);
-                float El         = float(p_El);
-                float Vr         = float(p_Vr);
-                int   Tref_ind   = int(float(p_Tref)/dt);
-                float Vt_star    = float(p_Vt_star);
-                float DeltaV     = float(p_DV);
-                float lambda0    = float(p_lambda0);
-           
-                float theta_ka         = float(p_theta_ka);
-                float theta_ki         = float(p_theta_ki);
-                float theta_Vi         = float(p_theta_Vi);
-                float theta_tau        = float(p_theta_tau);
-              
-                int eta_l        = int(p_eta_l);
-                int gamma_l      = int(p_gamma_l);
-                                      
-                float rand_max  = float(RAND_MAX); 
-                float p_dontspike = 0.0 ;
-                float lambda = 0.0 ;            
-                float r = 0.0;
-                
-                                                
-                for (int t=0; t<T_ind-1; t++) {
-    
-    
-                    // INTEGRATE VOLTAGE
-                    V[t+1] = V[t] + dt/C*( -gl*(V[t] - El) + I[t] - eta_sum[t] );
-                    
-                    // INTEGRATE THETA                    
-                    theta[t+1] = theta[t] + dt/theta_tau*(-theta[t] + theta_ka*log(1+exp((V[t]-theta_Vi)/theta_ki))); 
+        
+        all_spks = []
+        
+        for rep_start in np.arange(0, nb_rep, nb_rep_call) :
             
-               
-                    // COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
-                    lambda = lambda0*exp( (V[t+1]-Vt_star-gamma_sum[t]-theta[t+1])/DeltaV );
-                    p_dontspike = exp(-lambda*(dt/1000.0));                                  // since lambda0 is in Hz, dt must also be in Hz (this is why dt/1000.0)
-                          
-                          
-                    // PRODUCE SPIKE STOCHASTICALLY
-                    r = rand()/rand_max;
-                    if (r > p_dontspike) {
-                                        
-                        if (t+1 < T_ind-1)                
-                            spks[t+1] = 1.0; 
-                        
-                        t = t + Tref_ind;    
-                        
-                        if (t+1 < T_ind-1) 
-                            V[t+1] = Vr;
-                        
-                        
-                        // UPDATE ADAPTATION PROCESSES     
-                        for(int j=0; j<eta_l; j++) 
-                            eta_sum[t+1+j] += p_eta[j]; 
-                        
-                        for(int j=0; j<gamma_l; j++) 
-                            gamma_sum[t+1+j] += p_gamma[j] ;  
-                        
-                    }
-               
-                }
-                
-                """
- 
-        vars = [ 'theta', 'p_theta_ka', 'p_theta_ki', 'p_theta_Vi', 'p_theta_tau', 'p_T','p_dt','p_gl','p_C','p_El','p_Vr','p_Tref','p_Vt_star','p_DV','p_lambda0','V','I','p_eta','p_eta_l','eta_sum','p_gamma','gamma_sum','p_gamma_l','spks' ]
+            p_nb_rep = int(min(nb_rep_call, nb_rep - rep_start))
+            p_rep0   = int(rep0 + rep_start)
+            spks_i   = np.array(np.zeros(p_nb_rep*p_spks_max), dtype="int32")
+            spks_nb  = np.array(np.zeros(p_nb_rep), dtype="int32")
         
-        v = weave.inline(code, vars)
-
-        time = np.arange(p_T)*self.dt
+            kernel_iGIF_Na_simulate.run(locals())
+            
+            all_spks.extend( Tools.splitSpikeIndices(spks_i, spks_nb, p_spks_max, self.dt) )
         
-        eta_sum   = eta_sum[:p_T]     
-        V_T = gamma_sum[:p_T] + p_Vt_star + theta[:p_T]
-     
-        spks = (np.where(spks==1)[0])*self.dt
+        V_T = gamma_sum + p_Vt_star + theta[:p_T]
     
-        return (time, V, eta_sum, V_T, spks)
+        return (all_spks, V, eta_sum, V_T)
 
         
          
@@ -255,7 +214,7 @@ class iGIF_Na(iGIF) :
     # FUNCTIONS TO FIT DYNAMIC THRESHOLD BY BRUTE FORCE
     ######################################################################################################################
     
-    def fit(self, experiment, theta_tau, ki_all, Vi_all, DT_beforeSpike=5.0, do_plot=False):
+    def fit(self, experiment, theta_tau, ki_all, Vi_all, DT_beforeSpike=5.0, do_plot=False, n_jobs=1, search='bruteforce', theta_tau_bounds=None):
            
         """
         Fit the model to the training set data in experiment.
@@ -263,11 +222,17 @@ class iGIF_Na(iGIF) :
         Input parameters:
         
         - experiment     : an instance of the class Experiment containing the experimental data that will be used for the fit (only training set data will be used).
-        - theta_tau      : ms, timescale of the threshold-voltage coupling (this parameter is not fitted but has to be known). To fit this parameter, fit first a GIF_NP model to the data.   
+        - theta_tau      : ms, timescale of the threshold-voltage coupling (this parameter is not fitted but has to be known, except with search='continuous'). To fit this parameter, fit first a GIF_NP model to the data.   
         - ki_all         : mV, array of values containing the parameters k_i (ie, Na channel inactivation slope) tested during the fit
         - Vi_all         : mV, array of values containing the parameters V_i (ie, Na channel half inactivation voltage) tested during the fit
         - DT_beforeSpike : ms, amount of time removed before each action potential (these data will not be considered when fitting the subthreshold membrane potential dynamics)
-        - doPlot         : if True plot the max-likelihood as a function of ki and Vi.
+        - doPlot         : if True plot the max-likelihood as a function of ki and Vi (with search='continuous', the values of ki and Vi evaluated during the optimization).
+        - n_jobs         : number of worker processes among which the grid points (ki, Vi) are distributed (-1: one per CPU, see Tools.parallelMap).
+        - search         : 'bruteforce' to evaluate all the grid points (see fitThresholdDynamics_bruteforce) or 'adaptive' 
+                           to search the grid from coarse to fine (see fitThresholdDynamics_adaptive, n_jobs is not used) or 'continuous' to
+                           optimize ki, Vi and theta_tau as continuous parameters (see fitThresholdDynamics_continuous). In that case, ki and Vi are
+                           searched between the min and the max of ki_all and Vi_all, and theta_tau within theta_tau_bounds.
+        - theta_tau_bounds : ms, tuple (min, max), interval over which theta_tau is searched with search='continuous' (default: theta_tau/10, 10*theta_tau).
         """
              
         print "\n################################"
@@ -280,18 +245,53 @@ class iGIF_Na(iGIF) :
         
         self.fitSubthresholdDynamics(experiment, DT_beforeSpike=DT_beforeSpike)
         
-        self.theta_tau = theta_tau
-        
         self.fitStaticThreshold(experiment)
+        
+        self.fitSpecificStages(experiment, theta_tau, ki_all, Vi_all, do_plot=do_plot, n_jobs=n_jobs, search=search, theta_tau_bounds=theta_tau_bounds)
+        
+        
+    def fitSpecificStages(self, experiment, theta_tau, ki_all, Vi_all, do_plot=False, n_jobs=1, search='bruteforce', theta_tau_bounds=None):
+        
+        """
+        Fit the parameters that are specific to the iGIF_Na model (threshold dynamics, see fit for the input parameters).
+        This is the last step of fit, which assumes that fitVoltageReset, fitSubthresholdDynamics and fitStaticThreshold 
+        have been performed (see ModelFamily).
+        """
+        
+        self.theta_tau = theta_tau
               
-        self.fitThresholdDynamics_bruteforce(experiment, ki_all, Vi_all, do_plot=do_plot)
+        if search == 'bruteforce' :
+            self.fitThresholdDynamics_bruteforce(experiment, ki_all, Vi_all, do_plot=do_plot, n_jobs=n_jobs)
+        
+        elif search == 'adaptive' :
+            self.fitThresholdDynamics_adaptive(experiment, ki_all, Vi_all, do_plot=do_plot)
+        
+        elif search == 'continuous' :
+            if theta_tau_bounds == None :
+                theta_tau_bounds = (theta_tau/10.0, theta_tau*10.0)
+            
+            self.fitThresholdDynamics_continuous(experiment, (np.min(ki_all), np.max(ki_all)), (np.min(Vi_all), np.max(Vi_all)), theta_tau_bounds, do_plot=do_plot)
+        
+        else :
+            raise ValueError("Unknown search %s (must be 'bruteforce', 'adaptive' or 'continuous')." % (search))
   
         #self.fit_bruteforce_flag = True
         #self.fit_binary_flag     = False
   
   
   
-    def fitThresholdDynamics_bruteforce(self, experiment, ki_all, Vi_all, do_plot=False):
+    def fitThresholdDynamics_bruteforce(self, experiment, ki_all, Vi_all, do_plot=False, n_jobs=1, batch_size=16):
+        
+        """
+        Fit the dynamic threshold for each pair of parameters (ki, Vi) in the grid ki_all x Vi_all and retain the best one.
+        The subthreshold voltage V_est and the columns of X that do not depend on ki and Vi are computed once per training trace
+        (see buildXmatrix_dynamicThreshold_shared). The grid points are visited along a serpentine path (so that consecutive
+        points are neighbours) which is split in contiguous blocks among n_jobs worker processes (see Tools.parallelMap).
+        The worker processes share the precomputed data. Within a block, each fit starts from the solution of the previous point.
+        The nonlinear coupling is computed for batch_size consecutive points at once (see exponentialFiltering_Brette_ref_batch),
+        which requires the memory of batch_size columns of X.
+        The log-likelihood of all the grid points is stored in self.fit_all_likelihood.
+        """
         
         # Fit a dynamic threshold using a initial condition the result obtained by fitting a static threshold
 
@@ -300,49 +300,314 @@ class iGIF_Na(iGIF) :
         #beta0_dynamicThreshold = np.concatenate( ( [1/self.DV], [-self.Vt_star/self.DV], [0], self.gamma.getCoefficients()/self.DV))        
         beta0_dynamicThreshold = np.concatenate( ( [1/self.DV], [-self.Vt_star/self.DV], [0], np.zeros(self.gamma.getNbOfBasisFunctions())))        
          
-             
+        
+        # Simulate subthreshold dynamics and compute the columns of X that do not depend on ki and Vi
+        
+        traces = self.getTraces_dynamicThreshold(experiment)
+        
+        
+        # Serpentine path through the grid, split in contiguous blocks
+        
+        grid = []
+        
+        for ki_i in np.arange(len(ki_all)) :
+            
+            Vi_range = np.arange(len(Vi_all))
+            
+            if ki_i % 2 == 1 :
+                Vi_range = Vi_range[::-1]
+            
+            grid.extend([ (ki_i, Vi_i, ki_all[ki_i], Vi_all[Vi_i]) for Vi_i in Vi_range ])
+        
+        blocks = [ [ grid[i] for i in block ] for block in np.array_split(np.arange(len(grid)), min(Tools.getJobsNb(n_jobs), len(grid))) ]
+        
+        
+        # Perform fits
+        
         all_L       = np.zeros((len(ki_all),len(Vi_all)))
         L_opt       = -10**20
         beta_opt    = 0 
         ki_opt      = 0    
         Vi_opt      = 0 
-           
-           
-        for ki_i in np.arange(len(ki_all)) :
-            
-            for Vi_i in np.arange(len(Vi_all)) :
-            
-                ki = ki_all[ki_i]
-                Vi = Vi_all[Vi_i]            
-            
-                print "\nTest parameters: ki = %0.2f mV, Vi = %0.2f mV" % (ki, Vi)        
         
-                # Perform fit        
-                (beta_tmp, L_tmp) = self.maximizeLikelihood_dynamicThreshold(experiment, ki, Vi, beta0_dynamicThreshold)
+        data = (self, traces, beta0_dynamicThreshold, 10**3, 10**-6, batch_size)
+        
+        for results_block in Tools.parallelMap(maximizeLikelihood_grid_task, blocks, n_jobs=n_jobs, data=data) :
+            
+            for (ki_i, Vi_i, beta_tmp, L_tmp) in results_block :
                 
                 all_L[ki_i, Vi_i] = L_tmp
         
                 if L_tmp > L_opt :
                     
-                    print "NEW OPTIMAL SOLUTION: LL = %0.5f (bit/spike)" % (L_tmp)
-                    
                     L_opt    = L_tmp
                     beta_opt = beta_tmp 
-                    Vi_opt   = Vi
-                    ki_opt   = ki
+                    Vi_opt   = Vi_all[Vi_i]
+                    ki_opt   = ki_all[ki_i]
+        
+        print "\nOPTIMAL SOLUTION: ki = %0.2f mV, Vi = %0.2f mV, LL = %0.5f (bit/spike)" % (ki_opt, Vi_opt, L_opt)
+        
+        self.fitThresholdDynamics_storeResult(beta_opt, ki_opt, Vi_opt, ki_all, Vi_all, all_L, do_plot=do_plot)
+
+
+    def fitThresholdDynamics_adaptive(self, experiment, ki_all, Vi_all, coarse_step=None, do_plot=False):
+        
+        """
+        Search the best pair of parameters (ki, Vi) in the grid ki_all x Vi_all from coarse to fine.
+        
+        The search starts on a coarse grid (one point every coarse_step grid points along each dimension, by default about 5 points
+        per dimension), visited along a serpentine path. The 8 neighbours of the best point at distance step (in grid points) are then evaluated, until the best
+        point does not change, and step is halved. The search stops when the best point is better than its 8 neighbours on the full grid.
+        When the likelihood landscape has a single maximum (as usually observed), the result is the same as with 
+        fitThresholdDynamics_bruteforce, but only a fraction of the grid points are evaluated.
+        
+        Each fit starts from the solution of the nearest grid point already evaluated (or of the previous point of the coarse grid). The results are stored in a memo table
+        (self.fit_memo_kiVi) which is reused by later calls on the same data (e.g., with a finer grid), as long as the subthreshold
+        voltage, the columns of X and theta_tau do not change. In self.fit_all_likelihood, the grid points which have not been
+        evaluated are set to nan.
+        """
+        
+        print "Fit dynamic threshold (adaptive search)..."
+        
+        beta0_dynamicThreshold = np.concatenate( ( [1/self.DV], [-self.Vt_star/self.DV], [0], np.zeros(self.gamma.getNbOfBasisFunctions())))        
+        
+        # Simulate subthreshold dynamics and compute the columns of X that do not depend on ki and Vi
+        
+        traces = self.getTraces_dynamicThreshold(experiment)
+        memo   = self.getMemo_dynamicThreshold(traces)
+        
+        ki_all = np.array(ki_all, dtype='double')
+        Vi_all = np.array(Vi_all, dtype='double')
+        
+        ki_scale = max(ki_all[-1] - ki_all[0], 10**-9)
+        Vi_scale = max(Vi_all[-1] - Vi_all[0], 10**-9)
+        
+        all_L = np.zeros((len(ki_all),len(Vi_all)))*np.nan
+        
+        
+        def evaluate(points) :
+            
+            # Points which are not in the memo table
+            points_new = [ (ki_i, Vi_i) for (ki_i, Vi_i) in points if (ki_all[ki_i], Vi_all[Vi_i]) not in memo ]
+            
+            if len(points_new) > 0 :
+                
+                # Warm start from the nearest point already evaluated (None: from the previous point of points_new)
+                all_beta0 = []
+                
+                for k in np.arange(len(points_new)) :
+                    
+                    (ki, Vi) = (ki_all[points_new[k][0]], Vi_all[points_new[k][1]])
+                    
+                    beta0 = None
+                    d_min = np.inf
+                    
+                    if k > 0 :
+                        d_min = ((ki - ki_all[points_new[k-1][0]])/ki_scale)**2 + ((Vi - Vi_all[points_new[k-1][1]])/Vi_scale)**2
+                    
+                    for ((ki_memo, Vi_memo), (beta, L_norm)) in memo.items() :
+                        
+                        d = ((ki - ki_memo)/ki_scale)**2 + ((Vi - Vi_memo)/Vi_scale)**2
+                        
+                        if d < d_min :
+                            beta0 = beta
+                            d_min = d
+                            
+                    all_beta0.append(beta0)
+                
+                results = self.maximizeLikelihood_kiVi_batch(traces, ki_all[[ p[0] for p in points_new ]], Vi_all[[ p[1] for p in points_new ]],
+                                                             beta0_dynamicThreshold, all_beta0=all_beta0)
+                
+                for ((ki_i, Vi_i), result) in zip(points_new, results) :
+                    memo[(ki_all[ki_i], Vi_all[Vi_i])] = result
+            
+            for (ki_i, Vi_i) in points :
+                all_L[ki_i, Vi_i] = memo[(ki_all[ki_i], Vi_all[Vi_i])][1]
+            
+            
+        # Coarse grid
+        
+        if coarse_step == None :
+            coarse_step = max(1, int(np.ceil((max(len(ki_all), len(Vi_all)) - 1)/4.0)))
+            
+        step = coarse_step
+        
+        ki_coarse = sorted(set(range(0, len(ki_all), step)) | set([len(ki_all)-1]))
+        Vi_coarse = sorted(set(range(0, len(Vi_all), step)) | set([len(Vi_all)-1]))
+        
+        evaluate([ (ki_coarse[i], Vi_i) for i in np.arange(len(ki_coarse)) for Vi_i in (Vi_coarse if i % 2 == 0 else Vi_coarse[::-1]) ])
+        
+        
+        # Refine around the best point
+        
+        while True :
+            
+            (ki_i_opt, Vi_i_opt) = np.unravel_index(np.nanargmax(all_L), all_L.shape)
+            
+            neighbours = [ (ki_i_opt + d_ki*step, Vi_i_opt + d_Vi*step) for d_ki in [-1, 0, 1] for d_Vi in [-1, 0, 1] ]
+            neighbours = [ (ki_i, Vi_i) for (ki_i, Vi_i) in neighbours if 0 <= ki_i < len(ki_all) and 0 <= Vi_i < len(Vi_all) and np.isnan(all_L[ki_i, Vi_i]) ]
+            
+            if len(neighbours) > 0 :
+                evaluate(neighbours)
+                
+            elif step > 1 :
+                step = step/2
+                
+            else :
+                break
+        
+        
+        (beta_opt, L_opt) = memo[(ki_all[ki_i_opt], Vi_all[Vi_i_opt])]
+        
+        print "\nEvaluated %d of %d grid points" % (np.sum(np.isfinite(all_L)), np.size(all_L))
+        print "OPTIMAL SOLUTION: ki = %0.2f mV, Vi = %0.2f mV, LL = %0.5f (bit/spike)" % (ki_all[ki_i_opt], Vi_all[Vi_i_opt], L_opt)
+        
+        self.fitThresholdDynamics_storeResult(beta_opt, ki_all[ki_i_opt], Vi_all[Vi_i_opt], ki_all, Vi_all, all_L, do_plot=do_plot)
+        
+        
+    def fitThresholdDynamics_continuous(self, experiment, ki_bounds, Vi_bounds, theta_tau_bounds, ki0=None, Vi0=None, theta_tau0=None, maxEval=100, stopCond=10**-5, do_plot=False):
+        
+        """
+        Fit the dynamic threshold by optimizing ki, Vi and theta_tau as continuous parameters (within the bounds ki_bounds, Vi_bounds
+        and theta_tau_bounds, given as tuples (min, max)).
+        
+        For given (ki, Vi, theta_tau), the likelihood is maximized with respect to the linear parameters beta (see PoissonGLM).
+        The resulting profile log-likelihood is maximized with respect to (ki, Vi, theta_tau) with L-BFGS-B (scipy.optimize.fmin_l_bfgs_b).
+        Its exact gradient is given by the derivative of the log-likelihood at the optimal beta (envelope theorem), which only requires
+        the derivatives of the nonlinear coupling with respect to ki, Vi and theta_tau. These are computed in the same recursive 
+        pass as the coupling itself (see exponentialFiltering_Brette_derivatives). Each likelihood maximization starts from the
+        solution of the previous evaluation.
+        
+        The optimization starts from (ki0, Vi0, theta_tau0) (by default the middle of the bounds and the current theta_tau) and stops after
+        maxEval evaluations or when the largest component of the gradient (in bit/spike per unit of parameter) is smaller than stopCond.
+        The parameters evaluated during the optimization and the corresponding log-likelihoods are stored in self.fit_continuous_path
+        (one row (ki, Vi, theta_tau, LL) per evaluation) and are plotted if do_plot is True (see plotContinuousPath).
+        """
+        
+        print "Fit dynamic threshold (continuous optimization of ki, Vi and theta_tau)..."
+        
+        if ki0 == None :
+            ki0 = 0.5*(ki_bounds[0] + ki_bounds[1])
+            
+        if Vi0 == None :
+            Vi0 = 0.5*(Vi_bounds[0] + Vi_bounds[1])
+            
+        if theta_tau0 == None :
+            theta_tau0 = min(max(self.theta_tau, theta_tau_bounds[0]), theta_tau_bounds[1])
+        
+        # Simulate subthreshold dynamics and compute the columns of X that do not depend on ki, Vi and theta_tau
+        
+        traces = self.getTraces_dynamicThreshold(experiment)
+        
+        beta0 = [ np.concatenate( ( [1/self.DV], [-self.Vt_star/self.DV], [0], np.zeros(self.gamma.getNbOfBasisFunctions()))) ]
+        path  = []
+        
+        def f(q) :
+            
+            (beta, L_norm, dL_norm) = self.maximizeLikelihood_continuous(traces, q[0], q[1], q[2], beta0[0])
+            
+            beta0[0] = beta
+            path.append( (q[0], q[1], q[2], L_norm, beta) )
+            
+            print "ki = %0.3f mV, Vi = %0.3f mV, tau_theta = %0.3f ms: LL = %0.5f (bit/spike)" % (q[0], q[1], q[2], L_norm)
+            
+            return (-L_norm, -dL_norm)
+        
+        
+        (q_opt, f_opt, info) = fmin_l_bfgs_b(f, [ki0, Vi0, theta_tau0], bounds=[ki_bounds, Vi_bounds, theta_tau_bounds], pgtol=stopCond, maxfun=maxEval)
+        
+        
+        # Retain the best evaluation
+        
+        (ki_opt, Vi_opt, theta_tau_opt, L_opt, beta_opt) = max(path, key=lambda p : p[3])
+        
+        print "\nEvaluated the likelihood %d times" % (len(path))
+        print "OPTIMAL SOLUTION: ki = %0.3f mV, Vi = %0.3f mV, tau_theta = %0.3f ms, LL = %0.5f (bit/spike)" % (ki_opt, Vi_opt, theta_tau_opt, L_opt)
+        
+        self.theta_tau = theta_tau_opt
+        
+        self.fitThresholdDynamics_storeParameters(beta_opt, ki_opt, Vi_opt)
+        
+        self.fit_continuous_path = np.array([ p[:4] for p in path ])
+        
+        if do_plot :
+            
+            plt.figure(facecolor='white', figsize=(6,6))
+            self.plotContinuousPath()
+            plt.show()
+        
+        
+    def maximizeLikelihood_continuous(self, traces, ki, Vi, theta_tau, beta0, maxIter=10**3, stopCond=10**-6) :
+        
+        """
+        Maximize the likelihood with respect to beta for given ki, Vi and theta_tau (traces is returned by getTraces_dynamicThreshold).
+        Return the optimal parameters beta, the normalized log-likelihood L_norm (bit/spike) and the gradient of L_norm
+        with respect to (ki, Vi, theta_tau).
+        """
+        
+        glm = self.getPoissonGLM(maxIter=maxIter, stopCond=stopCond)
+        
+        all_dtheta = []
+        
+        for (tr, V_est, X_shared) in traces :
+            
+            selection = X_shared[5]
+            
+            (theta, dtheta_dki, dtheta_dVi, dtheta_dtau) = self.exponentialFiltering_Brette_derivatives(V_est, tr.getSpikeIndices(), ki, Vi, theta_tau)
+            
+            glm.addTrace(*self.buildXmatrix_dynamicThreshold_theta(X_shared, theta[selection]))
+            all_dtheta.append( np.transpose([ dtheta_dki[selection], dtheta_dVi[selection], dtheta_dtau[selection] ]) )
+        
+        beta = glm.maximizeLikelihood(beta0)
+        
+        # The nonlinear coupling enters X beta as beta[2]*theta
+        all_dXbeta        = [ beta[2]*dtheta for dtheta in all_dtheta ]
+        all_dXbeta_spikes = [ dXbeta[traces[trace_i][2][6],:] for (trace_i, dXbeta) in enumerate(all_dXbeta) ]
+        
+        dL = glm.computeLikelihoodDerivative(beta, all_dXbeta, all_dXbeta_spikes)
+        
+        return (beta, glm.L_norm, dL/np.log(2)/glm.N_spikes_tot)
+        
+        
+    def getMemo_dynamicThreshold(self, traces) :
+        
+        """
+        Return the memo table {(ki, Vi) : (beta, L_norm)} of the likelihood maximizations performed on the data in traces
+        (see getTraces_dynamicThreshold). The memo table is reset when the data, theta_tau or the likelihood solver change.
+        """
+        
+        h = hashlib.md5()
+        h.update(repr( (self.dt, self.Tref, self.theta_tau, self.getLikelihoodMethod(), self.getLikelihoodPrecision()) ))
+        
+        for (tr, V_est, X_shared) in traces :
+            h.update(np.ascontiguousarray(V_est).tostring())
+            h.update(np.ascontiguousarray(X_shared[0]).tostring())
+            h.update(np.ascontiguousarray(X_shared[5]).tostring())
+        
+        key = h.hexdigest()
+        
+        if getattr(self, 'fit_memo_kiVi', None) == None or self.fit_memo_kiVi[0] != key :
+            self.fit_memo_kiVi = (key, {})
+        
+        return self.fit_memo_kiVi[1]
+        
+        
+    def fitThresholdDynamics_storeResult(self, beta_opt, ki_opt, Vi_opt, ki_all, Vi_all, all_L, do_plot=False):
+        
+        """
+        Store the result of the fit of the dynamic threshold (optimal parameters beta_opt, ki_opt and Vi_opt) and
+        the likelihood landscape all_L on the grid ki_all x Vi_all.
+        """
         
         # Store result
         
-        self.DV       = 1.0/beta_opt[0]
-        self.Vt_star  = -beta_opt[1]*self.DV 
-        self.theta_ka =  -beta_opt[2]*self.DV
-        self.gamma.setFilter_Coefficients(-beta_opt[3:]*self.DV)
-        self.theta_Vi = Vi_opt        
-        self.theta_ki = ki_opt
+        self.fitThresholdDynamics_storeParameters(beta_opt, ki_opt, Vi_opt)
         
         self.fit_all_ki = ki_all                    
         self.fit_all_Vi = Vi_all                   
         self.fit_all_likelihood = all_L   
+        
+        self.fit_continuous_path = None
 
 
         # Plot landscape
@@ -357,7 +622,7 @@ class iGIF_Na(iGIF) :
             
             plt.figure(facecolor='white', figsize=(6,6))
             
-            plt.pcolor(Vi_plot, ki_plot, all_L)
+            plt.pcolor(Vi_plot, ki_plot, np.ma.masked_invalid(all_L))
             plt.plot(ki_opt, Vi_opt, 'o', mfc='white', mec='black', ms=10)
             
             plt.xlabel('ki (mV)')
@@ -369,83 +634,92 @@ class iGIF_Na(iGIF) :
  
 
    
+    def fitThresholdDynamics_storeParameters(self, beta_opt, ki_opt, Vi_opt):
+        
+        """
+        Store the parameters of the dynamic threshold given the optimal parameters beta_opt, ki_opt and Vi_opt.
+        """
+        
+        self.DV       = 1.0/beta_opt[0]
+        self.Vt_star  = -beta_opt[1]*self.DV 
+        self.theta_ka =  -beta_opt[2]*self.DV
+        self.gamma.setFilter_Coefficients(-beta_opt[3:]*self.DV)
+        self.theta_Vi = Vi_opt        
+        self.theta_ki = ki_opt
+        
+   
     def maximizeLikelihood_dynamicThreshold(self, experiment, ki, Vi, beta0, maxIter=10**3, stopCond=10**-6) :
         
-        all_X        = []
-        all_X_spikes = []
-        all_sum_X_spikes = []
+        traces = self.getTraces_dynamicThreshold(experiment)
+        
+        return self.maximizeLikelihood_kiVi(traces, ki, Vi, beta0, maxIter=maxIter, stopCond=stopCond)
+        
+        
+    def getTraces_dynamicThreshold(self, experiment) :
         
-        T_tot = 0.0
-        N_spikes_tot = 0.0
+        """
+        Return a list of tuples (tr, V_est, X_shared) for the training set traces, where V_est is the subthreshold voltage
+        simulated on the trace tr and X_shared is returned by buildXmatrix_dynamicThreshold_shared.
+        """
         
-        traces_nb = 0
+        traces = []
         
         for tr in experiment.trainingset_traces:
             
             if tr.useTrace :              
                 
-                traces_nb += 1
-                
                 # Simulate subthreshold dynamics 
-                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes(tr.I, tr.V[0], tr.getSpikeTimes())
-                
+                (time, V_est, eta_sum_est) = self.simulateDeterministic_forceSpikes_trace(tr)
+                traces.append( (tr, V_est, self.buildXmatrix_dynamicThreshold_shared(tr, V_est)) )
                 
-                # Precomputes matrices to perform gradient ascent on log-likelihood
-                (X_tmp, X_spikes_tmp, sum_X_spikes_tmp, N_spikes, T) = self.buildXmatrix_dynamicThreshold(tr, V_est, ki, Vi) 
-                    
-                T_tot        += T
-                N_spikes_tot += N_spikes
-                    
-                all_X.append(X_tmp)
-                all_X_spikes.append(X_spikes_tmp)
-                all_sum_X_spikes.append(sum_X_spikes_tmp)
+        return traces
+        
+        
+    def maximizeLikelihood_kiVi(self, traces, ki, Vi, beta0, maxIter=10**3, stopCond=10**-6) :
         
-        logL_poisson = N_spikes_tot*(np.log(N_spikes_tot/T_tot)-1)
+        """
+        Maximize the likelihood for given parameters ki and Vi (traces is returned by getTraces_dynamicThreshold).
+        Return the optimal parameters beta and the normalized log-likelihood (bit/spike).
+        """
         
+        return self.maximizeLikelihood_kiVi_batch(traces, [ki], [Vi], beta0, maxIter=maxIter, stopCond=stopCond)[0]
         
-        # Perform gradient ascent
         
-        print "Maximize log-likelihood (bit/spks)..."
-                        
-        beta = beta0
-        old_L = 1
+    def maximizeLikelihood_kiVi_batch(self, traces, ki_all, Vi_all, beta0, maxIter=10**3, stopCond=10**-6, all_beta0=None) :
         
-        for i in range(maxIter) :
-          
-            learning_rate = 1.0
+        """
+        Maximize the likelihood for each pair of parameters (ki_all[k], Vi_all[k]) (traces is returned by getTraces_dynamicThreshold).
+        The nonlinear coupling columns of all the pairs are computed in a single pass over each trace (see exponentialFiltering_Brette_ref_batch).
+        Each fit starts from the solution obtained with the previous pair (or from all_beta0[k], if all_beta0 is given and all_beta0[k] is not None).
+        Return a list of tuples (beta, L_norm), where L_norm is the normalized log-likelihood (bit/spike).
+        """
+        
+        all_X_theta = [ self.exponentialFiltering_Brette_ref_batch(V_est, tr.getSpikeIndices(), ki_all, Vi_all)[X_shared[5],:] for (tr, V_est, X_shared) in traces ]
+        
+        results = []
+        
+        for k in np.arange(len(ki_all)) :
             
-            if i<=10 :                      # be careful in the first iterations (using a small learning rate in the first step makes the fit more stable)
-                learning_rate = 0.1
+            print "\nTest parameters: ki = %0.2f mV, Vi = %0.2f mV" % (ki_all[k], Vi_all[k])        
             
+            # Precomputes matrices to perform gradient ascent on log-likelihood
             
-            L=0; G=0; H=0;  
-                
-            for trace_i in np.arange(traces_nb):
-                (L_tmp,G_tmp,H_tmp) = self.computeLikelihoodGradientHessian(beta, all_X[trace_i], all_X_spikes[trace_i], all_sum_X_spikes[trace_i])
-                L+=L_tmp; G+=G_tmp; H+=H_tmp;
+            glm = self.getPoissonGLM(maxIter=maxIter, stopCond=stopCond)
             
+            for trace_i in np.arange(len(traces)) :
+                glm.addTrace(*self.buildXmatrix_dynamicThreshold_theta(traces[trace_i][2], all_X_theta[trace_i][:,k]))
             
-            beta = beta - learning_rate*np.dot(inv(H),G)
-                
-                
-            if (i>0 and abs((L-old_L)/old_L) < stopCond) :              # If converged
-                
-                print "\nConverged after %d iterations!\n" % (i+1)
-                break
+            # Perform gradient ascent
             
-            old_L = L
+            if all_beta0 != None and all_beta0[k] is not None :
+                beta0 = all_beta0[k]
             
-            # Compute normalized likelihood (for print)
-            # The likelihood is normalized with respect to a poisson process and units are in bit/spks
-            L_norm = (L-logL_poisson)/np.log(2)/N_spikes_tot
-            reprint(L_norm)
+            beta  = glm.maximizeLikelihood(beta0)
+            beta0 = beta
             
+            results.append( (beta, glm.L_norm) )
         
-        if (i==maxIter - 1) :                                           # If too many iterations
-            print "\nNot converged after %d iterations.\n" % (maxIter)
-        
-        
-        return (beta, L_norm)
+        return results
               
 
         
@@ -455,6 +729,20 @@ class iGIF_Na(iGIF) :
         Use this function to fit a model in which the firing threshold dynamics is defined as:
         V_T(t) = Vt_star + sum_i gamma(t-\hat t_i) (i.e., model with spike-triggered movement of the threshold)
         """
+        
+        X_shared = self.buildXmatrix_dynamicThreshold_shared(tr, V_est)
+        
+        return self.buildXmatrix_dynamicThreshold_kiVi(tr, V_est, X_shared, ki, Vi)
+        
+        
+    def buildXmatrix_dynamicThreshold_shared(self, tr, V_est) :
+
+        """
+        Compute the columns of the matrix X that do not depend on ki and Vi (V, 1 and gamma), as well as the
+        selection of the time steps used in the fit. The result is used by buildXmatrix_dynamicThreshold_kiVi
+        and can be shared by all the grid points tested during the fit.
+        Return (X, X_spikes, sum_X_spikes, N_spikes, T_l, selection, spks_i_afterselection).
+        """
            
         # Get indices be removing absolute refractory periods (-self.dt is to not include the time of spike)       
         selection = tr.getROI_FarFromSpikes(-tr.dt, self.Tref)
@@ -472,13 +760,9 @@ class iGIF_Na(iGIF) :
         
         
         # Define X matrix
-        X       = np.zeros((T_l_selection, 3))
+        X       = np.zeros((T_l_selection, 2))
         X[:,0]  = V_est[selection]
         X[:,1]  = np.ones(T_l_selection)
-        
-        X_theta = self.exponentialFiltering_Brette_ref(V_est, tr.getSpikeIndices(), ki, Vi)
-        X[:,2]  = X_theta[selection]  
-      
            
         # Compute and fill the remaining columns associated with the spike-triggered current gamma              
         X_gamma = self.gamma.convolution_Spiketrain_basisfunctions(tr.getSpikeTimes() + self.Tref, tr.T, tr.dt)
@@ -489,6 +773,36 @@ class iGIF_Na(iGIF) :
         X_spikes = X[spks_i_afterselection,:]
         sum_X_spikes = np.sum( X_spikes, axis=0)
         
+        return (X, X_spikes, sum_X_spikes,  N_spikes, T_l, selection, spks_i_afterselection)
+
+
+    def buildXmatrix_dynamicThreshold_kiVi(self, tr, V_est, X_shared, ki, Vi) :
+
+        """
+        Insert the column related with the nonlinear coupling (which depends on ki and Vi) as third column of the matrix
+        computed by buildXmatrix_dynamicThreshold_shared. Only one exponential filtering of V_est is performed.
+        """
+
+        X_theta = self.exponentialFiltering_Brette_ref(V_est, tr.getSpikeIndices(), ki, Vi)[X_shared[5]]
+
+        return self.buildXmatrix_dynamicThreshold_theta(X_shared, X_theta)
+
+
+    def buildXmatrix_dynamicThreshold_theta(self, X_shared, X_theta) :
+
+        """
+        Insert the column X_theta (nonlinear coupling at the time steps selected in X_shared) as third column of the matrix
+        computed by buildXmatrix_dynamicThreshold_shared.
+        """
+
+        (X, X_spikes, sum_X_spikes, N_spikes, T_l, selection, spks_i_afterselection) = X_shared
+
+        X_theta_spikes = X_theta[spks_i_afterselection]
+
+        X            = np.concatenate( (X[:,:2], X_theta[:,np.newaxis], X[:,2:]), axis=1 )
+        X_spikes     = np.concatenate( (X_spikes[:,:2], X_theta_spikes[:,np.newaxis], X_spikes[:,2:]), axis=1 )
+        sum_X_spikes = np.concatenate( (sum_X_spikes[:2], [np.sum(X_theta_spikes)], sum_X_spikes[2:]) )
+
         return (X, X_spikes, sum_X_spikes,  N_spikes, T_l)
  
 
@@ -532,65 +846,84 @@ class iGIF_Na(iGIF) :
         
         spks      = np.array(spks_ind, dtype='double')
         p_spks_L  = len(spks)
-         
-    
-        code =  """
-                #include <math.h>
-                
-                int   T_ind      = int(p_T);                
-                float dt         = float(p_dt); 
-                
-                int   Tref_ind   = int(float(p_Tref)/dt);
-                float theta_ki         = float(p_theta_ki);
-                float theta_Vi         = float(p_theta_Vi);
-                float theta_tau        = float(p_theta_tau);
-              
-                float theta_taufactor = (1.0-dt/theta_tau);                 
-                
-                int spks_L     = int(p_spks_L);  
-                int spks_cnt   = 0;
-                int next_spike = int(spks[0]);
-         
-                                                
-                for (int t=0; t<T_ind-1; t++) {
-                        
-                    // INTEGRATE THETA 
-                                       
-                    theta[t+1] = theta[t] + dt/theta_tau*(-theta[t] + log(1+exp((V[t]-theta_Vi)/theta_ki))); 
-            
-             
-                    // MANAGE RESET        
-                    
-                    if ( t+1 >= next_spike ) {                                        
-                   
-                        if(spks_cnt < spks_L) {
-                            spks_cnt  += 1;
-                            next_spike = int(spks[spks_cnt]);
-                        }
-                        else {
-                            next_spike = T_ind+1;
-                        }
-                        
-                        
-                        if ( t + Tref_ind < T_ind-1 ) { 
-                            theta[t + Tref_ind] = 0.0;                                      
-                        }   
-                          
-                        t = t + Tref_ind; 
-                                 
-                    }  
-                            
-                }
-                
-                """
- 
-        vars = [ 'spks', 'p_spks_L', 'theta', 'p_theta_ki', 'p_theta_Vi', 'p_theta_tau', 'p_T','p_dt','p_Tref','V' ]
-        
-        v = weave.inline(code, vars)
+
+        kernel_iGIF_Na_exponentialFiltering_Brette.run(locals())
         
         
         return theta
 
+
+    def exponentialFiltering_Brette_derivatives(self, V, spks_ind, ki, Vi, theta_tau):
+
+        """
+        Same as exponentialFiltering_Brette_ref (with timescale theta_tau), but also return the derivatives of theta(t)
+        with respect to ki, Vi and theta_tau, which are integrated in the same recursive pass (in double precision):
+        
+        dtheta/dki(t+dt)  = (1-dt/tau) dtheta/dki(t)  - dt/tau * s(u) u/ki
+        dtheta/dVi(t+dt)  = (1-dt/tau) dtheta/dVi(t)  - dt/tau * s(u)/ki
+        dtheta/dtau(t+dt) = (1-dt/tau) dtheta/dtau(t) - dt/tau^2 * ( -theta(t) + log(1+exp(u)) )
+        
+        where u = (V(t)-Vi)/ki and s(u) = 1/(1+exp(-u)). The derivatives are reset together with theta.
+        Return (theta, dtheta_dki, dtheta_dVi, dtheta_dtau).
+        """
+
+        # Input parameters
+        p_T         = len(V)
+        p_dt        = self.dt
+
+        # Model parameters  definin threshold coupling
+        p_theta_tau = theta_tau
+        p_Tref      = self.Tref
+        p_theta_ki  = ki
+        p_theta_Vi  = Vi
+
+        # Define arrays
+        V           = np.array(V, dtype="double")
+        theta       = np.array(np.zeros(p_T), dtype="double")
+        dtheta_dki  = np.array(np.zeros(p_T), dtype="double")
+        dtheta_dVi  = np.array(np.zeros(p_T), dtype="double")
+        dtheta_dtau = np.array(np.zeros(p_T), dtype="double")
+
+        spks      = np.array(spks_ind, dtype='double')
+        p_spks_L  = len(spks)
+
+        kernel_iGIF_Na_exponentialFiltering_Brette_derivatives.run(locals())
+
+
+        return (theta, dtheta_dki, dtheta_dVi, dtheta_dtau)
+
+
+    def exponentialFiltering_Brette_ref_batch(self, V, spks_ind, ki_all, Vi_all):
+
+        """
+        Same as exponentialFiltering_Brette_ref, but for n pairs of parameters (ki_all[k], Vi_all[k]) at once.
+        All the integrals are computed in a single pass over V (the resets are shared).
+        Return a matrix of shape (len(V), n) whose k-th column is given by exponentialFiltering_Brette_ref(V, spks_ind, ki_all[k], Vi_all[k]).
+        """
+
+        # Input parameters
+        p_T         = len(V)
+        p_dt        = self.dt
+        p_n         = len(ki_all)
+
+        # Model parameters  definin threshold coupling
+        p_theta_tau = self.theta_tau
+        p_Tref      = self.Tref
+        p_theta_ki  = np.array(ki_all, dtype="double")
+        p_theta_Vi  = np.array(Vi_all, dtype="double")
+
+        # Define arrays
+        V         = np.array(V, dtype="double")
+        theta     = np.array(np.zeros(p_T*p_n), dtype="double")            # theta(t,k) is stored in theta[t*n+k]
+
+        spks      = np.array(spks_ind, dtype='double')
+        p_spks_L  = len(spks)
+
+        kernel_iGIF_Na_exponentialFiltering_Brette_batch.run(locals())
+
+
+        return theta.reshape((p_T, p_n))
+
   
     ########################################################################################################
     # PLOT AND PRINT FUNCTIONS
@@ -623,16 +956,38 @@ class iGIF_Na(iGIF) :
         super(iGIF_Na, self).plotParameters()
 
         plt.subplot(1,4,4)
+        
+        if getattr(self, 'fit_continuous_path', None) is not None :
+            self.plotContinuousPath()
+            return
                  
         (ki_plot,Vi_plot) = np.meshgrid(self.fit_all_Vi, self.fit_all_ki)
 
-        plt.pcolor(Vi_plot, ki_plot, self.fit_all_likelihood)
+        plt.pcolor(Vi_plot, ki_plot, np.ma.masked_invalid(self.fit_all_likelihood))
         plt.plot(self.theta_ki, self.theta_Vi, 'o', mfc='white', mec='black', ms=10)
                     
         plt.xlim([self.fit_all_ki[0], self.fit_all_ki[-1]])
         plt.ylim([self.fit_all_Vi[0], self.fit_all_Vi[-1]])            
         plt.xlabel('ki (mV)')
         plt.ylabel('Vi (mV)') 
+        
+        
+    def plotContinuousPath(self) :
+        
+        """
+        Plot, in the current axes, the values of ki and Vi evaluated by fitThresholdDynamics_continuous (colored by log-likelihood)
+        and the optimal solution.
+        """
+        
+        path = self.fit_continuous_path
+        
+        plt.plot(path[:,0], path[:,1], '-', color='0.5', zorder=1)
+        plt.scatter(path[:,0], path[:,1], c=path[:,3], zorder=2)
+        plt.colorbar(label='LL (bit/spike)')
+        plt.plot(self.theta_ki, self.theta_Vi, 'o', mfc='white', mec='black', ms=10, zorder=3)
+        
+        plt.xlabel('ki (mV)')
+        plt.ylabel('Vi (mV)') 
             
      
     @classmethod
@@ -692,4 +1047,521 @@ class iGIF_Na(iGIF) :
         plt.xlabel('Vi (mV)')
         Tools.removeAxis(plt.gca(), ['top', 'left', 'right'])
         plt.yticks([])     
-        
\ No newline at end of file
+        
+
+
+def maximizeLikelihood_grid_task(data, block):
+
+    """
+    Fits of iGIF_Na.fitThresholdDynamics_bruteforce for a block of grid points (ki_i, Vi_i, ki, Vi) (executed by the worker processes).
+    The nonlinear coupling columns are computed for batch_size points at once (see iGIF_Na.maximizeLikelihood_kiVi_batch).
+    Each fit starts from the solution obtained at the previous point of the block.
+    Return a list of tuples (ki_i, Vi_i, beta, L_norm).
+    """
+
+    (model, traces, beta0, maxIter, stopCond, batch_size) = data
+
+    results = []
+
+    for b in np.arange(0, len(block), batch_size) :
+
+        batch = block[b:b+batch_size]
+
+        results_batch = model.maximizeLikelihood_kiVi_batch(traces, [ ki for (ki_i, Vi_i, ki, Vi) in batch ], [ Vi for (ki_i, Vi_i, ki, Vi) in batch ],
+                                                            beta0, maxIter=maxIter, stopCond=stopCond)
+        beta0 = results_batch[-1][0]
+
+        results.extend([ (ki_i, Vi_i, beta, L_norm) for ((ki_i, Vi_i, ki, Vi), (beta, L_norm)) in zip(batch, results_batch) ])
+
+    return results
+
+
+########################################################################################################
+# KERNELS (see Kernel)
+########################################################################################################
+
+def iGIF_Na_simulate_ref(theta, p_theta_ka, p_theta_ki, p_theta_Vi, p_theta_tau,
+                         p_T, p_dt, p_exact, p_rescaling, p_gl, p_C, p_El, p_Vr, p_Tref, p_Vt_star, p_DV, p_lambda0, p_V0, V, I, 
+                         p_eta, p_eta_l, p_eta_chg, p_eta_chg_l, p_eta_b, p_eta_d, p_eta_R, eta_sum, eta_evt, eta_starts, eta_exp, 
+                         p_gamma, p_gamma_l, p_gamma_chg, p_gamma_chg_l, p_gamma_b, p_gamma_d, p_gamma_R, gamma_sum, gamma_evt, gamma_starts, gamma_exp, 
+                         p_nb_rep, p_seed, p_rep0, p_spks_max, spks_i, spks_nb):
+    
+    T_ind    = p_T
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    dtC = p_dt/p_C
+    if p_exact == 1 :
+        dtC = -np.expm1(-p_dt*p_gl/p_C)/p_gl
+    
+    eta_proc   = process_new(eta_sum, p_eta, p_eta_chg, eta_evt, eta_starts, p_eta_b, p_eta_d, eta_exp)
+    gamma_proc = process_new(gamma_sum, p_gamma, p_gamma_chg, gamma_evt, gamma_starts, p_gamma_b, p_gamma_d, gamma_exp)
+
+    sampler_i  = np.zeros(1, dtype=np.int32)
+    sampler_d  = np.zeros(2)
+    
+    for rep in range(p_nb_rep) :
+        
+        # RESET STATE VARIABLES
+        V[:]     = 0.0
+        theta[:] = 0.0
+        process_reset(eta_proc)
+        process_reset(gamma_proc)
+        sampler_reset(sampler_i, sampler_d)
+        
+        V[0] = p_V0
+        
+        spks_cnt = 0
+        
+        t = 0
+        while t < T_ind-1 :
+            
+            # COMPUTE ADAPTATION PROCESSES
+            process_advance(eta_proc, t+1)
+            process_advance(gamma_proc, t+1)
+            
+            # INTEGRATE VOLTAGE
+            V[t+1] = V[t] + dtC*( -p_gl*(V[t] - p_El) + I[t] - eta_sum[t] )
+            
+            # INTEGRATE THETA
+            theta[t+1] = theta[t] + p_dt/p_theta_tau*(-theta[t] + p_theta_ka*np.log(1+np.exp((V[t]-p_theta_Vi)/p_theta_ki)))
+            
+            # COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+            lambda_t    = p_lambda0*np.exp( (V[t+1]-p_Vt_star-gamma_sum[t]-theta[t+1])/p_DV )
+            
+            # PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+            if sample_spike(p_rescaling, p_seed, p_rep0 + rep, t, lambda_t, p_dt, sampler_i, sampler_d) :
+                
+                if t+1 < T_ind-1 and spks_cnt < p_spks_max :
+                    spks_i[rep*p_spks_max + spks_cnt] = t+1
+                    spks_cnt += 1
+                    
+                t = t + Tref_ind
+                
+                if t+1 < T_ind-1 :
+                    V[t+1] = p_Vr
+                    
+                # UPDATE ADAPTATION PROCESSES
+                process_spike(eta_proc, t+1)
+                process_spike(gamma_proc, t+1)
+                
+            t += 1
+            
+        process_advance(eta_proc, T_ind)
+        process_advance(gamma_proc, T_ind)
+        
+        spks_nb[rep] = spks_cnt
+
+
+kernel_iGIF_Na_simulate = Kernel('iGIF_Na_simulate',
+        [ 
+          'double* theta', 'double p_theta_ka', 'double p_theta_ki', 'double p_theta_Vi',
+          'double p_theta_tau', 'int p_T', 'double p_dt', 'int p_exact', 'int p_rescaling', 'double p_gl', 'double p_C', 'double p_El',
+          'double p_Vr', 'double p_Tref', 'double p_Vt_star', 'double p_DV', 'double p_lambda0',
+          'double p_V0', 'double* V', 'double* I', 'double* p_eta', 'int p_eta_l', 'int* p_eta_chg',
+          'int p_eta_chg_l', 'double* p_eta_b', 'double* p_eta_d', 'int p_eta_R', 'double* eta_sum',
+          'int* eta_evt', 'int* eta_starts', 'double* eta_exp', 'double* p_gamma', 'int p_gamma_l',
+          'int* p_gamma_chg', 'int p_gamma_chg_l', 'double* p_gamma_b', 'double* p_gamma_d', 'int p_gamma_R',
+          'double* gamma_sum', 'int* gamma_evt', 'int* gamma_starts', 'double* gamma_exp', 'int p_nb_rep', 'int p_seed', 'int p_rep0',
+          'int p_spks_max', 'int* spks_i', 'int* spks_nb' 
+        ],
+        """
+                
+                int   T_ind      = int(p_T);                
+                float dt         = float(p_dt); 
+                
+                float gl         = float(p_gl);
+                float C          = float(p_C);
+                float El         = float(p_El);
+                float Vr         = float(p_Vr);
+                int   Tref_ind   = int(float(p_Tref)/dt);
+                float dtC        = dt/C;                                     // forward Euler
+                if (p_exact == 1)
+                    dtC = -expm1(-dt*gl/C)/gl;                               // exact integration (I and eta constant during one time step)
+                float Vt_star    = float(p_Vt_star);
+                float DeltaV     = float(p_DV);
+                float lambda0    = float(p_lambda0);
+           
+                float theta_ka         = float(p_theta_ka);
+                float theta_ki         = float(p_theta_ki);
+                float theta_Vi         = float(p_theta_Vi);
+                float theta_tau        = float(p_theta_tau);
+              
+                int eta_l        = int(p_eta_l);
+                int gamma_l      = int(p_gamma_l);
+                
+                int nb_rep       = int(p_nb_rep);
+                int spks_max     = int(p_spks_max);
+                
+                SpikeProcess eta_proc;
+                SpikeProcess gamma_proc;
+                process_init(&eta_proc, eta_sum, T_ind, p_eta, eta_l, p_eta_chg, int(p_eta_chg_l), eta_evt, eta_starts, spks_max, p_eta_b, p_eta_d, eta_exp, int(p_eta_R));
+                process_init(&gamma_proc, gamma_sum, T_ind, p_gamma, gamma_l, p_gamma_chg, int(p_gamma_chg_l), gamma_evt, gamma_starts, spks_max, p_gamma_b, p_gamma_d, gamma_exp, int(p_gamma_R));
+                                      
+                float lambda = 0.0 ;            
+                int    sampler_i[1];                                              // state of the spike sampler (see Tools.sampler_support_code)
+                double sampler_d[2];
+                
+                
+                for (int rep=0; rep<nb_rep; rep++) {
+                
+                
+                    // RESET STATE VARIABLES
+                    for (int t=0; t<T_ind; t++) {
+                        V[t] = 0.0;
+                        theta[t] = 0.0;
+                    }
+                        
+                    process_reset(&eta_proc);
+                    process_reset(&gamma_proc);
+                    sampler_reset(sampler_i, sampler_d);
+                    
+                    V[0] = p_V0;
+                    
+                    int spks_cnt = 0;
+                    
+                                                    
+                    for (int t=0; t<T_ind-1; t++) {
+        
+        
+                        // COMPUTE ADAPTATION PROCESSES
+                        process_advance(&eta_proc, t+1);
+                        process_advance(&gamma_proc, t+1);
+        
+        
+                        // INTEGRATE VOLTAGE
+                        V[t+1] = V[t] + dtC*( -gl*(V[t] - El) + I[t] - eta_sum[t] );
+                        
+                        // INTEGRATE THETA                    
+                        theta[t+1] = theta[t] + dt/theta_tau*(-theta[t] + theta_ka*log(1+exp((V[t]-theta_Vi)/theta_ki))); 
+                
+                   
+                        // COMPUTE PROBABILITY OF EMITTING ACTION POTENTIAL
+                        lambda = lambda0*exp( (V[t+1]-Vt_star-gamma_sum[t]-theta[t+1])/DeltaV );
+                              
+                              
+                        // PRODUCE SPIKE STOCHASTICALLY (see Tools.sampler_support_code)
+                        if (sample_spike(p_rescaling, (unsigned int)(p_seed), (unsigned int)(p_rep0 + rep), (unsigned int)(t), lambda, dt, sampler_i, sampler_d)) {
+                                            
+                            if (t+1 < T_ind-1 && spks_cnt < spks_max) {
+                                spks_i[rep*spks_max + spks_cnt] = t+1;
+                                spks_cnt++;
+                            }
+                            
+                            t = t + Tref_ind;    
+                            
+                            if (t+1 < T_ind-1) 
+                                V[t+1] = Vr;
+                            
+                            
+                            // UPDATE ADAPTATION PROCESSES     
+                            process_spike(&eta_proc, t+1);
+                            process_spike(&gamma_proc, t+1);
+                            
+                        }
+                   
+                    }
+                    
+                    process_advance(&eta_proc, T_ind);
+                    process_advance(&gamma_proc, T_ind);
+                    
+                    spks_nb[rep] = spks_cnt;
+                    
+                }
+                
+                """,
+        iGIF_Na_simulate_ref,
+        support_code=Tools.adaptation_support_code + Tools.philox_support_code + Tools.sampler_support_code,
+        helpers=[process_new, process_reset, process_advance, process_spike, philox_uniform, sampler_reset, sample_spike])
+
+
+def iGIF_Na_exponentialFiltering_Brette_ref(spks, p_spks_L, theta, p_theta_ki, p_theta_Vi, p_theta_tau, p_T, p_dt, p_Tref, V):
+    
+    T_ind    = p_T
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    spks_cnt   = 0
+    next_spike = T_ind + 1
+    if p_spks_L > 0 :
+        next_spike = int(spks[0])
+        
+    t = 0
+    while t < T_ind-1 :
+        
+        # INTEGRATE THETA
+        theta[t+1] = theta[t] + p_dt/p_theta_tau*(-theta[t] + np.log(1+np.exp((V[t]-p_theta_Vi)/p_theta_ki)))
+        
+        # MANAGE RESET
+        if t+1 >= next_spike :
+            
+            spks_cnt  += 1
+            next_spike = T_ind + 1
+            if spks_cnt < p_spks_L :
+                next_spike = int(spks[spks_cnt])
+                
+            if t + Tref_ind < T_ind-1 :
+                theta[t + Tref_ind] = 0.0
+                
+            t = t + Tref_ind
+            
+        t += 1
+
+
+kernel_iGIF_Na_exponentialFiltering_Brette = Kernel('iGIF_Na_exponentialFiltering_Brette',
+        [ 
+          'double* spks', 'int p_spks_L', 'double* theta', 'double p_theta_ki', 'double p_theta_Vi',
+          'double p_theta_tau', 'int p_T', 'double p_dt', 'double p_Tref', 'double* V' 
+        ],
+        """
+                
+                int   T_ind      = int(p_T);                
+                float dt         = float(p_dt); 
+                
+                int   Tref_ind   = int(float(p_Tref)/dt);
+                float theta_ki         = float(p_theta_ki);
+                float theta_Vi         = float(p_theta_Vi);
+                float theta_tau        = float(p_theta_tau);
+              
+                float theta_taufactor = (1.0-dt/theta_tau);                 
+                
+                int spks_L     = int(p_spks_L);  
+                int spks_cnt   = 0;
+                int next_spike = T_ind+1;
+                
+                if (spks_L > 0)
+                    next_spike = int(spks[0]);
+         
+                                                
+                for (int t=0; t<T_ind-1; t++) {
+                        
+                    // INTEGRATE THETA 
+                                       
+                    theta[t+1] = theta[t] + dt/theta_tau*(-theta[t] + log(1+exp((V[t]-theta_Vi)/theta_ki))); 
+            
+             
+                    // MANAGE RESET        
+                    
+                    if ( t+1 >= next_spike ) {                                        
+                   
+                        spks_cnt  += 1;
+                        next_spike = T_ind+1;
+                        
+                        if (spks_cnt < spks_L)
+                            next_spike = int(spks[spks_cnt]);
+                        
+                        
+                        if ( t + Tref_ind < T_ind-1 ) { 
+                            theta[t + Tref_ind] = 0.0;                                      
+                        }   
+                          
+                        t = t + Tref_ind; 
+                                 
+                    }  
+                            
+                }
+                
+                """,
+        iGIF_Na_exponentialFiltering_Brette_ref)
+
+
+def iGIF_Na_exponentialFiltering_Brette_batch_ref(spks, p_spks_L, theta, p_theta_ki, p_theta_Vi, p_n, p_theta_tau, p_T, p_dt, p_Tref, V):
+    
+    T_ind    = p_T
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    theta_tn = theta.reshape((T_ind, p_n))
+    
+    spks_cnt   = 0
+    next_spike = T_ind + 1
+    if p_spks_L > 0 :
+        next_spike = int(spks[0])
+        
+    t = 0
+    while t < T_ind-1 :
+        
+        # INTEGRATE THETA (all the pairs ki, Vi)
+        theta_tn[t+1,:] = theta_tn[t,:] + p_dt/p_theta_tau*(-theta_tn[t,:] + np.log(1+np.exp((V[t]-p_theta_Vi)/p_theta_ki)))
+        
+        # MANAGE RESET
+        if t+1 >= next_spike :
+            
+            spks_cnt  += 1
+            next_spike = T_ind + 1
+            if spks_cnt < p_spks_L :
+                next_spike = int(spks[spks_cnt])
+                
+            if t + Tref_ind < T_ind-1 :
+                theta_tn[t + Tref_ind,:] = 0.0
+                
+            t = t + Tref_ind
+            
+        t += 1
+
+
+kernel_iGIF_Na_exponentialFiltering_Brette_batch = Kernel('iGIF_Na_exponentialFiltering_Brette_batch',
+        [ 
+          'double* spks', 'int p_spks_L', 'double* theta', 'double* p_theta_ki', 'double* p_theta_Vi', 'int p_n',
+          'double p_theta_tau', 'int p_T', 'double p_dt', 'double p_Tref', 'double* V' 
+        ],
+        """
+                
+                int   T_ind      = int(p_T);                
+                float dt         = float(p_dt); 
+                int   n          = int(p_n);
+                
+                int   Tref_ind   = int(float(p_Tref)/dt);
+                float theta_tau        = float(p_theta_tau);
+                
+                int spks_L     = int(p_spks_L);  
+                int spks_cnt   = 0;
+                int next_spike = T_ind+1;
+                
+                if (spks_L > 0)
+                    next_spike = int(spks[0]);
+         
+                                                
+                for (int t=0; t<T_ind-1; t++) {
+                        
+                    // INTEGRATE THETA (all the pairs ki, Vi, theta(t,k) is stored in theta[t*n+k])
+                    
+                    for (int k=0; k<n; k++) {
+                    
+                        float theta_ki = float(p_theta_ki[k]);
+                        float theta_Vi = float(p_theta_Vi[k]);
+                                       
+                        theta[(t+1)*n+k] = theta[t*n+k] + dt/theta_tau*(-theta[t*n+k] + log(1+exp((V[t]-theta_Vi)/theta_ki))); 
+                    }
+             
+                    // MANAGE RESET        
+                    
+                    if ( t+1 >= next_spike ) {                                        
+                   
+                        spks_cnt  += 1;
+                        next_spike = T_ind+1;
+                        
+                        if (spks_cnt < spks_L)
+                            next_spike = int(spks[spks_cnt]);
+                        
+                        
+                        if ( t + Tref_ind < T_ind-1 ) { 
+                            for (int k=0; k<n; k++)
+                                theta[(t + Tref_ind)*n+k] = 0.0;                                      
+                        }   
+                          
+                        t = t + Tref_ind; 
+                                 
+                    }  
+                            
+                }
+                
+                """,
+        iGIF_Na_exponentialFiltering_Brette_batch_ref)
+
+
+def iGIF_Na_exponentialFiltering_Brette_derivatives_ref(spks, p_spks_L, theta, dtheta_dki, dtheta_dVi, dtheta_dtau, 
+                                                        p_theta_ki, p_theta_Vi, p_theta_tau, p_T, p_dt, p_Tref, V):
+    
+    T_ind    = p_T
+    Tref_ind = int(np.float32(p_Tref)/np.float32(p_dt))
+    
+    a = p_dt/p_theta_tau
+    
+    spks_cnt   = 0
+    next_spike = T_ind + 1
+    if p_spks_L > 0 :
+        next_spike = int(spks[0])
+        
+    t = 0
+    while t < T_ind-1 :
+        
+        # INTEGRATE THETA AND ITS DERIVATIVES
+        u = (V[t]-p_theta_Vi)/p_theta_ki
+        f = np.log(1+np.exp(u))
+        s = 1.0/(1.0+np.exp(-u))
+        
+        theta[t+1]       = theta[t] + a*(-theta[t] + f)
+        dtheta_dki[t+1]  = (1.0-a)*dtheta_dki[t] - a*s*u/p_theta_ki
+        dtheta_dVi[t+1]  = (1.0-a)*dtheta_dVi[t] - a*s/p_theta_ki
+        dtheta_dtau[t+1] = (1.0-a)*dtheta_dtau[t] - a/p_theta_tau*(-theta[t] + f)
+        
+        # MANAGE RESET
+        if t+1 >= next_spike :
+            
+            spks_cnt  += 1
+            next_spike = T_ind + 1
+            if spks_cnt < p_spks_L :
+                next_spike = int(spks[spks_cnt])
+                
+            if t + Tref_ind < T_ind-1 :
+                theta[t + Tref_ind]       = 0.0
+                dtheta_dki[t + Tref_ind]  = 0.0
+                dtheta_dVi[t + Tref_ind]  = 0.0
+                dtheta_dtau[t + Tref_ind] = 0.0
+                
+            t = t + Tref_ind
+            
+        t += 1
+
+
+kernel_iGIF_Na_exponentialFiltering_Brette_derivatives = Kernel('iGIF_Na_exponentialFiltering_Brette_derivatives',
+        [ 
+          'double* spks', 'int p_spks_L', 'double* theta', 'double* dtheta_dki', 'double* dtheta_dVi', 'double* dtheta_dtau',
+          'double p_theta_ki', 'double p_theta_Vi', 'double p_theta_tau', 'int p_T', 'double p_dt', 'double p_Tref', 'double* V' 
+        ],
+        """
+                
+                int    T_ind      = int(p_T);                
+                int    Tref_ind   = int(float(p_Tref)/float(p_dt));
+                
+                double theta_ki   = p_theta_ki;
+                double theta_Vi   = p_theta_Vi;
+                double theta_tau  = p_theta_tau;
+                double a          = p_dt/theta_tau;
+                
+                int spks_L     = int(p_spks_L);  
+                int spks_cnt   = 0;
+                int next_spike = T_ind+1;
+                
+                if (spks_L > 0)
+                    next_spike = int(spks[0]);
+         
+                                                
+                for (int t=0; t<T_ind-1; t++) {
+                        
+                    // INTEGRATE THETA AND ITS DERIVATIVES
+                    
+                    double u = (V[t]-theta_Vi)/theta_ki;
+                    double f = log(1+exp(u));
+                    double s = 1.0/(1.0+exp(-u));
+                                       
+                    theta[t+1]       = theta[t] + a*(-theta[t] + f); 
+                    dtheta_dki[t+1]  = (1.0-a)*dtheta_dki[t] - a*s*u/theta_ki;
+                    dtheta_dVi[t+1]  = (1.0-a)*dtheta_dVi[t] - a*s/theta_ki;
+                    dtheta_dtau[t+1] = (1.0-a)*dtheta_dtau[t] - a/theta_tau*(-theta[t] + f);
+             
+                    // MANAGE RESET        
+                    
+                    if ( t+1 >= next_spike ) {                                        
+                   
+                        spks_cnt  += 1;
+                        next_spike = T_ind+1;
+                        
+                        if (spks_cnt < spks_L)
+                            next_spike = int(spks[spks_cnt]);
+                        
+                        
+                        if ( t + Tref_ind < T_ind-1 ) { 
+                            theta[t + Tref_ind]       = 0.0;
+                            dtheta_dki[t + Tref_ind]  = 0.0;
+                            dtheta_dVi[t + Tref_ind]  = 0.0;
+                            dtheta_dtau[t + Tref_ind] = 0.0;
+                        }   
+                          
+                        t = t + Tref_ind; 
+                                 
+                    }  
+                            
+                }
+                
+                """,
+        iGIF_Na_exponentialFiltering_Brette_derivatives_ref)
+